@@ -5,7 +5,7 @@ Created on Wed Mar 12 12:48:33 2014
 @author: ibackus
 """
 
-__version__ = "$Revision: 4 $"
+__version__ = "$Revision: 5 $"
 # $Source$
 
 __iversion__ = int(filter(str.isdigit,__version__))
@@ -15,6 +15,9 @@ import pynbody
 SimArray = pynbody.array.SimArray
 import numpy as np
 import os
+import sys
+import traceback
+import types
 import cPickle as pickle
 from warnings import warn
 
@@ -29,6 +32,10 @@ import make_snapshotSTypeSupplied
 import ICgen_settings
 import make_sigma
 import sigma_profile
+import stage_cache
+import ic_store
+import checkpoint
+import timing
 from ICglobal_settings import global_settings
 import isaac
 
@@ -105,6 +112,12 @@ class IC:
             pass
         
         # Add modules/attributes
+        # Labels of the stage outputs (see stage_cache.py)
+        self._stage_keys = {}
+        # Keys of the settings/inputs the stage outputs were made with
+        self._made_with = {}
+        # Attributes which are built when first accessed (see ICgen.load)
+        self._lazy = {}
         self.T = calc_temp.T(self)
         self.maker = maker(self)
         self.add = add(self)
@@ -115,14 +128,29 @@ class IC:
             self.maker.sigma_gen(r, sigma, CDF)
         
         # Define a saving function        
-        def saver(filename = None):
+        def saver(filename = None, compress = None):
             """
             A wrapper for ICgen.save
             """
-            save(self, filename)
+            save(self, filename, compress)
             
         self.save = saver
         
+    def __getattr__(self, name):
+        """
+        Builds lazily loaded attributes (see ICgen.load) on first access
+        """
+        lazy = self.__dict__.get('_lazy', {})
+        
+        if name in lazy:
+            
+            val = lazy.pop(name).build()
+            setattr(self, name, val)
+            
+            return val
+            
+        raise AttributeError, name
+        
     def Qest(self, r=None):
         """
         Estimate Toomre Q at r (optional) for ICs, assuming omega=epicyclic
@@ -130,49 +158,166 @@ class IC:
         """
         return Qest(self, r)
         
-    def generate(self, restart=False):
+    def _has(self, name):
+        """
+        Checks if self has the attribute name, without building it if it is
+        lazily loaded
+        """
+        return (name in self.__dict__) or (name in self._lazy)
+        
+    def generate(self, restart=False, force=False):
         """
         Runs through all the steps to generate a set of initial conditions
+        (sigma, rho, pos, snapshot)
+        
+        Only the steps which are out of date are run: a step is re-run if its
+        output doesn't exist, if the settings it reads (see 
+        stage_cache._stage_settings) have changed since it was made, or if a
+        step before it was re-run.  A sigma which was supplied as arrays is
+        kept.
+        
+        IF restart=True, it picks up at the last completed step (outputs which
+        exist are kept even if the settings have changed)
         
-        IF restart=True, it picks up at the last completed step
+        IF force=True, all the steps are re-run
+        
+        The ICs are saved after every step.  If global_settings['ic_store']
+        ['background'] is True, the saves are written in a background thread
+        (see checkpoint.py) while the next step runs.  generate only returns
+        once they are all written.
+        
+        The wall time, CPU time, and memory use of every step (and parts of 
+        the steps, ie the ChaNGa runs) are stored in self.timing and saved 
+        next to the IC file (ie IC_timing.json).  See timing.py
         """
-        if restart:
+        with timing.report('generate') as report:
             
-            # Find the last completed step
-            if hasattr(self, 'pos'): initial_step = 3
-            elif hasattr(self, 'rho'): initial_step = 2
-            elif hasattr(self, 'sigma'): initial_step = 1
-            else: initial_step = 0
+            self._generate(restart, force)
+            
+        self.timing = report
+        filename = self.settings.filenames.IC_file_name
+        report.save(os.path.splitext(filename)[0] + '_timing.json')
         
+    def _generate(self, restart=False, force=False):
+        """
+        Runs the steps of generate
+        """
+        if global_settings['ic_store']['background']:
+            
+            writer = checkpoint.writer()
+            
         else:
             
-            initial_step = 0
-        
-        self.save()
+            writer = None
+            
+        try:
+            
+            self._checkpoint(writer)
+            
+            makers = {'sigma': self.maker.sigma_gen, 'rho': self.maker.rho_gen, \
+            'pos': self.maker.pos_gen, 'snapshot': self.maker.snapshot_gen}
+            
+            for stage in ('sigma', 'rho', 'pos', 'snapshot'):
+                
+                if force or self._out_of_date(stage, restart):
+                    
+                    with timing.stage(stage):
+                        
+                        makers[stage]()
+                        
+                    self._checkpoint(writer)
+                    
+                else:
+                    
+                    print '{0} is up to date'.format(stage)
+                    
+        except:
+            # Raise the error of the stage, not one from closing the writer
+            exc_info = sys.exc_info()
+            
+            if writer is not None:
+                
+                try:
+                    
+                    writer.close()
+                    
+                except Exception:
+                    
+                    warn('Checkpoint writer also failed:\n' + \
+                    traceback.format_exc())
+                    
+            raise exc_info[0], exc_info[1], exc_info[2]
+                
+        if writer is not None:
+            
+            with timing.stage('flush'):
+                
+                writer.close()
+                
+            # Clean up the columns of the checkpoints (not done in the 
+            # background, since the steps write to the data directory)
+            filename = self.settings.filenames.IC_file_name
+            ic_store.clean(ic_store.data_dir(filename), \
+            pickle.load(open(filename, 'rb')))
+                
+    def _checkpoint(self, writer=None):
+        """
+        Saves the ICs.  If writer (a checkpoint.writer) is set, the arrays are
+        written in the background by writer (see IC.generate)
+        """
+        with timing.stage('checkpoint'):
+            
+            if writer is None:
+                
+                self.save()
+                
+            else:
+                
+                args = _prepare_save(self)
+                writer.submit(_write_save, *args, clean=False)
+                
+    def _out_of_date(self, stage, restart=False):
+        """
+        Checks whether the output of stage needs to be (re)made
+        """
+        if not self._has(stage):
+            
+            return True
+            
+        if restart:
+            
+            return False
+            
+        made_with = self._made_with.get(stage)
         
-        if initial_step <= 0:
+        if (stage == 'sigma') and (made_with == 'input'):
+            
+            return False
             
-            # Generate sigma
-            self.maker.sigma_gen()
-            self.save()
+        current = stage_cache.stage_key(self, stage, self._upstream(stage))
         
-        if initial_step <= 1:
+        return (made_with is None) or (made_with != current)
+        
+    def _upstream(self, stage):
+        """
+        Returns the labels of the outputs stage is made from (see 
+        stage_cache.stage_key)
+        """
+        labels = self._stage_keys
+        
+        if stage == 'rho':
+            
+            return labels.get('sigma')
             
-            # Generate rho
-            self.maker.rho_gen()
-            self.save()
+        elif stage == 'pos':
             
-        if initial_step <= 2:
+            return (labels.get('sigma'), labels.get('rho'))
             
-            # Generate positions
-            self.maker.pos_gen()
-            self.save()
+        elif stage == 'snapshot':
             
-        if initial_step <= 3:
+            return labels.get('pos')
             
-            # Generate snapshot
-            self.maker.snapshot_gen()
-            self.save()
+        return None
             
 def Qest(ICobj, r=None):
     """
@@ -203,18 +348,49 @@ def Qest(ICobj, r=None):
     return Q
         
         
-def save(ICobj, filename=None):
+def save(ICobj, filename=None, compress=None):
+    """
+    Saves ICobj to filename (default: settings.filenames.IC_file_name).
+    
+    filename is a pickled dictionary.  The arrays (sigma, CDF, rho, and the 
+    positions) are stored in a directory next to it (see ic_store.py), 
+    compressed if compress=True (default: global_settings['ic_store']
+    ['compress'])
+    
+    The snapshot is only written if it isn't already on disk as
+    settings.filenames.snapshotName (snapshot_gen writes it there and keeps it
+    up to date).  Changes made to ICobj.snapshot after that should be written
+    with ICobj.snapshot.write()
+    """
+    _write_save(*_prepare_save(ICobj, filename, compress))
+    
+def _prepare_save(ICobj, filename=None, compress=None):
+    """
+    The first part of save: saves the settings, .param, .director (and if
+    needed the snapshot) and makes the save dictionary.  The arrays in the
+    save dictionary aren't written yet (see _write_save), but it doesn't 
+    change if ICobj does, so it can be written later (see IC.generate)
     
+    Returns filename, save_dict, compress (the arguments of _write_save)
+    """
     if filename is None:
         
         filename = ICobj.settings.filenames.IC_file_name
     
+    if compress is None:
+        
+        compress = ic_store.compress_default()
+    
     save_dict = {}
     
     if hasattr(ICobj, '__version__'):
         
         save_dict['version'] = ICobj.__version__
         
+    # Keep track of what the outputs were made with (see IC.generate)
+    save_dict['stage_keys'] = ICobj._stage_keys.copy()
+    save_dict['made_with'] = ICobj._made_with.copy()
+        
     # --------------------------------------------------
     # GET SETTINGS/save a copy
     # --------------------------------------------------
@@ -225,7 +401,11 @@ def save(ICobj, filename=None):
     # --------------------------------------------------
     # Prepare rho, if available
     # --------------------------------------------------
-    if hasattr(ICobj, 'rho'):
+    if 'rho' in ICobj._lazy:
+        
+        save_dict['rho'] = ICobj._lazy['rho'].raw
+        
+    elif hasattr(ICobj, 'rho'):
         
         rho = ICobj.rho
         # Generate a dictionary containing rho_binned, z_bins, r_bins
@@ -239,11 +419,15 @@ def save(ICobj, filename=None):
     # --------------------------------------------------
     # Prepare sigma, if available
     # --------------------------------------------------
-    if hasattr(ICobj, 'sigma'):
+    if 'sigma' in ICobj._lazy:
+        
+        save_dict.update(ICobj._lazy['sigma'].raw)
+        
+    elif hasattr(ICobj, 'sigma'):
         
         sigma = ICobj.sigma
         # Update save dictionary
-        save_dict['sigma'] = sigma.input_dict
+        save_dict['sigma'] = sigma.input_dict.copy()
         save_dict['CDF'] = sigma._CDF
 
     # --------------------------------------------------
@@ -251,7 +435,9 @@ def save(ICobj, filename=None):
     # --------------------------------------------------
     if hasattr(ICobj, 'pos'):
         
-        save_dict['pos'] = ICobj.pos
+        pos_state = ICobj.pos.__dict__.copy()
+        pos_state.pop('_parent', None)
+        save_dict['pos'] = pos_state
         
     # --------------------------------------------------
     # Prepare param/dict if possible
@@ -274,10 +460,23 @@ def save(ICobj, filename=None):
     # SAVE
     # --------------------------------------------------
     # Save snapshot if possible
-    if hasattr(ICobj, 'snapshot'):
+    fname = ICobj.settings.filenames.snapshotName
+    
+    if ('snapshot' in ICobj._lazy) and (ICobj._lazy['snapshot'].raw == fname):
+        
+        # Not loaded (so not changed) and already saved to fname
+        save_dict['snapshotName'] = fname
+        
+    elif hasattr(ICobj, 'snapshot') and \
+    (getattr(ICobj, '_snapshot_file', None) == fname):
+        
+        # The snapshot file is kept up to date by snapshot_gen (or the
+        # snapshot was loaded from it)
+        save_dict['snapshotName'] = fname
+    
+    elif hasattr(ICobj, 'snapshot'):
         
         fmt = pynbody.tipsy.TipsySnap
-        fname = ICobj.settings.filenames.snapshotName
         save_dict['snapshotName'] = fname
         
         # Sometimes, saving the snapshot once raises an error.  Saving again
@@ -290,12 +489,48 @@ def save(ICobj, filename=None):
         except ValueError:
             
             ICobj.snapshot.write(fmt = fmt, filename = fname)
+            
+    return filename, save_dict, compress
+    
+def _write_save(filename, save_dict, compress, clean=True):
+    """
+    The second part of save: writes the arrays of save_dict as columns, then
+    the save dictionary (see _prepare_save).  filename is written to a 
+    temporary file first and renamed once it is complete, so it is never left
+    partially written.  If clean=True, columns from previous saves which are
+    no longer used are deleted (see ic_store.clean)
+    """
+    # Store the arrays as columns
+    data_dir = ic_store.data_dir(filename)
+    save_dict = save_dict.copy()
+    save_dict['data_dir'] = os.path.basename(data_dir)
+    
+    for key in ('sigma', 'CDF', 'rho', 'pos'):
         
+        if key in save_dict:
+            
+            save_dict[key] = ic_store.write(save_dict[key], data_dir, key, \
+            compress)
+    
     # Save the save dictionary
-    pickle.dump(save_dict,open(filename,'wb'), protocol=2)
+    tmpname = filename + '.tmp'
+    f = open(tmpname, 'wb')
+    pickle.dump(save_dict, f, protocol=2)
+    f.close()
+    os.rename(tmpname, filename)
+    
+    if clean:
+        # Remove columns from previous saves which are no longer used
+        ic_store.clean(data_dir, save_dict)
+        
     print 'Initial conditions saved to {0}'.format(filename)        
     
 def load(filename):
+    """
+    Loads ICs saved with ICgen.save.  sigma, rho, and the snapshot are only
+    built (splines, CDFs, etc.) when they are first accessed, and the arrays
+    are memory-mapped, so loading is fast
+    """
        
     # Load everything available from filename
     input_dict = pickle.load(open(filename,'rb'))
@@ -311,27 +546,31 @@ def load(filename):
     
     _upgrade_version(input_dict, version)
     
+    # Read the arrays (memory-mapped)
+    if 'data_dir' in input_dict:
+        
+        data_dir = os.path.join(os.path.dirname(filename), \
+        input_dict['data_dir'])
+        
+        for key in ('sigma', 'CDF', 'rho', 'pos'):
+            
+            if key in input_dict:
+                
+                input_dict[key] = ic_store.read(input_dict[key], data_dir)
+    
     # Parse the input dictionary
+    # Initialize blank IC object
+    ICobj = IC()
     
     if 'sigma' in input_dict:
         
-        # Load sigma stuff
-        sigma = input_dict['sigma']['sigma']
-        r = input_dict['sigma']['r']
+        raw = {'sigma': input_dict['sigma']}
         
-        # Initialize ICobj
         if 'CDF' in input_dict:
             
-            CDF = input_dict['CDF']
-            ICobj = IC(r, sigma, CDF)
+            raw['CDF'] = input_dict['CDF']
             
-        else:
-        
-            ICobj = IC(r, sigma)
-            
-    else:
-        # Initialize blank IC object, sigma has not been generated yet
-        ICobj = IC()
+        ICobj._lazy['sigma'] = _lazy_attr(_load_sigma, ICobj, raw)
         
     if 'settings' in input_dict:
 
@@ -341,23 +580,25 @@ def load(filename):
         
     if 'rho' in input_dict:
         
-        print 'loading rho'
-        ICobj.add.rho(input_dict['rho'])
+        ICobj._lazy['rho'] = _lazy_attr(_load_rho, ICobj, input_dict['rho'])
         
     if 'pos' in input_dict:
         
         print 'loading pos'
-        ICobj.pos = input_dict['pos']
+        # Re-create the pos object from its attributes (without generating
+        # positions)
+        ICobj.pos = types.InstanceType(pos_class.pos, input_dict['pos'])
         ICobj.pos._parent = ICobj
+        ICobj.pos._memmap_files = {}
         
     if 'snapshotName' in input_dict:
         
-        print 'loading snapshot'
         fname = input_dict['snapshotName']
         
-        try:
+        if os.path.exists(fname):
         
-            ICobj.snapshot = pynbody.load(fname)
+            ICobj._lazy['snapshot'] = _lazy_attr(_load_snapshot, ICobj, fname)
+            
             if 'snapshot_param' in input_dict:
         
                 print 'loading param'
@@ -368,16 +609,77 @@ def load(filename):
                 print 'loading director'
                 ICobj.snapshot_director = input_dict['snapshot_director']
             
-        except IOError:
+        else:
             
             warn('Could not find snapshot ({0})'.format(fname))
             print 'Could not find snapshot ({0})'.format(fname)
+            
+    if 'made_with' in input_dict:
+        
+        ICobj._stage_keys.update(input_dict['stage_keys'])
+        ICobj._made_with = input_dict['made_with']
         
+    elif 'sigma' in input_dict:
+        
+        # Unknown, so keep sigma (see IC.generate)
+        ICobj._made_with['sigma'] = 'input'
     
 
     return ICobj
             
             
+class _lazy_attr:
+    """
+    An attribute of an IC object which is built when it is first accessed (see
+    IC.__getattr__).  raw is the saved data it is built from
+    """
+    
+    def __init__(self, builder, ICobj, raw):
+        
+        self._builder = builder
+        self._ICobj = ICobj
+        self.raw = raw
+        
+    def build(self):
+        
+        ICobj = self._ICobj
+        # Building shouldn't change what the stages were made with
+        made_with = ICobj._made_with.copy()
+        val = self._builder(ICobj, self.raw)
+        ICobj._made_with = made_with
+        
+        return val
+        
+def _load_sigma(ICobj, raw):
+    
+    print 'loading sigma'
+    # Copied, since make_sigma alters r
+    r = raw['sigma']['r'].copy()
+    sigma = raw['sigma']['sigma'].copy()
+    CDF = raw.get('CDF')
+    
+    if CDF is not None:
+        
+        CDF = np.array(CDF)
+        
+    ICobj.maker.sigma_gen(r, sigma, CDF)
+    
+    return ICobj.sigma
+    
+def _load_rho(ICobj, raw):
+    
+    print 'loading rho'
+    ICobj.add.rho(raw)
+    
+    return ICobj.rho
+    
+def _load_snapshot(ICobj, fname):
+    
+    print 'loading snapshot'
+    ICobj._snapshot_file = fname
+    
+    return pynbody.load(fname)
+            
 def _upgrade_version(IC_input, version):
     """
     Used for backwards compatibility.  If an initial conditions object was
@@ -422,6 +724,17 @@ def _upgrade_version(IC_input, version):
     if version < 4:
         
         IC_input['settings'] = IC_input['settings'].settings_filename
+    
+    if version < 5:
+        
+        # Arrays were stored in the pickle (not in the columnar store, see
+        # ic_store.py) and pos was stored as an object.  They are moved to the 
+        # columnar store the next time the ICs are saved
+        if 'pos' in IC_input:
+            
+            pos_state = IC_input['pos'].__dict__
+            pos_state.pop('_parent', None)
+            IC_input['pos'] = pos_state
         
         
 class add:
@@ -453,6 +766,9 @@ class add:
         r_bins = rho_dict['r']
         
         self._parent.rho = calc_rho_zr.rho_from_array(self._parent, rho_binned, z_bins, r_bins)
+        self._parent._stage_keys['rho'] = stage_cache.hash_value(\
+        ('rho', rho_binned, z_bins, r_bins))
+        self._parent._made_with.pop('rho', None)
         
         print 'rho stored in <IC instance>.rho'
         
@@ -490,15 +806,51 @@ class maker:
         
         r and sigma should be 1-D SimArrays.  sigma is the surface density
         evaluated at r
+        
+        When sigma is made from the settings, it is loaded from the stage
+        cache if possible (see stage_cache.py)
         """
         # Generate sigma
+        made_with = 'input'
+        
         if r is None:
             
-            r, sigma = sigma_profile.make_profile(self._parent)
+            made_with = None
+            key = stage_cache.stage_key(self._parent, 'sigma')
+            cached = stage_cache.load('sigma', key)
+            
+            if cached is not None:
+                
+                r, sigma, CDF = cached
+                
+            else:
+                
+                with timing.stage('profile'):
+                    
+                    r, sigma = sigma_profile.make_profile(self._parent)
+                
+        else:
+            
+            key = None
+            cached = None
+            
+        with timing.stage('sigma_gen'):
+            
+            sigma = make_sigma.sigma_gen(r, sigma, CDF)
+            timing.add_arrays(r=r, CDF=sigma._CDF)
+            
+        r = sigma.input_dict['r']
+        label = stage_cache.hash_value(('sigma', r, sigma.input_dict['sigma']))
+        
+        if cached is None:
+            
+            stage_cache.save('sigma', key, (r, sigma.input_dict['sigma'], \
+            sigma._CDF))
             
-        sigma = make_sigma.sigma_gen(r, sigma, CDF)
         # Copy sigma to the parent (IC) object
         self._parent.sigma = sigma
+        self._parent._stage_keys['sigma'] = label
+        self._made('sigma', made_with)
         
         print 'Sigma stored in <IC instance>.sigma'
         
@@ -507,6 +859,8 @@ class maker:
         A wrapper for calc_rho_zr.
         
         Upon executing, generates rho and rho cdf inverse
+        
+        rho is loaded from the stage cache if possible (see stage_cache.py)
         """
         
         # Check that sigma has been generated
@@ -514,13 +868,39 @@ class maker:
             
             raise RuntimeError,'Must load/generate sigma before calculating rho'
             
-        # Numerically calculate rho(z,r) for a given sigma.  rho(z,r)
-        # obeys vertical hydrostatic equilibrium (approximately)
-        rho_array, z, r = calc_rho_zr.rho_zr(self._parent)
+        settings = self._parent.settings
+        key = stage_cache.stage_key(self._parent, 'rho', \
+        self._parent._upstream('rho'))
+        cached = stage_cache.load('rho', key)
+        
+        if cached is not None:
+            
+            rho_array, z, r, zmax = cached
+            # rho_zr fills in zmax if it isn't set
+            settings.rho_calc.zmax = zmax
+            
+        else:
+            
+            # Numerically calculate rho(z,r) for a given sigma.  rho(z,r)
+            # obeys vertical hydrostatic equilibrium (approximately)
+            with timing.stage('rho_zr'):
+                
+                rho_array, z, r = calc_rho_zr.rho_zr(self._parent)
+                timing.add_arrays(rho=rho_array, z=z, r=r)
+                
+            stage_cache.save('rho', key, (rho_array, z, r, \
+            settings.rho_calc.zmax))
+            
         # Create a complete rho object.  Includes rho spline and CDF inverse
-        rho = calc_rho_zr.rho_from_array(self._parent, rho_array, z, r)
+        with timing.stage('rho_from_array'):
+            
+            rho = calc_rho_zr.rho_from_array(self._parent, rho_array, z, r)
+            
         # Save to ICobj
         self._parent.rho = rho
+        self._parent._stage_keys['rho'] = stage_cache.hash_value(\
+        ('rho', rho_array, z, r))
+        self._made('rho')
         
         print 'rho stored in <IC instance>.rho'
         
@@ -532,11 +912,50 @@ class maker:
         
         IF called with method not set, the method used is:
             ICobj.settings.pos_gen.method
+            
+        Positions are loaded from the stage cache if possible (see 
+        stage_cache.py).  They are only cached if they can be reproduced (a
+        seed is set with pos_gen.seed) and aren't memory-mapped 
+        (pos_gen.chunk_size is None)
         """
-        # Generate positions object
-        pos = pos_class.pos(self._parent, method)
+        settings = self._parent.settings
+        
+        if method is not None:
+            
+            settings.pos_gen.method = method
+            
+        key = stage_cache.stage_key(self._parent, 'pos', \
+        self._parent._upstream('pos'))
+        use_cache = (settings.pos_gen.chunk_size is None) and \
+        (settings.pos_gen.seed is not None)
+        pos = None
+        
+        if use_cache:
+            
+            pos = stage_cache.load('pos', key)
+            
+        if pos is not None:
+            
+            pos._parent = self._parent
+            
+        else:
+            
+            # Generate positions object
+            with timing.stage('pos_class'):
+                
+                pos = pos_class.pos(self._parent, method, \
+                seed=settings.pos_gen.seed)
+                timing.add_arrays(xyz=pos.xyz, r=pos.r)
+                
+            
+            if use_cache:
+                
+                stage_cache.save('pos', key, pos)
+                
         # Save it to ICobj
         self._parent.pos = pos
+        self._parent._stage_keys['pos'] = key
+        self._made('pos')
         
     def snapshot_gen(self):
         """
@@ -546,8 +965,13 @@ class maker:
         """
         
         # Generate snapshot for either a single star or binary depending on IC.settings.physical.starMode
+        # make_snapshot keeps the snapshot file up to date, so ICgen.save
+        # doesn't need to write it
+        snapshot_file = None
+        
         if self._parent.settings.physical.starMode == "single":							
             snapshot, snapshot_param, snapshot_director = make_snapshot.snapshot_gen(self._parent)
+            snapshot_file = self._parent.settings.filenames.snapshotName
         elif self._parent.settings.physical.starMode == "binary":
             snapshot, snapshot_param, snapshot_director = make_snapshotBinary.snapshot_gen(self._parent)
         elif self._parent.settings.physical.starMode == "stype":
@@ -557,9 +981,27 @@ class maker:
         else:
             print "Invalid starMode given in ICobj.  Assuming default single star."
             snapshot, snapshot_param, snapshot_director = make_snapshot.snapshot_gen(self._parent)
+            snapshot_file = self._parent.settings.filenames.snapshotName
 										
 	  # Save to ICobj
         self._parent.snapshot = snapshot
         self._parent.snapshot_param = snapshot_param
         self._parent.snapshot_director = snapshot_director
+        self._parent._snapshot_file = snapshot_file
+        self._made('snapshot')
+        
+    def _made(self, stage, made_with=None):
+        """
+        Records the key of the settings/inputs the output of stage was made 
+        with (see IC.generate).  Note, the settings can be updated while making
+        the output (ie, rho_calc.zmax) so this is done afterwards
+        """
+        ICobj = self._parent
+        
+        if made_with is None:
+            
+            made_with = stage_cache.stage_key(ICobj, stage, \
+            ICobj._upstream(stage))
+            
+        ICobj._made_with[stage] = made_with
         
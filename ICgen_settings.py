@@ -255,9 +255,25 @@ class rho_calc:
         # The maximum z (assumed to be au) to calculate rho(z,r) at.  Outside zmax,
         # rho = 0.  If None, zmax is twice the scale height at rmax
         self.zmax = None
+        # If not None, every radius gets its own z grid which extends to
+        # zmax_scale times the local scale height, sqrt(2 k T r^3/(G M m)).
+        # z is then 2D, with the same shape as rho.  zmax is only used to set
+        # the units
+        self.zmax_scale = None
         # Numerical parameter.  During the calculation of rho(z) for a given r.  See
         # the doc-string for calc_rho.py
         self.rho_tol = 1.001
+        # How to solve for rho at all the radii.  'pool' solves every radius
+        # separately using a multiprocessing pool, 'batch' solves all radii
+        # at once as one stacked system and 'library' interpolates from a
+        # cached table of solutions (see calc_rho_zr.rho_zr)
+        self.method = 'pool'
+        # For method = 'pool', warm start each radius from the solution at the
+        # previous radius (see calc_rho.rho_z_continuation)
+        self.warm_start = False
+        # For method = 'library', the maximum estimated relative error of the
+        # interpolated rho(z).  Radii above this are solved for exactly
+        self.library_tol = 1e-3
 
         
     def __call__(self):
@@ -288,6 +304,14 @@ class pos_gen:
         self.nParticles = 40411
         # The method for generating positions
         self.method = 'grid'
+        # Number of particles generated at a time.  If not None, r and xyz
+        # are stored in memory-mapped .npy files next to the IC file so that
+        # memory use is bounded by chunk_size rather than nParticles
+        self.chunk_size = None
+        # Random seed for the positions.  If None, every IC gets a new
+        # realization.  Positions are only cached (see stage_cache.py) if a
+        # seed is set
+        self.seed = None
         
     def __call__(self):
         
@@ -315,6 +339,23 @@ class snapshot:
         # by this factor
         self.mScale = 1.0
         
+        # How the gravitational accelerations used to calculate the 
+        # velocities are found: 'changa' (run ChaNGa), 'tree' (in-process
+        # tree code, see gravity.py) or 'grid' (the axisymmetric field of 
+        # sigma and rho, see potential.py).  See calc_velocity.v_xy
+        self.gravity = 'changa'
+        # Opening angle for gravity = 'tree'
+        self.theta = 0.7
+        # How the accelerations due to pressure are found: 'changa' (run 
+        # ChaNGa with SPH) or 'grid' (the pressure gradient of rho and T, see
+        # calc_velocity.pressure_support)
+        self.pressure = 'changa'
+        # How the gravitational softening eps of the gas is estimated: 
+        # 'changa' (half the mean ChaNGa smoothing length) or 'tree' (half of
+        # every particle's smoothing length, found in-process, which also 
+        # sets the SPH density rho.  See smooth.py)
+        self.smooth = 'changa'
+        
         # Other defaults that shouldn't need to be changed
         self.metals = 1.0
         
@@ -476,6 +517,29 @@ class settings:
         # Update the settings_filename
         self.settings_filename = settings_filename
         
+    def _fill_defaults(self):
+        """
+        Adds any settings missing from self (ie settings added to ICgen since
+        self was saved) using the default values
+        """
+        defaults = {'filenames': filenames, 'rho_calc': rho_calc, \
+        'pos_gen': pos_gen, 'snapshot': snapshot, 'changa_run': changa_run}
+        
+        for key, default_class in defaults.iteritems():
+            
+            if not hasattr(self, key):
+                
+                setattr(self, key, default_class())
+                continue
+            
+            current = getattr(self, key)
+            
+            for attr, val in default_class().__dict__.iteritems():
+                
+                if attr not in current.__dict__:
+                    
+                    current.__dict__[attr] = val
+        
     def load(self,settings_filename):
         """
         Load settings from settings_filename.
@@ -490,6 +554,10 @@ class settings:
         
         version = checkversion(self)
         
+        # Settings saved before a setting was added won't have it.  Fill in
+        # any missing settings with their defaults
+        self._fill_defaults()
+        
         # Version checking
             
         if version < 3:
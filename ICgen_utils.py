@@ -14,12 +14,17 @@ import pynbody
 SimArray = pynbody.array.SimArray
 import os
 import re
+import multiprocessing
+from contextlib import contextmanager
 
 # ICgen modules
 from ICglobal_settings import global_settings
 
 import isaac
 
+# Limit on the number of ChaNGa runs at once (see set_changa_limit)
+_changa_limit = None
+
 def Qeff(ICobj, bins=None):
     
     if bins is None:
@@ -180,7 +185,8 @@ def delistify(in_list):
 def est_eps(smoothlength_file, nstar=1):
     """
     Estimate gravitational softening length (eps) from a ChaNGa output .smoothlength
-    file.  eps is estimated as 1/2 the mean smoothing length
+    file.  eps is estimated as 1/2 the mean smoothing length.  See smooth.py
+    for per-particle smoothing lengths calculated without ChaNGa
     
     **ARGUENTS**
     
@@ -255,26 +261,33 @@ def est_time_step(param_name, preset='default', dDelta0=100, changa_args='', run
     command = changa_command(param_name, preset, changa_args=changa_args, runner_args=runner_args)
     
     rung_line = ''
-    p = changa_run(command, verbose=False)
     
-    for line in iter(p.stdout.readline, ''):
+    # ChaNGa is killed with pkill, which would kill any other ChaNGa runs, so
+    # nothing else may run ChaNGa meanwhile
+    with changa_slot(exclusive=True):
         
-        if 'rung distribution' in line.lower():
-            
-            # Kill the runner
-            kill_command = 'pkill -9 ' + runner_name
-            pkill = subprocess.Popen(kill_command.split(), \
-            stdout=subprocess.PIPE)
-            pkill.wait()
+        p = changa_run(command, verbose=False)
+        
+        for line in iter(p.stdout.readline, ''):
             
-            # Kill ChaNGa
-            kill_command = 'pkill -9 ' + changa_name
-            pkill = subprocess.Popen(kill_command.split(), \
-            stdout=subprocess.PIPE)
-            pkill.wait()
+            if 'rung distribution' in line.lower():
+                
+                # Kill the runner
+                kill_command = 'pkill -9 ' + runner_name
+                pkill = subprocess.Popen(kill_command.split(), \
+                stdout=subprocess.PIPE)
+                pkill.wait()
+                
+                # Kill ChaNGa
+                kill_command = 'pkill -9 ' + changa_name
+                pkill = subprocess.Popen(kill_command.split(), \
+                stdout=subprocess.PIPE)
+                pkill.wait()
+                
+                rung_line = line.strip()
+                break
             
-            rung_line = line.strip()
-            break
+        p.wait()
         
     if rung_line == '':
         
@@ -306,6 +319,68 @@ def est_time_step(param_name, preset='default', dDelta0=100, changa_args='', run
     return dDelta
             
 
+def changa_limit(n):
+    """
+    Makes a limit of n ChaNGa runs at once, which can be shared between 
+    processes (see set_changa_limit)
+    """
+    return (multiprocessing.Semaphore(n), multiprocessing.Lock(), n)
+    
+def set_changa_limit(limit):
+    """
+    Sets the limit on the number of ChaNGa runs at once for this process (see
+    changa_slot).  limit is made by changa_limit.  Processes started after
+    this (or given the same limit) share it.  If limit is None, the number 
+    of runs is unlimited
+    """
+    global _changa_limit
+    _changa_limit = limit
+    
+@contextmanager
+def changa_slot(exclusive=False):
+    """
+    A context manager for running ChaNGa.  Waits until ChaNGa may be run (see
+    set_changa_limit).  If exclusive=True, waits until no other ChaNGa run
+    is allowed, ie until all the slots are free
+    
+    USAGE:
+        
+        with changa_slot():
+            
+            p = changa_run(command)
+            p.wait()
+    """
+    if _changa_limit is None:
+        
+        yield
+        return
+        
+    slots, lock, n = _changa_limit
+    
+    if exclusive:
+        # The lock stops two exclusive runs from each taking some slots
+        # and waiting on each other
+        with lock:
+            
+            for i in range(n):
+                
+                slots.acquire()
+                
+    else:
+        
+        n = 1
+        slots.acquire()
+        
+    try:
+        
+        yield
+        
+    finally:
+        
+        for i in range(n):
+            
+            slots.release()
+
 def changa_run(command, verbose = True, logfile_name=None, force_wait=False):
     """
     A wrapper for running ChaNGa
@@ -37,6 +37,38 @@ misc = {}
 misc['max_particles'] = int(1e7)
 defaults['misc'] = misc
 
+# ***** rho(z) solution library (see rho_library.py) *****
+rho_library = {}
+# Directory the dimensionless rho(z) tables are cached in (per user)
+rho_library['directory'] = os.path.join(os.path.expanduser('~'), '.cache', \
+'ICgen', 'rho_library')
+# Maximum total size (in MB) of the cached tables.  The least recently used
+# tables are deleted to stay below this
+rho_library['max_size'] = 100
+defaults['rho_library'] = rho_library
+
+# ***** Stage cache (see stage_cache.py) *****
+stage_cache = {}
+# Cache sigma, rho, and positions generated by ICgen.  Off by default (the
+# cache can get large).  sweep.run turns it on for a sweep
+stage_cache['enabled'] = False
+# Directory the stage outputs are cached in (per user)
+stage_cache['directory'] = os.path.join(os.path.expanduser('~'), '.cache', \
+'ICgen', 'stage_cache')
+# Maximum total size (in MB) of the cache.  The least recently used outputs
+# are deleted to stay below this
+stage_cache['max_size'] = 2000
+defaults['stage_cache'] = stage_cache
+
+# ***** Storage of saved ICs (see ic_store.py) *****
+ic_store = {}
+# Save the arrays of ICs compressed (smaller, but can't be memory-mapped)
+ic_store['compress'] = False
+# Write the saves made during IC.generate in a background thread (see 
+# checkpoint.py)
+ic_store['background'] = True
+defaults['ic_store'] = ic_store
+
 # ***** Cluster presets *****
 node_info = {}
 node_info['scheduler'] = 'PBS'
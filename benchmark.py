@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmarks of the IC pipeline.  These don't need ChaNGa, so they can
+be run on any machine.
+
+The benchmarked stages are:
+    sigma_gen       make_sigma.sigma_gen (swept over sigma.n_points)
+    rho_zr          calc_rho_zr.rho_zr (swept over rho_calc.nr and nz)
+    rho_from_array  building calc_rho_zr.rho_from_array (nr and nz)
+    rho_lookup      rho.rho, rho.drho_dr, and rho.cdf_inv at n_lookup points
+                    (nr, nz) or at nParticles points (nParticles)
+    pos             pos_class.pos (nParticles)
+    tipsy_write     writing the snapshot (tipsy_io.write, as done by
+                    make_snapshot) (nParticles)
+
+Each sweep varies one parameter, keeping the others at their base value (see
+defaults).  Every case is run repeat times and the fastest run of every stage
+is kept (as timeit does), along with its CPU time.  To keep results
+comparable over time, the profile and random seeds are fixed, the stage
+cache is off, the rho library (for rho_calc.method = 'library') is a
+temporary one which is filled before timing, and the results are saved
+(as JSON) with the machine, package versions, and git commit they were made
+with.
+
+USAGE (command line):
+    
+    python benchmark.py                     # full sweeps, saves benchmark.json
+    python benchmark.py --quick             # small sweeps
+    python benchmark.py -o new.json --compare old.json --plot new.png
+
+USAGE (python):
+    
+    import benchmark
+    results = benchmark.run(quick=True)
+    benchmark.print_scaling(results)
+    benchmark.save(results, 'new.json')
+    benchmark.compare(results, benchmark.load('old.json'))
+    benchmark.plot(results, 'new.png')
+"""
+
+__version__ = 1
+
+# External packages
+import numpy as np
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import shutil
+import tempfile
+import warnings
+import subprocess
+import multiprocessing
+import argparse
+from contextlib import contextmanager
+import scipy
+import pynbody
+import matplotlib.pyplot as plt
+
+# ICgen packages
+import ICgen
+import make_sigma
+import sigma_profile
+import calc_rho_zr
+import pos_class
+import tipsy_io
+import timing
+from ICglobal_settings import global_settings
+
+# Base values of the swept parameters
+defaults = {}
+defaults['profile_kind'] = 'powerlaw'
+defaults['n_points'] = 1000
+defaults['nr'] = 100
+defaults['nz'] = 100
+defaults['rho_method'] = 'batch'
+defaults['nParticles'] = 100000
+defaults['n_lookup'] = 100000
+defaults['seed'] = 0
+defaults['repeat'] = 3
+
+# Parameter values of the sweeps
+sweeps = {}
+sweeps['n_points'] = [500, 1000, 2000, 4000, 8000, 16000]
+sweeps['nr'] = [50, 100, 200, 400, 800]
+sweeps['nz'] = [50, 100, 200, 400, 800]
+sweeps['nParticles'] = [10**4, 10**5, 10**6, 10**7]
+
+quick_sweeps = {}
+quick_sweeps['n_points'] = [250, 500, 1000, 2000]
+quick_sweeps['nr'] = [25, 50, 100, 200]
+quick_sweeps['nz'] = [25, 50, 100, 200]
+quick_sweeps['nParticles'] = [10**3, 10**4, 10**5]
+
+# The benchmark run for each swept parameter
+_benchmarks = {'n_points': 'sigma', 'nr': 'rho', 'nz': 'rho', \
+'nParticles': 'particles'}
+_order = ['n_points', 'nr', 'nz', 'nParticles']
+
+def run(quick=False, params=None, sweep=None, verbose=False):
+    """
+    Runs the benchmark sweeps
+    
+    * Arguments *
+    
+    quick : bool
+        Use the small sweeps (quick_sweeps) rather than sweeps
+    params : dict
+        Base parameters, overriding defaults (ie {'rho_method': 'pool'})
+    sweep : dict
+        Sweeps to run, as {parameter: values}, overriding the default sweeps.
+        Only the parameters in it are swept
+    verbose : bool
+        Show the output of the pipeline (hidden by default)
+    
+    * Output *
+    
+    results : dict
+        Contains 'meta' (the machine, versions, etc...), 'params' (the base
+        parameters), and 'cases', one for each value of each sweep.  Save
+        with save()
+    """
+    base = defaults.copy()
+    
+    if params is not None:
+        
+        base.update(params)
+    
+    if sweep is None:
+        
+        sweep = quick_sweeps if quick else sweeps
+    
+    results = {'meta': _meta(), 'params': base, 'cases': []}
+    old_settings = (global_settings['stage_cache']['enabled'], \
+    global_settings['rho_library']['directory'])
+    old_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='ICgen_benchmark_')
+    
+    try:
+        
+        # Everything the pipeline writes goes in work_dir
+        os.chdir(work_dir)
+        global_settings['stage_cache']['enabled'] = False
+        global_settings['rho_library']['directory'] = \
+        os.path.join(work_dir, 'rho_library')
+        
+        with _quiet(not verbose):
+            
+            ICobj = _make_IC(base)
+            
+            if base['rho_method'] == 'library':
+                
+                # Fill the library, so that the timed runs use it as it
+                # is normally used
+                _rho(ICobj, base['nr'], base['nz'], base['rho_method'])
+        
+        for parameter in _order:
+            
+            if parameter not in sweep:
+                
+                continue
+            
+            for value in sweep[parameter]:
+                
+                p = base.copy()
+                p[parameter] = value
+                print 'Benchmarking {0} = {1}'.format(parameter, value)
+                
+                with _quiet(not verbose):
+                    
+                    case = _run_case(ICobj, _benchmarks[parameter], p)
+                
+                case['parameter'] = parameter
+                case['value'] = value
+                results['cases'].append(case)
+    
+    finally:
+        
+        os.chdir(old_dir)
+        global_settings['stage_cache']['enabled'] = old_settings[0]
+        global_settings['rho_library']['directory'] = old_settings[1]
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    return results
+
+def save(results, filename='benchmark.json'):
+    """
+    Saves benchmark results (see run) to filename as JSON
+    """
+    f = open(filename, 'w')
+    json.dump(results, f, indent=2)
+    f.close()
+    print 'Benchmark results saved to {0}'.format(filename)
+
+def load(filename):
+    """
+    Loads benchmark results saved by save()
+    """
+    f = open(filename, 'r')
+    results = json.load(f)
+    f.close()
+    
+    return results
+
+def scaling(results):
+    """
+    Fits the wall time of every stage of every sweep as a power law of the
+    swept parameter.
+    
+    * Output *
+    
+    curves : dict
+        Keys are (parameter, stage).  Values are dicts containing 'values'
+        (of the parameter), 'wall' (the best wall times), and 'exponent'
+        (the fitted power, ie 1 for linear scaling; None if there are fewer
+        than 2 usable points)
+    """
+    curves = {}
+    
+    for case in results['cases']:
+        
+        for stage, record in case['stages'].iteritems():
+            
+            key = (case['parameter'], stage)
+            
+            if key not in curves:
+                
+                curves[key] = {'values': [], 'wall': []}
+            
+            curves[key]['values'].append(case['value'])
+            curves[key]['wall'].append(record['wall'])
+    
+    for curve in curves.values():
+        
+        x = np.array(curve['values'], dtype=float)
+        y = np.array(curve['wall'], dtype=float)
+        use = (x > 0) & (y > 0)
+        curve['exponent'] = None
+        
+        if use.sum() > 1:
+            
+            curve['exponent'] = float(np.polyfit(np.log(x[use]), \
+            np.log(y[use]), 1)[0])
+    
+    return curves
+
+def print_scaling(results):
+    """
+    Prints the wall time of every stage of every sweep and its scaling
+    exponent (see scaling)
+    """
+    curves = scaling(results)
+    
+    for parameter in _order:
+        
+        keys = sorted(key for key in curves if key[0] == parameter)
+        
+        if len(keys) == 0:
+            
+            continue
+        
+        values = curves[keys[0]]['values']
+        print ''
+        print '{0:<16}'.format(parameter) + \
+        ''.join('{0:>11}'.format(v) for v in values) + '   exponent'
+        
+        for key in keys:
+            
+            curve = curves[key]
+            exponent = curve['exponent']
+            exponent = '-' if exponent is None else '{0:.2f}'.format(exponent)
+            print '{0:<16}'.format(key[1]) + \
+            ''.join('{0:>11.4f}'.format(t) for t in curve['wall']) + \
+            '{0:>11}'.format(exponent)
+    
+    print ''
+    print '(best wall times in seconds)'
+
+def compare(results, reference, threshold=0.1):
+    """
+    Compares benchmark results to reference results (ie an older run).
+    Prints the best wall time of every stage in both and their ratio, flagging
+    stages which are more than a fraction threshold slower or faster.
+    
+    Returns a list of (parameter, value, stage, reference time, time)
+    """
+    for key in ('hostname', 'machine', 'cpu_count', 'python', 'numpy', \
+    'scipy', 'pynbody'):
+        
+        a = reference['meta'].get(key)
+        b = results['meta'].get(key)
+        
+        if a != b:
+            
+            print 'WARNING: {0} differs ({1} vs {2})'.format(key, a, b)
+    
+    if reference['params'] != results['params']:
+        
+        print 'WARNING: base parameters differ'
+    
+    ref_times = {}
+    
+    for case in reference['cases']:
+        
+        for stage, record in case['stages'].iteritems():
+            
+            ref_times[(case['parameter'], case['value'], stage)] = \
+            record['wall']
+    
+    print '{0:<12} {1:>10} {2:<16} {3:>10} {4:>10} {5:>7}'.format(\
+    'parameter', 'value', 'stage', 'ref (s)', 'new (s)', 'ratio')
+    out = []
+    
+    for case in results['cases']:
+        
+        for stage in sorted(case['stages']):
+            
+            key = (case['parameter'], case['value'], stage)
+            
+            if key not in ref_times:
+                
+                continue
+            
+            t_ref = ref_times[key]
+            t = case['stages'][stage]['wall']
+            ratio = t/t_ref if t_ref > 0 else np.inf
+            flag = ''
+            
+            if ratio > 1 + threshold:
+                
+                flag = 'slower'
+            
+            elif ratio < 1 - threshold:
+                
+                flag = 'faster'
+            
+            print '{0:<12} {1:>10} {2:<16} {3:>10.4f} {4:>10.4f} {5:>7.2f} {6}'\
+            .format(key[0], key[1], stage, t_ref, t, ratio, flag)
+            out.append(key + (t_ref, t))
+    
+    return out
+
+def plot(results, filename=None):
+    """
+    Plots the scaling curves (wall time vs swept parameter, one panel per
+    parameter).  Saved to filename if given, otherwise shown
+    """
+    curves = scaling(results)
+    parameters = [p for p in _order if any(key[0] == p for key in curves)]
+    fig, axes = plt.subplots(1, len(parameters), \
+    figsize=(4.5*len(parameters), 4), squeeze=False)
+    
+    for ax, parameter in zip(axes[0], parameters):
+        
+        for key in sorted(key for key in curves if key[0] == parameter):
+            
+            curve = curves[key]
+            label = key[1]
+            
+            if curve['exponent'] is not None:
+                
+                label += ' ({0:.2f})'.format(curve['exponent'])
+            
+            ax.loglog(curve['values'], curve['wall'], 'o-', label=label)
+        
+        ax.set_xlabel(parameter)
+        ax.set_ylabel('wall time (s)')
+        ax.legend(loc='best', fontsize='small')
+    
+    fig.tight_layout()
+    
+    if filename is not None:
+        
+        fig.savefig(filename)
+        plt.close(fig)
+        print 'Plot saved to {0}'.format(filename)
+    
+    else:
+        
+        plt.show()
+
+def _run_case(ICobj, benchmark, p):
+    """
+    Runs one case of a benchmark p['repeat'] times and keeps the fastest run
+    of every stage
+    """
+    stages = {}
+    
+    for i in range(p['repeat']):
+        
+        with timing.report(benchmark) as rep:
+            
+            if benchmark == 'sigma':
+                
+                _bench_sigma(ICobj, p)
+            
+            elif benchmark == 'rho':
+                
+                _bench_rho(ICobj, p)
+            
+            else:
+                
+                _bench_particles(ICobj, p)
+        
+        for record in rep.record['stages']:
+            
+            name = record['name']
+            
+            if name not in stages:
+                
+                stages[name] = {'walls': [], 'info': record['info']}
+            
+            stages[name]['walls'].append(record['wall'])
+            
+            if record['wall'] <= min(stages[name]['walls']):
+                
+                stages[name]['wall'] = record['wall']
+                stages[name]['cpu'] = record['cpu']
+                stages[name]['cpu_children'] = record['cpu_children']
+    
+    return {'benchmark': benchmark, 'params': p, 'stages': stages}
+
+def _bench_sigma(ICobj, p):
+    
+    settings = ICobj.settings
+    n_points = settings.sigma.n_points
+    settings.sigma.n_points = p['n_points']
+    r, sigma = sigma_profile.make_profile(ICobj)
+    settings.sigma.n_points = n_points
+    
+    with timing.stage('sigma_gen'):
+        
+        make_sigma.sigma_gen(r, sigma)
+
+def _bench_rho(ICobj, p):
+    
+    with timing.stage('rho_zr'):
+        
+        rho_array, z, r = _rho(ICobj, p['nr'], p['nz'], p['rho_method'])
+    
+    with timing.stage('rho_from_array'):
+        
+        rho = calc_rho_zr.rho_from_array(ICobj, rho_array, z, r)
+    
+    _bench_lookup(ICobj, rho, p['n_lookup'], p['seed'])
+
+def _bench_particles(ICobj, p):
+    
+    nParticles = p['nParticles']
+    _bench_lookup(ICobj, ICobj.rho, nParticles, p['seed'])
+    ICobj.settings.pos_gen.nParticles = nParticles
+    
+    with timing.stage('pos'):
+        
+        pos = pos_class.pos(ICobj, seed=p['seed'])
+    
+    # The fields make_snapshot writes
+    r = pos.r
+    gas = {'pos': pos.xyz, 'mass': 1.0/nParticles, \
+    'temp': lambda i0, i1: ICobj.T(r[i0:i1]), 'eps': 0.01, 'metals': 1.0}
+    star = {'mass': 1.0, 'metals': 1.0, 'eps': float(r.min())}
+    filename = 'benchmark.std'
+    
+    with timing.stage('tipsy_write'):
+        
+        tipsy_io.write(filename, n_gas=nParticles, n_star=1, gas=gas, \
+        star=star, time=1.0)
+    
+    os.remove(filename)
+
+def _bench_lookup(ICobj, rho, n, seed):
+    """
+    Times evaluating rho, drho/dr, and the inverse CDF of rho at n random
+    points
+    """
+    rand = np.random.RandomState(seed)
+    r_bins = ICobj.sigma.r_bins
+    zmax = float(ICobj.settings.rho_calc.zmax.in_units(r_bins.units))
+    r = rand.uniform(float(r_bins.min()), float(r_bins.max()), n)
+    z = rand.uniform(0, zmax, n)
+    m = rand.rand(n)
+    
+    with timing.stage('rho_lookup'):
+        
+        rho.rho(z, r)
+        rho.drho_dr(z, r)
+        rho.cdf_inv(m, r)
+
+def _rho(ICobj, nr, nz, method):
+    
+    settings = ICobj.settings
+    settings.rho_calc.nr = nr
+    settings.rho_calc.nz = nz
+    settings.rho_calc.method = method
+    
+    return calc_rho_zr.rho_zr(ICobj)
+
+def _make_IC(p):
+    """
+    Makes the IC object the benchmarks are run on, with sigma, rho, and
+    positions at the base parameters
+    """
+    ICobj = ICgen.IC(profile_kind=p['profile_kind'])
+    ICobj.settings.sigma.n_points = p['n_points']
+    ICobj.maker.sigma_gen()
+    rho_array, z, r = _rho(ICobj, p['nr'], p['nz'], p['rho_method'])
+    ICobj.add.rho({'rho': rho_array, 'z': z, 'r': r})
+    
+    return ICobj
+
+def _meta():
+    """
+    Info about the machine and code the benchmarks are run with
+    """
+    meta = {}
+    meta['benchmark_version'] = __version__
+    meta['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    meta['hostname'] = socket.gethostname()
+    meta['platform'] = platform.platform()
+    meta['machine'] = platform.machine()
+    meta['processor'] = platform.processor()
+    meta['cpu_count'] = multiprocessing.cpu_count()
+    meta['python'] = platform.python_version()
+    meta['numpy'] = np.__version__
+    meta['scipy'] = scipy.__version__
+    meta['pynbody'] = pynbody.__version__
+    meta['git_commit'] = None
+    
+    try:
+        
+        directory = os.path.dirname(os.path.abspath(__file__))
+        meta['git_commit'] = subprocess.check_output(['git', 'rev-parse', \
+        'HEAD'], cwd=directory, stderr=open(os.devnull, 'w')).strip()
+    
+    except (OSError, subprocess.CalledProcessError):
+        
+        pass
+    
+    return meta
+
+@contextmanager
+def _quiet(quiet=True):
+    """
+    Hides the printed output and warnings of the pipeline
+    """
+    if not quiet:
+        
+        yield
+        return
+    
+    stdout = sys.stdout
+    devnull = open(os.devnull, 'w')
+    
+    try:
+        
+        with warnings.catch_warnings():
+            
+            warnings.simplefilter('ignore')
+            sys.stdout = devnull
+            yield
+    
+    finally:
+        
+        sys.stdout = stdout
+        devnull.close()
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description='Scaling benchmarks of the'\
+    ' IC pipeline (see benchmark.py)')
+    parser.add_argument('--quick', action='store_true', \
+    help='run the small sweeps')
+    parser.add_argument('-o', '--output', default='benchmark.json', \
+    help='file to save the results to (default: benchmark.json)')
+    parser.add_argument('--compare', default=None, \
+    help='results file to compare to')
+    parser.add_argument('--plot', default=None, \
+    help='file to save the scaling curves to')
+    parser.add_argument('--only', nargs='+', choices=_order, default=None, \
+    help='only sweep these parameters')
+    parser.add_argument('--rho-method', default=defaults['rho_method'], \
+    help='rho_calc.method (default: {0})'.format(defaults['rho_method']))
+    parser.add_argument('--repeat', type=int, default=defaults['repeat'], \
+    help='runs of every case (default: {0})'.format(defaults['repeat']))
+    parser.add_argument('-v', '--verbose', action='store_true', \
+    help='show the output of the pipeline')
+    args = parser.parse_args()
+    
+    sweep = quick_sweeps if args.quick else sweeps
+    
+    if args.only is not None:
+        
+        sweep = dict((key, sweep[key]) for key in args.only)
+    
+    results = run(params={'rho_method': args.rho_method, \
+    'repeat': args.repeat}, sweep=sweep, verbose=args.verbose)
+    print_scaling(results)
+    save(results, args.output)
+    
+    if args.compare is not None:
+        
+        print ''
+        compare(results, load(args.compare))
+    
+    if args.plot is not None:
+        
+        plot(results, args.plot)
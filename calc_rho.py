@@ -15,15 +15,13 @@ import isaac
 import numpy as np
 import scipy
 import scipy.integrate as nInt
-import scipy.optimize as opt
+import scipy.linalg as linalg
 from scipy.interpolate import interp1d
-from scipy.optimize.nonlin import NoConvergence
 import pynbody
 from pynbody.array import SimArray
 from warnings import warn
-import sys
 
-def rho_z(sigma, T, r, settings):
+def rho_z(sigma, T, r, settings, guess=None):
     """ 
     rho,z = rho_z(...)
     
@@ -57,6 +55,11 @@ def rho_z(sigma, T, r, settings):
         satisfy the diff. eq. for rho very well.  But doing it this way 
         allows rho to satisfy the surface density profile
     
+    The roots in steps 3 and 5 are found with newton's method, using the
+    analytic jacobians of the finite difference equations.  These are banded
+    (for step 5 the integral of rho is solved for alongside rho), so each
+    newton step is a cheap banded solve.
+    
     * Arguments *
     
     sigma - The surface density at r
@@ -66,6 +69,12 @@ def rho_z(sigma, T, r, settings):
     r - The radius at which rho is being calculated.  Should have units
     
     settings - ICobj settings (ie, ICobj.settings)
+    
+    guess - (optional) An initial guess for rho(z), given as (rho, z).  If
+    supplied, steps 1-4 are skipped and the guess (interpolated onto the z
+    grid and normalized to integrate to sigma/2) is used as the starting
+    point for step 5.  If that does not converge, rho is calculated from
+    scratch.  See rho_z_continuation
         
     * Output *
     Returns a 1D SimArray (see pynbody) of rho(z) and a 1D SimArray of z,
@@ -95,6 +104,11 @@ def rho_z(sigma, T, r, settings):
     b = (2*np.pi*G*m/(kB*T)).in_units(length_unit/mass_unit)
     z0guess = np.sqrt(2*r*r*r/a).in_units(length_unit)# Est. scale height of disk
     z0_dummy = (2/(b*sigma)).in_units(length_unit)
+    zmax = _zmax(z0guess, settings)
+    
+    if np.ndim(zmax) > 0:
+        
+        zmax = SimArray(float(zmax[0]), zmax.units)
 
     z = np.linspace(0.0,zmax,nz)
     dz = z[[1]]-z[[0]]
@@ -152,156 +166,814 @@ def rho_z(sigma, T, r, settings):
         
         return rho0, z  
         
-    # -------------------------------------------------------------------
-    # FUNCTION DEFINITIONS
-    # -------------------------------------------------------------------
-    def dI_dz(I_in):
-        """
-        Finite difference approximation of dI/dz, assuming I is odd around I(0)
-        """
-        I = I_in.copy()
-        dI = np.zeros(len(I))
-        # Fourth order center differencing
-        dI[0] = (-I[2] + 8*I[1] - 7*I[0])/(6*dz)
-        dI[1] = (-I[3] + 8*I[2] - 6*I[0] - I[1])/(12*dz)
-        dI[2:-2] = (-I[4:] + 8*I[3:-1] -8*I[1:-3] + I[0:-4])/(12*dz)
-        # Second order backward differencing for right edge
-        dI[-2:] = (3*I[-2:] -4*I[-3:-1] + I[-4:-2])/(2*dz)
-        
-        return dI
-        
-    def d2I_dz2(I_in):
-        
-        # Finite difference for d2I/dz2 assuming it is 0 at the origin
-        I = I_in.copy()
-        d2I = np.zeros(len(I))
-        # Boundary condition
-        d2I[0] = 0
-        # Centered 4th order finite difference
-        d2I[1] = (-I[3] + 16*I[2] - 30*I[1] + 16*I[0] -(2*I[0] - I[1]))/(12*dz**2)
-        d2I[2:-2] = (-I[4:] + 16*I[3:-1] - 30*I[2:-2] + 16*I[1:-3] - I[0:-4])/(12*(dz**2))
-        # second order backward difference for right edge
-        d2I[-2:] = (-2*I[-2:] + 5*I[-3:-1] -4*I[-4:-2] + I[-5:-3])/dz**2
-        
-        return d2I
-        
-    def Ires(I_in):
-        """
-        Calculate the residual for the differential equation governing I,
-        the integral of rho from z to "infinity."
-        """
-        # DEFINE INITIAL CONDITION:
-        I = I_in.copy()
-        I[0] = rho_int
-        #I[-1] = 0.0
-        weight = 1.0
-
-        res = d2I_dz2(I) + dI_dz(I)*(a*z/((z**2 + r**2)**(1.5)) + 2*b*(I[0] - I))
-        
-        return weight*res
-        
-    def drho_dz(rho_in):
-        """
-        Fourth order, centered finite difference for d(rho)/dz, assumes that
-        rho is an even function.  The right-hand boundary is done using
-        backward differencing
-        """
-        rho = rho_in.copy()
-        drho = np.zeros(len(rho))
-        drho[0] = 0.0   # defined by boundary condition, rho[0] = max(rho)
-        drho[1] = (-rho[3] + 8*rho[2] - 8*rho[0] + rho[1])/(12*dz)
-        drho[2:-2] = (-rho[4:] + 8*rho[3:-1] - 8*rho[1:-3] + rho[0:-4])/(12*dz)
-        drho[-2:] = (3*rho[-2:] - 4*rho[-3:-1] + rho[-4:-2])/(2*dz)
-        
-        return drho
-        
-    def residual(rho_in):
-        """
-        Estimate d(rho)/dz
-        """
-        rho = rho_in.copy()
-        # Estimate integral of rho
-        I = np.zeros(len(rho))
-        I[1:] = nInt.cumtrapz(rho,z)
-        # Estimate residual 
-        res = drho_dz(rho) + a*rho*z/((z**2 + r**2)**(1.5)) + 2*b*rho*I
-        
-        return res
+    if guess is not None:
         
-    def erf_res(scale_size):
+        rho_guess, z_guess = guess
         
-        testfct = rho_int*(1 - scipy.special.erf(z/scale_size))
+        if pynbody.units.has_units(rho_guess):
+            
+            rho_guess = rho_guess.in_units(mass_unit/length_unit**3)
+            
+        z_guess = isaac.match_units(z_guess, length_unit)[0]
+        guess = np.interp(z, np.asarray(z_guess), np.asarray(rho_guess), \
+        right=0.0)
+        norm = nInt.trapz(guess, z)
         
-        return abs(Ires(testfct)).sum()
+        if (norm > 0) and np.isfinite(norm):
+            
+            guess = (guess*rho_int/norm).reshape([1, nz])
+            
+        else:
+            
+            guess = None
         
-
-    pass
     # -------------------------------------------------------------------
     # FIND RHO
     # -------------------------------------------------------------------
+    # Steps 1-7 are done by _solve_columns, which treats this radius as a
+    # stack of one column.  The newton iterations use the analytic (banded)
+    # jacobians of the residuals
+    rho0, n_iter, unconverged, n_newton = _solve_columns(*[np.reshape(x, [1, 1]) \
+    for x in (rho_int, a, b, r, z0guess)], z=z, dz=float(dz), rho_tol=rho_tol, \
+    guess=guess)
+    rho0 = rho0[0]
+    print 'Rescaling iterations: {0}'.format(n_iter)
+    print 'Newton iterations: {0}'.format(n_newton[0])
+        
+    if unconverged[0]:
+        
+        print 'Warning: solution to rho did not converge for r = {0}'.format(r)
+    
+    # Re-introduce units
+    rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
+    z = isaac.set_units(z, length_unit)
+    
+    return SimArray(rho0,'Msol au**-3'), SimArray(z,'au')
+    
+
+def rho_z_continuation(sigma, T, r, settings):
+    """
+    rho,z = rho_z_continuation(...)
+    
+    Calculates rho(z) at the radii r (which should be sorted) one at a time
+    with rho_z, warm starting each radius from the solution at the previous
+    one.  The previous solution is stretched in z by the ratio of the scale
+    heights, h ~ sqrt(T r^3), and renormalized to the new surface density.
+    rho_z falls back to a cold start if the warm start does not converge.
+    
+    * Arguments *
+    
+    sigma, T - The surface density and temperature at r
+    
+    r - The radii at which rho is being calculated.  Should have units
+    
+    settings - ICobj settings (ie, ICobj.settings)
+    
+    * Output *
+    Returns a 2D SimArray of rho, with shape (nz, len(r)), and a SimArray of
+    z.  z is 1D, unless settings.rho_calc.zmax_scale is set, in which case
+    it is 2D with the same shape as rho (see rho_z)
+    """
+    nr = len(r)
+    rho = None
+    z_all = None
+    guess = None
+    
+    for i in range(nr):
+        
+        rho_vector, z = rho_z(sigma[[i]], T[[i]], r[[i]], settings, guess)
+        
+        if rho is None:
+            
+            rho = SimArray(np.zeros([len(z), nr]), rho_vector.units)
+            z_all = SimArray(np.zeros([len(z), nr]), z.units)
+            
+        rho[:,i] = rho_vector
+        z_all[:,i] = z
+        guess = None
+        
+        if np.any(rho_vector > 0) and (i < nr - 1):
+            # Stretch by the ratio of the scale heights
+            h_ratio = np.sqrt(float(T[i+1]/T[i]) * float(r[i+1]/r[i])**3)
+            guess = (rho_vector, z*h_ratio)
+            
+    if settings.rho_calc.zmax_scale is None:
+        # All radii share the same z grid
+        z_all = z
+        
+    return rho, z_all
+    
+def rho_z_batch(sigma, T, r, settings):
+    """
+    rho,z = rho_z_batch(...)
+    
+    Batched version of rho_z.  Calculates rho(z) at all the radii r at once
+    by stacking the vertical profiles into one (nr x nz) system which is
+    iterated as a whole, using the same (vectorized) residuals as rho_z.
+    This runs on a single process and avoids the per-radius python overhead
+    of rho_z.
+    
+    The numerical steps are the same as for rho_z (see rho_z):
+    1) The length scale of the error function guess for I is found for all
+        radii at once with a vectorized golden section search
+    2) I is solved for at all radii at once with a vectorized newton's
+        method (see _newton_banded)
+    3) rho = -dI/dz is iterated (newton's method + rescaling) until every
+        radius has been rescaled by a factor closer to unity than rho_tol.
+        Radii which have converged are dropped from later iterations.
+        
+    Residuals are normalized at each radius (by I(0) and max(rho)) so that
+    the tolerances per radius are the same as in rho_z
+    
+    * Arguments *
+    
+    sigma - The surface density at r (1D SimArray)
+    
+    T - the temperature at r (1D SimArray)
+    
+    r - The radii at which rho is being calculated (1D SimArray)
+    
+    settings - ICobj settings (ie, ICobj.settings)
+    
+    * Output *
+    Returns a 2D SimArray of rho(z,r) with shape (nz, nr) and a 1D SimArray
+    of z, with the same units as ICobj.settings.rho_calc.zmax
+    """
+    rho_tol = settings.rho_calc.rho_tol
+    nz = settings.rho_calc.nz
+    zmax = settings.rho_calc.zmax
+    nr = len(r)
+    
+    print '***********************************************'
+    print '* Calculating rho(z) at {0} radii (batched)'.format(nr)
+    print '***********************************************'
+    print 'r              = {0} to {1} {2}'.format(r.min(), r.max(), r.units)
+    print 'zmax           = {0} {1}'.format(zmax,zmax.units)
+    print 'rho_tol        = {0}'.format(rho_tol)
+    print 'nz             = {0}'.format(nz)
+    print '***********************************************'
+    
+    rho_int, a, b, z0guess, r, z, dz, use, units = \
+    _column_params(sigma, T, r, settings)
+    mass_unit, length_unit = units
+    
+    rho0 = np.zeros([nr, nz])
+        
+    if np.any(use):
+        
+        ind = np.where(use)[0]
+        rho0[ind], n_iter, unconverged, n_newton = _solve_columns(rho_int[ind],\
+        a[ind], b[ind], r[ind], z0guess[ind], _take_columns(z, ind), \
+        _take_columns(dz, ind), rho_tol)
+        print 'Rescaling iterations: {0}'.format(n_iter)
+        print 'Newton iterations per radius: {0} to {1} (mean {2:.1f})'\
+        .format(n_newton.min(), n_newton.max(), n_newton.mean())
+        
+        if np.any(unconverged):
+            
+            print 'Warning: solution to rho did not converge for r = {0}'\
+            .format(r[ind][unconverged, 0])
+    
+    # Re-introduce units
+    rho0 = isaac.set_units(rho0.T, mass_unit/length_unit**3)
+    z = isaac.set_units(z.T, length_unit)
+    
+    return rho0, z
+    
+def _zmax(z0guess, settings):
+    """
+    Returns the maximum z to calculate rho at.  This is
+    settings.rho_calc.zmax, unless settings.rho_calc.zmax_scale is set, in
+    which case zmax is zmax_scale times the scale height z0guess at every
+    radius (where z0guess is unusable, eg at r = 0, settings.rho_calc.zmax is
+    used)
+    """
+    zmax = settings.rho_calc.zmax
+    zmax_scale = settings.rho_calc.zmax_scale
+    
+    if zmax_scale is None:
+        
+        return zmax
+    
+    zmax_r = (zmax_scale*z0guess).in_units(zmax.units)
+    bad = ~np.isfinite(zmax_r) | (zmax_r <= 0)
+    zmax_r[bad] = zmax
+    
+    return zmax_r
+    
+def _column_params(sigma, T, r, settings):
+    """
+    Calculates the (unitless) parameters of the differential equations for
+    rho(z) at the radii r, as used by rho_z_batch.
+    
+    Returns rho_int, a, b, z0guess, r (each with shape (nr, 1)), z, dz, a
+    boolean array which is False at the radii where rho is just set to zero
+    (see rho_z) and the units (mass_unit, length_unit) of the parameters.
+    If settings.rho_calc.zmax_scale is set, every radius has its own z grid
+    and z, dz have shape (nr, nz), (nr, 1).  Otherwise z is 1D and dz is a
+    float
+    """
+    nz = settings.rho_calc.nz
+    zmax = settings.rho_calc.zmax
+    m = settings.physical.m
+    M = settings.physical.M
+    
+    # Physical constants
+    kB = SimArray(1.0,'k')
+    G = SimArray(1.0,'G')
+    
+    # Set up default units
+    mass_unit = M.units
+    length_unit = zmax.units
+    r = (r.in_units(length_unit)).copy()
+    nr = len(r)
     
-    maxiter = 40
+    # Initial conditions/physical parameters
+    rho_int = 0.5*sigma.in_units(mass_unit/length_unit**2)
+    a = (G*M*m/(kB*T)).in_units(length_unit)
+    b = (2*np.pi*G*m/(kB*T)).in_units(length_unit/mass_unit)
+    z0guess = np.sqrt(2*r*r*r/a).in_units(length_unit)
+    zmax = _zmax(z0guess, settings)
     
-    # Estimate the scale length of the error function
-    z0 = opt.fminbound(erf_res,z0guess/100.0,5.0*z0guess)
-    print 'Length scale guess: {0} {1}'.format(z0guess, length_unit)
-    print 'Final length scale: {0} {1}'.format(z0, length_unit)
+    if np.ndim(zmax) > 0:
+        # A z grid for every radius
+        zmax = np.asarray(zmax).reshape([nr, 1])
+        z = zmax * np.linspace(0.0, 1.0, nz)
+        dz = z[:,[1]] - z[:,[0]]
+        
+    else:
+        
+        z = np.asarray(np.linspace(0.0,zmax,nz))
+        dz = float(z[1] - z[0])
+    
+    # Strip units and make all the per-radius parameters column vectors
+    rho_int, a, b, z0guess, r, T = [np.asarray(x, dtype=float).reshape([nr, 1]) \
+    for x in (rho_int, a, b, z0guess, r, T)]
+    
+    use = (rho_int[:,0] >= 0.5e-100) & (T[:,0] <= 1e100)
+    
+    if np.any(~use):
+        
+        warn('Sigma too small or temperature too large at {0} radii.  Setting'\
+        ' rho = 0 there'.format((~use).sum()))
+        
+    return rho_int, a, b, z0guess, r, z, dz, use, (mass_unit, length_unit)
+    
+def _solve_columns(rho_int, a, b, r, z0guess, z, dz, rho_tol, maxiter=40, \
+guess=None):
+    """
+    Solves for rho(z) for a stack of columns at once (see rho_z_batch).  All
+    inputs should be unitless.  rho_int, a, b, r, z0guess should have shape
+    (ncol, 1).  z should have shape (nz,) or (ncol, nz) and dz should be a
+    float or have shape (ncol, 1)
+    
+    guess is an optional initial guess for rho (shape (ncol, nz)), eg the
+    solution at a neighboring radius (see rho_z_continuation).  The error
+    function guess and the solution for I (steps 1-4 of rho_z) are then
+    skipped.  Columns for which the warm start does not converge are solved
+    again from scratch.
+    
+    Returns rho (shape (ncol, nz)), the number of rescaling iterations, a
+    boolean array flagging the columns which did not converge and the total
+    number of newton iterations used for every column
+    """
+    ncol = rho_int.shape[0]
+    
+    if guess is not None:
+        
+        rho0, n_rescale, active, n_newton, newton_ok = _rescale_columns(\
+        np.array(guess, dtype=float), rho_int, a, b, r, z, dz, rho_tol, maxiter)
+        failed = active | ~newton_ok
+        
+        if np.any(failed):
+            
+            print 'Warm start failed for {0} of {1} columns.  Starting them '\
+            'from scratch'.format(failed.sum(), ncol)
+            ind = np.where(failed)[0]
+            rho_cold, n_cold, active_cold, n_newton_cold = _solve_columns(\
+            *[_take_columns(p, ind) for p in (rho_int, a, b, r, z0guess, z, dz)],\
+            rho_tol=rho_tol, maxiter=maxiter)
+            rho0[ind] = rho_cold
+            active[ind] = active_cold
+            n_newton[ind] += n_newton_cold
+            n_rescale = max(n_rescale, n_cold)
+            
+        return rho0, n_rescale, active, n_newton
+    
+    # Estimate the scale length of the error function for all columns
+    def erf_res(scale_size):
+        
+        return _erf_res(scale_size, rho_int, a, b, r, z, dz)
+        
+    z0 = _golden_min(erf_res, z0guess/100.0, 5.0*z0guess)
     
     # Begin by finding I, the integral of rho (from z to inf)
     # Assuming rho is gaussian, I is an error function
     guess = rho_int*(1 - scipy.special.erf(z/z0))
     
-    # Find the root of the differential equation for I
-    f_tol = rho_int * 6e-6
-    try:
+    # Find the root of the differential equation for I.  I(0) = rho_int is
+    # fixed, so the unknowns are I[1:]
+    def params(ind):
+        
+        return [_take_columns(p, ind) for p in (rho_int, a, b, r, z, dz)]
+    
+    def Ires(x, ind):
+        
+        rho_int_i, a_i, b_i, r_i, z_i, dz_i = params(ind)
+        I = np.concatenate((rho_int_i, x), -1)
+        res = _Ires(I, rho_int_i, a_i, b_i, r_i, z_i, dz_i)/rho_int_i
         
-        Isol = opt.newton_krylov(Ires,guess,maxiter=maxiter,f_tol=f_tol)
+        return res[:,1:]
         
-    except NoConvergence:
-        # Assume it didn't converge because f_tol was too strict
-        # Read exception
-        xepshun = sys.exc_info()
-        # Extract rho from the exception
-        Isol = xepshun[1][0]
+    def Ires_jac(x, ind):
+        
+        rho_int_i = rho_int[ind]
+        I = np.concatenate((rho_int_i, x), -1)
+        
+        return _Ires_jac(I, *params(ind))
+        
+    x, n_newton = _newton_banded(Ires, Ires_jac, guess[:,1:], _Ires_bands, \
+    6e-6, maxiter)[0:2]
+    Isol = np.concatenate((rho_int, x), -1)
         
     # rho is the negative derivative
-    rho0 = -dI_dz(Isol)
+    rho0 = -_dI_dz(Isol, dz)
     
     # Now apply the diff eq on rho
-    for n in range(maxiter):
+    rho0, n_rescale, active, n_iter = _rescale_columns(rho0, rho_int, a, b, \
+    r, z, dz, rho_tol, maxiter)[0:4]
+    
+    return rho0, n_rescale, active, n_newton + n_iter
+    
+def _rescale_columns(rho0, rho_int, a, b, r, z, dz, rho_tol, maxiter=40):
+    """
+    Steps 5-7 of rho_z for a stack of columns (see _solve_columns).  rho0 is
+    the initial estimate of rho.  Only the unconverged columns are iterated.
+    
+    Returns rho, the number of rescaling iterations, a boolean array flagging
+    the columns which did not converge, the number of newton iterations for
+    every column and a boolean array which is False for the columns where
+    the last newton solve did not converge
+    """
+    ncol = rho0.shape[0]
+    active = np.ones(ncol, dtype=bool)
+    newton_ok = np.ones(ncol, dtype=bool)
+    n_newton = np.zeros(ncol, dtype=int)
+    n_rescale = 0
+    
+    while np.any(active) and (n_rescale < maxiter):
+        
+        ind = np.where(active)[0]
+        rho_i = rho0[ind]
+        z_i = _take_columns(z, ind)
+        rho_i, n_iter, newton_ok[ind] = _solve_rho_columns(rho_i, \
+        *[_take_columns(p, ind) for p in (a, b, r, z, dz)], maxiter=maxiter)
+        n_newton[ind] += n_iter
+        rho_scale = rho_int[ind]/nInt.trapz(rho_i, z_i, axis=-1)[:,None]
+        rho0[ind] = rho_i*rho_scale
+        active[ind[abs(1 - rho_scale[:,0]) < rho_tol - 1]] = False
+        n_rescale += 1
+        
+    return rho0, n_rescale, active, n_newton, newton_ok
+    
+def _solve_rho_columns(rho, a, b, r, z, dz, f_tol=6e-6, maxiter=40):
+    """
+    Solves the differential equation for rho (see _residual) for a stack of
+    columns, holding rho(0) fixed.  The current estimate, rho, is used as the
+    initial guess.
+    
+    The cumulative integral of rho makes the residual of rho alone dense, so
+    the unknowns are rho[1:] and its integral I[1:] (I(0) = 0), interleaved as
+    [rho1, I1, rho2, I2, ...].  The system is then banded (see
+    _residual_aug).  As for rho_z, the residuals are normalized by max(rho)
+    
+    Returns rho, the number of newton iterations for every column and a
+    boolean array which is True for the columns which converged
+    """
+    rho0 = rho[:,0:1]
+    scale = rho.max(-1)[:,None]
+    I = nInt.cumtrapz(rho, z, axis=-1)
+    x = _interleave(rho[:,1:], I)
+    
+    def residual(x, ind):
+        
+        a_i, b_i, r_i, z_i, dz_i = [_take_columns(p, ind) for p in \
+        (a, b, r, z, dz)]
+        
+        return _residual_aug(x, rho0[ind], a_i, b_i, r_i, z_i, dz_i)/scale[ind]
+        
+    def jac(x, ind):
+        
+        a_i, b_i, r_i, z_i, dz_i = [_take_columns(p, ind) for p in \
+        (a, b, r, z, dz)]
+        
+        return _residual_aug_jac(x, rho0[ind], a_i, b_i, r_i, z_i, dz_i)\
+        /scale[ind][...,None]
+        
+    x, n_iter, converged = _newton_banded(residual, jac, x, \
+    _residual_aug_bands, f_tol, maxiter)
+    rho = np.concatenate((rho0, x[:,0::2]), -1)
+    
+    return rho, n_iter, converged
+    
+def _take_columns(x, ind):
+    """
+    Selects the columns ind from a per-column array (ie one with 2 dimensions).
+    Anything else (floats, 1D arrays shared by all columns) is returned as is
+    """
+    if np.ndim(x) == 2:
+        
+        return x[ind]
+        
+    return x
+    
+def _interleave(x, y):
+    """
+    Interleaves the last axis of x and y, ie returns [x0, y0, x1, y1, ...]
+    """
+    out = np.zeros(x.shape[0:-1] + (2*x.shape[-1],))
+    out[...,0::2] = x
+    out[...,1::2] = y
+    
+    return out
+    
+def _newton_banded(F, jac, x0, bands, f_tol, maxiter=40, max_backtrack=10):
+    """
+    Vectorized Newton's method for a stack of independent systems of
+    equations with banded jacobians.  Each row of x0 is the initial guess for
+    one system.
+    
+    F(x, ind) should return the residuals for the rows ind of the stack, given
+    x (the current estimate for those rows).  jac(x, ind) should return the
+    jacobians of those rows in the banded storage of scipy.linalg.solve_banded
+    (shape (len(ind), l+u+1, n)), where bands = (l, u) are the number of sub-
+    and super-diagonals of the jacobian.
+    
+    The newton steps for all the systems are found with one banded solve.
+    Every system gets its own (backtracking) step length and drops out of
+    the iteration once max(abs(F)) < f_tol.  Systems for which no step
+    reduces the residual stop iterating.
+    
+    Returns x, the number of iterations used for every system and a boolean
+    array which is True for the systems which converged
+    """
+    x = np.array(x0, dtype=float)
+    ncol = x.shape[0]
+    ind = np.arange(ncol)
+    res = F(x, ind)
+    err = abs(res).max(-1)
+    n_iter = np.zeros(ncol, dtype=int)
+    active = (err >= f_tol)
+    
+    for i in range(maxiter):
+        
+        ind = np.where(active)[0]
+        
+        if len(ind) == 0:
+            
+            break
+        
+        x_i = x[ind]
+        res_i = res[ind]
+        dx = _solve_banded_stack(bands, jac(x_i, ind), -res_i)
+        n_iter[ind] += 1
+        
+        # Backtrack (per system) until the residual decreases
+        norm = (res_i**2).sum(-1)
+        step = np.ones(len(ind))
+        pending = np.arange(len(ind))
+        
+        for j in range(max_backtrack):
+            
+            x_try = x_i[pending] + step[pending,None]*dx[pending]
+            res_try = F(x_try, ind[pending])
+            norm_try = (res_try**2).sum(-1)
+            better = np.isfinite(norm_try) & (norm_try < norm[pending])
+            accepted = pending[better]
+            x_i[accepted] = x_try[better]
+            res_i[accepted] = res_try[better]
+            pending = pending[~better]
+            step[pending] *= 0.5
+            
+            if len(pending) == 0:
+                
+                break
+            
+        x[ind] = x_i
+        res[ind] = res_i
+        err[ind] = abs(res_i).max(-1)
+        active[ind] = (err[ind] >= f_tol)
+        # Stop iterating systems which could not be improved
+        active[ind[pending]] = False
+        
+    return x, n_iter, (err < f_tol)
+    
+def _solve_banded_stack(bands, jac, rhs):
+    """
+    Solves the stacked, independent banded systems jac * x = rhs with one call
+    to scipy.linalg.solve_banded.  jac should be in banded storage with shape
+    (nsys, l+u+1, n) (see _to_banded) and rhs should have shape
+    (nsys, n).  Stacking the systems along the diagonal keeps the same band
+    structure.
+    """
+    l, u = bands
+    nsys, nb, n = jac.shape
+    jac = jac.copy()
+    # Make sure there is no coupling between neighboring systems
+    for k in range(u):
+        
+        jac[:, k, 0:u-k] = 0
+        
+    for k in range(l):
+        
+        jac[:, u+1+k, n-1-k:] = 0
+        
+    ab = jac.transpose(1, 0, 2).reshape([nb, nsys*n])
+    
+    try:
+        
+        x = linalg.solve_banded((l, u), ab, rhs.ravel())
+        
+    except np.linalg.LinAlgError:
+        # The differential equation for I only has a boundary condition at
+        # z = 0, so its jacobian can be numerically singular.  Solve the
+        # systems one at a time, regularizing the singular ones
+        x = np.zeros([nsys, n])
+        
+        for i in range(nsys):
+            
+            x[i] = _solve_banded_shifted((l, u), jac[i], rhs[i])
+        
+    return x.reshape([nsys, n])
+    
+def _solve_banded_shifted(bands, ab, rhs, shifts=(0, 1e-12, 1e-10, 1e-8)):
+    """
+    Solves one banded system (see scipy.linalg.solve_banded).  If the matrix
+    is singular, its diagonal is shifted away from zero by an increasing
+    fraction (shifts) of the largest element until the system can be solved
+    """
+    u = bands[1]
+    sign = np.where(ab[u] < 0, -1.0, 1.0)
+    scale = abs(ab).max()
+    
+    for shift in shifts:
+        
+        ab_shift = ab.copy()
+        ab_shift[u] += shift*scale*sign
         
-        print 'Iteration {0}'.format(n+1)
-        f_tol = rho0.max() * 6e-6
         try:
             
-            rho0 = opt.newton_krylov(residual,rho0,maxiter=maxiter, f_tol=f_tol)
+            return linalg.solve_banded(bands, ab_shift, rhs)
             
-        except:
-            # Assume it didn't converge because f_tol was too strict
-            # Read exception
-            xepshun = sys.exc_info()
-            # Extract rho from the exception
-            rho0 = xepshun[1][0]
+        except np.linalg.LinAlgError:
             
-        rho_scale = rho_int/nInt.cumtrapz(rho0,z)[-1]
-        print 'Scaling rho by {0}'.format(rho_scale)
-        rho0 = rho0*rho_scale
+            pass
+        
+    raise np.linalg.LinAlgError, 'singular matrix'
+    
+def _golden_min(f, lo, hi, xtol=1e-5, maxiter=500):
+    """
+    Vectorized golden section search.  Minimizes f(x) independently for every
+    element of x in the brackets (lo, hi).  f should take an array of x (the
+    same shape as lo) and return an array of function values, one for every
+    element of x.  The search stops when all the brackets are narrower than
+    xtol (the same default absolute tolerance as scipy.optimize.fminbound)
+    """
+    gr = (np.sqrt(5.0) - 1)/2
+    lo = np.array(lo, dtype=float)
+    hi = np.array(hi, dtype=float)
+    shape = lo.shape
+    x1 = hi - gr*(hi - lo)
+    x2 = lo + gr*(hi - lo)
+    f1 = np.reshape(f(x1), shape)
+    f2 = np.reshape(f(x2), shape)
+    
+    for i in range(maxiter):
         
-        if abs(1-rho_scale) < rho_tol - 1:
+        if np.all((hi - lo) < xtol):
             
             break
         
-    if n >= maxiter:
+        # Where f1 < f2 the minimum is in (lo, x2), otherwise in (x1, hi)
+        left = f1 < f2
+        hi = np.where(left, x2, hi)
+        lo = np.where(left, lo, x1)
+        x_new = np.where(left, hi - gr*(hi - lo), lo + gr*(hi - lo))
+        f_new = np.reshape(f(x_new), shape)
+        x1, x2 = np.where(left, x_new, x2), np.where(left, x1, x_new)
+        f1, f2 = np.where(left, f_new, f2), np.where(left, f1, f_new)
         
-        print 'Warning: solution to rho did not converge for r = {0}'.format(r)
+    return 0.5*(lo + hi)
     
-    # Re-introduce units
-    rho0 = isaac.set_units(rho0, mass_unit/length_unit**3)
-    z = isaac.set_units(z, length_unit)
+# -------------------------------------------------------------------
+# FINITE DIFFERENCES AND RESIDUALS
+# These operate along the last axis, so they work on a single rho(z) (1D) or
+# on a stack of columns (2D, one row per radius).  For stacked columns, the
+# parameters (rho_int, a, b, r, dz) should have shape (ncol, 1) and z should
+# have shape (nz,) or (ncol, nz)
+# -------------------------------------------------------------------
+def _dI_dz(I, dz):
+    """
+    Finite difference approximation of dI/dz, assuming I is odd around I(0)
+    """
+    dI = np.zeros(I.shape)
+    # Fourth order center differencing
+    dI[...,0:1] = (-I[...,2:3] + 8*I[...,1:2] - 7*I[...,0:1])/(6*dz)
+    dI[...,1:2] = (-I[...,3:4] + 8*I[...,2:3] - 6*I[...,0:1] - I[...,1:2])/(12*dz)
+    dI[...,2:-2] = (-I[...,4:] + 8*I[...,3:-1] -8*I[...,1:-3] + I[...,0:-4])/(12*dz)
+    # Second order backward differencing for right edge
+    dI[...,-2:] = (3*I[...,-2:] -4*I[...,-3:-1] + I[...,-4:-2])/(2*dz)
     
-    return SimArray(rho0,'Msol au**-3'), SimArray(z,'au')
+    return dI
+    
+def _d2I_dz2(I, dz):
+    """
+    Finite difference for d2I/dz2 assuming it is 0 at the origin
+    """
+    d2I = np.zeros(I.shape)
+    # Boundary condition: d2I[0] = 0
+    # Centered 4th order finite difference
+    d2I[...,1:2] = (-I[...,3:4] + 16*I[...,2:3] - 30*I[...,1:2] + 16*I[...,0:1] \
+    -(2*I[...,0:1] - I[...,1:2]))/(12*dz**2)
+    d2I[...,2:-2] = (-I[...,4:] + 16*I[...,3:-1] - 30*I[...,2:-2] \
+    + 16*I[...,1:-3] - I[...,0:-4])/(12*(dz**2))
+    # second order backward difference for right edge
+    d2I[...,-2:] = (-2*I[...,-2:] + 5*I[...,-3:-1] -4*I[...,-4:-2] \
+    + I[...,-5:-3])/dz**2
+    
+    return d2I
+    
+def _drho_dz(rho, dz):
+    """
+    Fourth order, centered finite difference for d(rho)/dz, assumes that
+    rho is an even function.  The right-hand boundary is done using
+    backward differencing
+    """
+    drho = np.zeros(rho.shape)
+    # drho[0] = 0 is defined by boundary condition, rho[0] = max(rho)
+    drho[...,1:2] = (-rho[...,3:4] + 8*rho[...,2:3] - 8*rho[...,0:1] \
+    + rho[...,1:2])/(12*dz)
+    drho[...,2:-2] = (-rho[...,4:] + 8*rho[...,3:-1] - 8*rho[...,1:-3] \
+    + rho[...,0:-4])/(12*dz)
+    drho[...,-2:] = (3*rho[...,-2:] - 4*rho[...,-3:-1] + rho[...,-4:-2])/(2*dz)
+    
+    return drho
+    
+def _Ires(I_in, rho_int, a, b, r, z, dz):
+    """
+    Calculate the residual for the differential equation governing I,
+    the integral of rho from z to "infinity."
+    """
+    # DEFINE INITIAL CONDITION:
+    I = I_in.copy()
+    I[...,0:1] = rho_int
+    
+    res = _d2I_dz2(I, dz) + _dI_dz(I, dz)*(a*z/((z**2 + r**2)**(1.5)) \
+    + 2*b*(I[...,0:1] - I))
+    
+    return res
+    
+def _residual(rho, a, b, r, z, dz):
+    """
+    Residual of the differential equation for rho, ie d(rho)/dz + ...
+    """
+    # Estimate integral of rho
+    I = np.zeros(rho.shape)
+    I[...,1:] = nInt.cumtrapz(rho, z, axis=-1)
+    # Estimate residual 
+    res = _drho_dz(rho, dz) + a*rho*z/((z**2 + r**2)**(1.5)) + 2*b*rho*I
+    
+    return res
+    
+def _residual_aug(x, rho0, a, b, r, z, dz):
+    """
+    Residual of the differential equation for rho written in terms of rho and
+    its (cumulative) integral I.  x contains [rho1, I1, rho2, I2, ...] and
+    rho0 = rho(0) is held fixed (I(0) = 0).
+    
+    Returns the residuals interleaved as [E1, R1, E2, R2, ...], where R is
+    the residual for rho (see _residual) and E is the residual of the
+    trapezoidal integral of rho, divided by dz.  This makes the jacobian
+    banded (see _residual_aug_bands)
+    """
+    rho = np.concatenate((rho0, x[...,0::2]), -1)
+    I = np.concatenate((np.zeros(rho0.shape), x[...,1::2]), -1)
+    # Residual of I_k = I_{k-1} + (rho_{k-1} + rho_k) * (z_k - z_{k-1}) / 2
+    dI = np.diff(I, axis=-1)
+    E = (dI - 0.5*(rho[...,1:] + rho[...,0:-1])*np.diff(z, axis=-1))/dz
+    R = _drho_dz(rho, dz) + a*rho*z/((z**2 + r**2)**(1.5)) + 2*b*rho*I
+    
+    return _interleave(E, R[...,1:])
+    
+# Number of (sub, super) diagonals of the jacobians for _Ires (for the
+# unknowns I[1:]) and for _residual_aug
+_Ires_bands = (3, 2)
+_residual_aug_bands = (5, 3)
+    
+def _stencils(n):
+    """
+    Coefficients of the finite differences used by _dI_dz, _d2I_dz2 and
+    _drho_dz, in units of 1/dz (1/dz**2 for _d2I_dz2).  Row k holds the
+    coefficients of the points k-3 to k+2.
+    
+    Returns dI, d2I, drho, each with shape (n, 6)
+    """
+    dI = np.zeros([n, 6])
+    d2I = np.zeros([n, 6])
+    drho = np.zeros([n, 6])
+    # Interior, fourth order centered differences (offsets -2 to 2)
+    dI[2:-2, 1:] = np.array([1., -8., 0., 8., -1.])/12
+    d2I[2:-2, 1:] = np.array([-1., 16., -30., 16., -1.])/12
+    drho[2:-2] = dI[2:-2]
+    # Boundary at z = 0 (see _dI_dz etc)
+    dI[0, 3:] = np.array([-7., 8., -1.])/6
+    dI[1, 2:] = np.array([-6., -1., 8., -1.])/12
+    d2I[1, 2:] = np.array([14., -29., 16., -1.])/12
+    drho[1, 2:] = np.array([-8., 1., 8., -1.])/12
+    # Backward differences at the right edge
+    dI[-2:, 1:4] = np.array([0.5, -2., 1.5])
+    d2I[-2:, 0:4] = np.array([1., -4., 5., -2.])
+    drho[-2:] = dI[-2:]
+    
+    return dI, d2I, drho
+    
+def _to_banded(coefs, l, u):
+    """
+    Converts the coefficients of a banded matrix stored by row (coefs[...,i,k]
+    is the element (i, i+k-l), shape (..., n, l+u+1)) to the banded storage
+    used by scipy.linalg.solve_banded (shape (..., l+u+1, n)).  Elements
+    which fall outside of the matrix are dropped
+    """
+    n = coefs.shape[-2]
+    ab = np.zeros(coefs.shape[0:-2] + (l + u + 1, n))
+    
+    for offset in range(-l, u+1):
+        
+        i0 = max(-offset, 0)
+        i1 = n - max(offset, 0)
+        ab[..., u - offset, i0+offset:i1+offset] = coefs[..., i0:i1, offset+l]
+        
+    return ab
+    
+def _Ires_jac(I_in, rho_int, a, b, r, z, dz):
+    """
+    Analytic jacobian of _Ires/rho_int with respect to I[1:] (I[0] = rho_int
+    is fixed), in the banded storage of scipy.linalg.solve_banded (see
+    _Ires_bands), ie shape (ncol, 6, nz-1)
+    """
+    I = I_in.copy()
+    I[...,0:1] = rho_int
+    n = I.shape[-1]
+    dz = np.asarray(dz)[...,None]
+    c1, c2 = _stencils(n)[0:2]
+    # res = d2I + dI*g, g = a*z/(z**2 + r**2)**1.5 + 2*b*(I(0) - I)
+    g = a*z/((z**2 + r**2)**(1.5)) + 2*b*(I[...,0:1] - I)
+    coefs = c2/dz**2 + g[...,None]*c1/dz
+    coefs[...,3] -= 2*b*_dI_dz(I, np.squeeze(dz, -1))
+    coefs = coefs[...,1:,:]/np.asarray(rho_int)[...,None]
+    
+    return _to_banded(coefs, *_Ires_bands)
+    
+def _residual_aug_jac(x, rho0, a, b, r, z, dz):
+    """
+    Analytic jacobian of _residual_aug with respect to x, in the banded
+    storage of scipy.linalg.solve_banded (see _residual_aug_bands), ie shape
+    (ncol, 9, 2*(nz-1))
+    """
+    rho = np.concatenate((rho0, x[...,0::2]), -1)
+    I = np.concatenate((np.zeros(rho0.shape), x[...,1::2]), -1)
+    n = rho.shape[-1]
+    l = _residual_aug_bands[0]
+    c_rho = _stencils(n)[2][1:]
+    dz = np.asarray(dz)
+    coefs = np.zeros(rho.shape[0:-1] + (n-1, 2, l + 4))
+    # Rows for E (row 2m-2, m = 1 ... nz-1).  The unknowns rho_m, I_m are
+    # at 2m-2 and 2m-1
+    dzdz = np.diff(z, axis=-1)/dz
+    coefs[...,0,l+1] = 1/dz
+    coefs[...,0,l-1] = -1/dz
+    coefs[...,0,l] = -0.5*dzdz
+    coefs[...,0,l-2] = -0.5*dzdz
+    # Rows for R (row 2m-1).  rho_{m+k} is at offset 2k-1
+    for k in range(-2, 3):
+        
+        coefs[...,1,l+2*k-1] = c_rho[:,k+3]/dz
+        
+    coefs[...,1,l-1] += (a*z/((z**2 + r**2)**(1.5)) + 2*b*I)[...,1:]
+    coefs[...,1,l] = (2*b*rho)[...,1:]
+    coefs = coefs.reshape(coefs.shape[0:-3] + (2*(n-1), l + 4))
+    
+    return _to_banded(coefs, *_residual_aug_bands)
+    
+def _erf_res(scale_size, rho_int, a, b, r, z, dz):
+    """
+    Summed absolute residual of I for an error function guess with a length
+    scale of scale_size
+    """
+    testfct = rho_int*(1 - scipy.special.erf(z/scale_size))
+    
+    return abs(_Ires(testfct, rho_int, a, b, r, z, dz)).sum(-1)
     
-
 def cdfinv_z(z,rho):
     """
     Calculates the inverse of the cumulative distribution function for
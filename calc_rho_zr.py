@@ -23,20 +23,33 @@ __iversion__ = int(filter(str.isdigit,__version__))
 # ICgen packages
 import calc_rho
 import isaac
+import rho_library
+import timing
 
 # External packages
 import copy as copier
 import numpy as np
 import cPickle as pickle
 import scipy.interpolate as interp
+import scipy.integrate as nInt
 from multiprocessing import Pool, cpu_count
 
 import pynbody
 SimArray = pynbody.array.SimArray
 
+# Maximum number of points evaluated at once by the rho splines.  Larger
+# inputs are evaluated in chunks of this size to bound memory usage
+_max_chunk = int(2**20)
+# Minimum number of probability points used in the inverse CDF table
+_n_cdf_min = 1000
+
 def multirun_rho(args):
     # A wrapper for multiprocessing calls to rho_z (allows multiple args)
     return calc_rho.rho_z(*args)
+    
+def multirun_rho_continuation(args):
+    # A wrapper for multiprocessing calls to rho_z_continuation
+    return calc_rho.rho_z_continuation(*args)
 
 def rho_zr(ICobj):
     """
@@ -45,6 +58,18 @@ def rho_zr(ICobj):
     
     Requires ICobj.sigma to be defined already
     
+    How the radii are solved is set by ICobj.settings.rho_calc.method:
+        'pool' : each radius is solved separately by calc_rho.rho_z, using a
+            multiprocessing pool.  If settings.rho_calc.warm_start is True,
+            every process is given a contiguous block of radii, which are
+            solved in order, warm starting each radius from the previous one
+            (see calc_rho.rho_z_continuation)
+        'batch' : all radii are solved together, on one process, by
+            calc_rho.rho_z_batch
+        'library' : rho is interpolated from a cached table of
+            dimensionless solutions, solving exactly only where needed (see
+            rho_library.rho_z_library)
+    
     * Arguments *
     
     ICobj - The initial conditions object for which rho will be calculated
@@ -52,7 +77,8 @@ def rho_zr(ICobj):
     * Output *
     Returns dictionary containing:
         dict['rho'] : 2D array, rho at all pairs of points (z,r)
-        dict['z']   : a 1D array of z points
+        dict['z']   : a 1D array of z points (2D, the same shape as rho, if
+            settings.rho_calc.zmax_scale is set)
         dict['r']   : a 1D array of r points
         
     If output=filename, dictionary is pickled and saved to filename
@@ -84,7 +110,51 @@ def rho_zr(ICobj):
         
     # Initialize r,z, and rho
     r = SimArray(np.linspace(rmin,rmax,nr), 'au')
+    
+    if settings.rho_calc.method == 'batch':
+        # Solve for all radii at once on a single process
+        rho, z = calc_rho.rho_z_batch(ICobj.sigma(r), ICobj.T(r), r, settings)
+        
+        return rho, z, r
+        
+    if settings.rho_calc.method == 'library':
+        # Interpolate from the dimensionless solution library
+        rho, z = rho_library.rho_z_library(ICobj.sigma(r), ICobj.T(r), r, \
+        settings)
+        
+        return rho, z, r
+        
     rho = SimArray(np.zeros([nz,nr]), 'Msol au**-3')
+    
+    if settings.rho_calc.warm_start:
+        # Split the radii into one contiguous block per process
+        blocks = np.array_split(np.arange(nr), min(n_proc, nr))
+        arg_list = []
+        
+        for ind in blocks:
+            
+            arg_list.append([ICobj.sigma(r[ind]), ICobj.T(r[ind]), r[ind], \
+            settings])
+            
+        pool = Pool(n_proc)
+        results = pool.map(multirun_rho_continuation, arg_list)
+        pool.close()
+        pool.join()
+        
+        z_blocks = []
+        
+        for ind, (rho_block, z) in zip(blocks, results):
+            
+            rho[:,ind] = rho_block
+            z_blocks.append(z)
+            
+        rho.convert_units(rho_block.units)
+        
+        if np.ndim(z) == 2:
+            # Every radius has its own z grid
+            z = SimArray(np.concatenate(z_blocks, axis=1), z.units)
+        
+        return rho, z, r
 
     # Set up arguments for multiprocessing
     arg_list = []
@@ -96,16 +166,31 @@ def rho_zr(ICobj):
     pool = Pool(n_proc)
     results = pool.map(multirun_rho, arg_list)
     pool.close()
+    pool.join()
     
     # Extract results
+    z_all = None
+    
     for i in range(nr):
         
         rho_vector, z = results[i]
         rho[:,i] = rho_vector
+        
+        if settings.rho_calc.zmax_scale is not None:
+            # Every radius has its own z grid
+            if z_all is None:
+                
+                z_all = SimArray(np.zeros([nz, nr]), z.units)
+                
+            z_all[:,i] = z
     
     # Convert to the units generated by calc_rho
     rho.convert_units(rho_vector.units)
     
+    if z_all is not None:
+        
+        z = z_all
+    
     return rho, z, r
 
 class rho_from_array:
@@ -117,6 +202,11 @@ class rho_from_array:
     create a 2D spline interpolation.  Points outside of z,r are taken to be
     zero.  Also calculates the inverse CDF for rho(z) at all r points.
     
+    z can also be a 2D array (same shape as rho), giving a separate z grid
+    at every r (see calc_rho_zr.rho_zr).  Every column should increase from
+    0 to zmax(r).  The splines are then made in (z/zmax(r), r) and rho is
+    zero above zmax(r)
+    
     USAGE:
     
     INITIALIZE RHO:
@@ -134,44 +224,171 @@ class rho_from_array:
     
     """
     
-    def __init__(self, ICobj, rho, z, r):
+    def __init__(self, ICobj, rho, z, r, n_cdf=None):
         """
         Initialize
+        
+        n_cdf is the number of points on the probability grid used for the
+        inverse CDF table.  If None, _n_cdf_min or len(z) points are used,
+        whichever is larger
         """
         self._parent = ICobj
-        self._rho_spline = interp.RectBivariateSpline(z,r,rho)
         self.rho_binned = rho
         self.r_bins = r
         self.z_bins = z
         
-        # Generate inverse cdf spline (used by cdf_inv)
-        self._cdf_inv_gen(rho, z, r)
+        with timing.stage('spline'):
+            
+            if np.ndim(z) == 2:
+                # A separate z grid at every radius
+                self._zmax = np.asarray(z)[-1]
+                self._zeta, rho_zeta = self._zeta_grid(rho, z)
+                self._rho_spline = interp.RectBivariateSpline(self._zeta, r, \
+                rho_zeta)
+                
+            else:
+                
+                self._zmax = None
+                self._rho_spline = interp.RectBivariateSpline(z,r,rho)
+        
+        # Generate inverse cdf table (used by cdf_inv)
+        with timing.stage('cdf_inv'):
+            
+            self._cdf_inv_gen(rho, z, r, n_cdf)
+            
         # Generate radial derivative of rho (used by drho_dr)
-        self._radial_derivative()
+        with timing.stage('drho_dr'):
+            
+            self._radial_derivative()
+        
         
+    def __call__(self, z, r, chunksize=None):
         
-    def __call__(self,z,r):
+        return self.rho(z, r, chunksize)
         
-        return self.rho(z,r)
+    def __getstate__(self):
+        """
+        Drop the link to the parent IC object when pickling.  Everything else
+        (splines and the inverse CDF table) is stored as plain arrays, so the
+        rho object is cheap to pickle and to send to other processes
+        """
+        state = self.__dict__.copy()
+        state.pop('_parent', None)
+        
+        return state
+        
+    def __setstate__(self, state):
+        
+        state.setdefault('_zmax', None)
+        self.__dict__.update(state)
+        
+    def _zeta_grid(self, rho, z):
+        """
+        For per-radius z grids (2D z), returns the shared grid of
+        zeta = z/zmax(r) and rho on that grid.  If the columns of z are not
+        all proportional to each other, rho is linearly interpolated onto the
+        mean zeta grid.
+        """
+        z = np.asarray(z)
+        rho = np.asarray(rho)
+        zeta_all = z/self._zmax
+        zeta = zeta_all.mean(1)
+        
+        if np.allclose(zeta_all, zeta[:,None], rtol=0, atol=1e-12):
+            
+            return zeta, rho
+            
+        rho_zeta = np.zeros([len(zeta), rho.shape[1]])
+        
+        for i in range(rho.shape[1]):
+            
+            rho_zeta[:,i] = np.interp(zeta, zeta_all[:,i], rho[:,i])
+            
+        return zeta, rho_zeta
+        
+    def _to_zeta(self, z, r):
+        """
+        Converts z (unitless, in the units of z_bins) to zeta = |z|/zmax(r)
+        for per-radius z grids.  zmax(r) is linearly interpolated in r
+        """
+        zmax = np.interp(r, np.asarray(self.r_bins), self._zmax)
+        
+        return abs(z)/zmax
     
-    def _cdf_inv_gen(self, rho, z, r):
+    def _cdf_inv_gen(self, rho, z, r, n_cdf=None):
+        """
+        Tabulates the inverse CDF of rho(z) at every r on a shared
+        probability grid.  The result is stored as one dense (nr x n_cdf)
+        array, self._cdf_inv_table, where self._cdf_inv_table[i, j] is z at
+        r_bins[i] for a CDF of m[j].
+        
+        The grid is uniform in s = 1 - sqrt(1 - m), ie m = 1 - (1 - s)**2,
+        which refines the grid towards m = 1 where z(m) is steep (the tail of
+        the vertical profile) while still allowing O(1) lookup.
         
-        cdf_inv = []
-        # Generate the inverse CDF
-        for n in range(len(r)):
+        Columns where rho is zero (or negative) everywhere map all m to z = 0.
+        z can be 1D or have a separate grid for every r (2D)
+        """
+        if n_cdf is None:
+            
+            n_cdf = max(_n_cdf_min, len(z))
             
-            cdf_inv.append(calc_rho.cdfinv_z(z,rho[:,n]))
+        z = np.asarray(z)
+        rho = np.asarray(rho)
+        nz, nr = rho.shape
+        s_grid = np.linspace(0, 1, n_cdf)
+        m_grid = 1 - (1 - s_grid)**2
+        
+        # Calculate the CDF for all radial bins at once
+        f = np.zeros([nz, nr])
+        f[1:] = nInt.cumtrapz(rho, z, axis=0)
+        f_max = f.max(0)
+        
+        table = np.zeros([nr, n_cdf])
         
-        self._cdf_inv = cdf_inv
+        for i in range(nr):
+            
+            if f_max[i] <= 0.0:
+                # The density (rho) is zero here for all z or neg or something.
+                # Make all particles go to z = 0.0
+                continue
+            
+            f_i = f[:,i]/f_max[i]
+            # Assume CDF is approximately monotonic and sort to force it to be
+            ind = f_i.argsort(kind='mergesort')
+            f_i = f_i[ind]
+            z_i = z[ind] if z.ndim == 1 else z[ind, i]
+            # Drop values where CDF is constant (ie, prob = 0)
+            mask = np.ones(nz, dtype=bool)
+            mask[1:] = (f_i[1:] != f_i[0:-1])
+            table[i] = np.interp(m_grid, f_i[mask], z_i[mask])
+            
+        self._cdf_inv_table = table
         
     def _radial_derivative(self):
         """
         Generate the radial derivative of rho
+        
+        For per-radius z grids, rho(z, r) = g(zeta, r) with zeta = z/zmax(r),
+        so at constant z:
+            drho/dr = dg/dr - zeta * (dzmax/dr / zmax) * dg/dzeta
         """
         z = self.z_bins
         r = self.r_bins
         rho = self.rho_binned
         
+        if self._zmax is not None:
+            
+            zeta = self._zeta
+            g = self._rho_spline(zeta, r)
+            r = np.asarray(r)
+            dg_dzeta, dg_dr = np.gradient(g, zeta, r)
+            dlnzmax_dr = np.gradient(self._zmax, r)/self._zmax
+            drho_dr_binned = dg_dr - zeta[:,None]*dlnzmax_dr*dg_dzeta
+            self._drho_dr = interp.RectBivariateSpline(zeta, r, drho_dr_binned)
+            
+            return
+        
         dz = z[[1]] - z[[0]]
         dr = r[[1]] - r[[0]]
         
@@ -182,7 +399,7 @@ class rho_from_array:
         
         
 
-    def cdf_inv(self,m,r):
+    def cdf_inv(self, m, r, chunksize=None):
         """
         A callable interface for the inverse CDF.
         
@@ -198,61 +415,121 @@ class rho_from_array:
             
             cdf_vals = cdf_inv(m, r) # Returns z at cdf = 0.5 for all r
             
+        z is found by bilinear interpolation of the inverse CDF table in (m, r)
+        and is vectorized over all points, in chunks of at most chunksize
+        points.  Points outside of the r range are given z = 0
         """
-        
-        # Make them iterable if they are floats/0D arrays
-        if not hasattr(m, '__iter__'): m = np.array(m).reshape(1)
-        if not hasattr(r, '__iter__'): r = np.array(r).reshape(1)
-        # Check to see if one of the arrays is longer than the other.  IF so,
-        # assume that one is length one
-        if np.prod(m.shape) > np.prod(r.shape):
-            
-            r = r*np.ones(m.shape)
+        if chunksize is None:
             
-        elif np.prod(m.shape) < np.prod(r.shape):
+            chunksize = _max_chunk
             
-            m = m*np.ones(r.shape)
+        chunksize = int(chunksize)
         
         # Check units
         runit = self.r_bins.units
         zunit = self.z_bins.units
         r = isaac.match_units(r, runit)[0]
+        m, r = np.broadcast_arrays(np.asarray(m, dtype=float), np.asarray(r))
             
         # Initialize
-        n_pts = len(r)
-        z_out = SimArray(np.zeros([len(r)]), zunit)
-        dr = self.r_bins[[1]] - self.r_bins[[0]]
-        r_indices = np.digitize(r, self.r_bins)
+        z_out = np.zeros(m.shape)
+        z_flat = z_out.reshape(-1)
+        n_pts = z_flat.size
+        
+        for i in range(0, n_pts, chunksize):
+            
+            z_flat[i:i+chunksize] = self._cdf_inv_lookup(m.flat[i:i+chunksize],\
+            r.flat[i:i+chunksize])
+            
+        return SimArray(z_out, zunit)
+        
+    def _cdf_inv_lookup(self, m, r):
+        """
+        Bilinear lookup of the inverse CDF table for 1D (unitless) arrays m, r
+        """
+        table = self._cdf_inv_table
+        nr, n_cdf = table.shape
+        r_bins = np.asarray(self.r_bins)
+        z = np.zeros(len(r))
+        
         # Ignore values outside of the r range
-        mask = (r >= self.r_bins.min()) & (r < self.r_bins.max())
-        z = z_out[mask]
+        mask = (r >= r_bins[0]) & (r < r_bins[-1])
         r = r[mask]
-        r_indices = r_indices[mask]
-        m = m[mask]
-        
-        # Loop through all used radial bins
-        used_indices = set(r_indices)        
-        for i in used_indices:
-            
-            # Look at all particles in radial bin i
-            mask2 = (r_indices == i)
-            # Calculate z at the bin edges
-            z_lo = self._cdf_inv[i-1](m[mask2])
-            z_hi = self._cdf_inv[i](m[mask2])
-            # Linearly interpolate z from bin edges
-            z[mask2] = z_lo + ((z_hi-z_lo)/dr) * (r[mask2] - self.r_bins[[i-1]])
-            
-        # Assign z for all particles within the bin range
-        z_out[mask] = z
-                    
-        return z_out
+        m = np.clip(m[mask], 0.0, 1.0)
+        
+        # Radial bin edges and interpolation weights
+        i_hi = np.searchsorted(r_bins, r, side='right')
+        i_lo = i_hi - 1
+        w_r = (r - r_bins[i_lo])/(r_bins[i_hi] - r_bins[i_lo])
+        
+        # Probability grid indices and interpolation weights (the table is
+        # uniform in s = 1 - sqrt(1-m), see _cdf_inv_gen)
+        x = (1 - np.sqrt(1 - m)) * (n_cdf - 1)
+        j_lo = np.minimum(x.astype(int), n_cdf - 2)
+        j_hi = j_lo + 1
+        w_m = x - j_lo
+        
+        z_lo = (1 - w_m)*table[i_lo, j_lo] + w_m*table[i_lo, j_hi]
+        z_hi = (1 - w_m)*table[i_hi, j_lo] + w_m*table[i_hi, j_hi]
+        z[mask] = z_lo + w_r*(z_hi - z_lo)
+        
+        return z
             
+    def _spline_eval(self, spline, z, r, chunksize=None):
+        """
+        Evaluates a RectBivariateSpline at the pairs of points (z, r).  z and
+        r are broadcast against each other and the spline is evaluated in
+        vectorized chunks of at most chunksize points, which bounds the
+        memory used by temporaries for very large inputs.
+        
+        z, r should be unitless (already in the units of the spline).
+        Returns an array with the broadcast shape of z, r
+        """
+        if chunksize is None:
+            
+            chunksize = _max_chunk
+            
+        chunksize = int(chunksize)
+        z, r = np.broadcast_arrays(np.asarray(z), np.asarray(r))
+        out = np.zeros(z.shape)
+        out_flat = out.reshape(-1)
+        n_pts = out_flat.size
+        
+        if n_pts <= chunksize:
+            
+            out_flat[:] = spline.ev(z.ravel(), r.ravel())
+            
+        else:
+            
+            for i in range(0, n_pts, chunksize):
+                
+                out_flat[i:i+chunksize] = spline.ev(z.flat[i:i+chunksize], \
+                r.flat[i:i+chunksize])
+                
+        return out
 
-    def rho(self,z,r):
+    def _zeta_eval(self, spline, z, r, chunksize=None):
+        """
+        Evaluates a spline in (zeta, r) (per-radius z grids) at the points
+        (z, r).  Points above zmax(r) are zero.  Returns an array with the
+        broadcast shape of z, r
+        """
+        z, r = np.broadcast_arrays(np.asarray(z, dtype=float), np.asarray(r))
+        zeta = self._to_zeta(z, r)
+        out = self._spline_eval(spline, zeta, r, chunksize)
+        out[zeta > 1] = 0.0
+        
+        return out
+        
+    def rho(self, z, r, chunksize=None):
         """
         A Callable method that works like a spline but handles units.
         
         returns rho(z,r), an N-D array evaluated over the N-D arrays z, r
+        
+        z and r are broadcast against each other and evaluated in one
+        vectorized pass.  For very large inputs the evaluation is done in
+        chunks of at most chunksize points (default calc_rho_zr._max_chunk)
         """
         
         # Fix up units
@@ -263,27 +540,24 @@ class rho_from_array:
         z = isaac.match_units(z, zunit)[0]
         r = isaac.match_units(r, runit)[0]
         
+        if self._zmax is not None:
+            
+            rho_out = self._zeta_eval(self._rho_spline, z, r, chunksize)
+            
+            return SimArray(rho_out, rho_unit)
+        
         if not hasattr(z, '__iter__'):
             
             rho_out = SimArray(self._rho_spline(z,r), rho_unit)
             
         else:
             
-            rho_out = np.zeros(z.shape)
-            iterator = np.nditer([z,r], flags=['multi_index'])
-            
-            while not iterator.finished:
-                
-                z_val, r_val = iterator.value
-                ind = iterator.multi_index
-                rho_out[ind] = self._rho_spline(z_val, r_val)
-                iterator.iternext()
-                
-            rho_out = SimArray(rho_out, rho_unit)                
+            rho_out = self._spline_eval(self._rho_spline, z, r, chunksize)
+            rho_out = SimArray(rho_out, rho_unit)
                         
         return rho_out
         
-    def drho_dr(self, z, r):
+    def drho_dr(self, z, r, chunksize=None):
         """
         Radial derivative of rho.  A callable method that works like a spline
         but handles units.
@@ -291,6 +565,9 @@ class rho_from_array:
         USAGE:
         
         drho_dr(z,r) returns the radial derivative of rho at z, r
+        
+        As with rho(z,r), the evaluation is vectorized over the broadcast
+        z, r arrays, in chunks of at most chunksize points
         """
         
         # Set-up units
@@ -303,22 +580,17 @@ class rho_from_array:
         z = isaac.match_units(z, zunit)[0]
         r = isaac.match_units(r, runit)[0]
         
-        # Iterate over drho        
-        if not hasattr(z, '__iter__'):
+        if self._zmax is not None:
+            
+            drho = self._zeta_eval(self._drho_dr, z, r, chunksize)
+            
+        elif not hasattr(z, '__iter__'):
             
             drho = self._drho_dr(z,r)
             
         else:
             
-            drho = np.zeros(z.shape)
-            iterator = np.nditer([z,r], flags=['multi_index'])
-            
-            while not iterator.finished:
-                
-                z_val, r_val = iterator.value
-                ind = iterator.multi_index
-                drho[ind] = self._drho_dr(z_val, r_val)
-                iterator.iternext()
+            drho = self._spline_eval(self._drho_dr, z, r, chunksize)
                         
         # Fix up units
         drho = isaac.match_units(drho, drho_unit)[0]
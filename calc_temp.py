@@ -45,6 +45,8 @@ class T:
             Tmin
             Tmax (optional)
     
+    T.dT_dr(r) gives the radial derivative of T (calculated numerically, so
+    it works for all kinds)
     """
     def __init__(self, ICobj):
         
@@ -94,5 +96,15 @@ class T:
             Tout[Tout > Tmax] = Tmax
             
         
-        return Tout        
+        return Tout
+    
+    def dT_dr(self, r, h=1e-4):
+        """
+        Radial derivative of T at r, by central differences with a relative
+        step h
+        """
+        r = isaac.match_units(r, 'au')[0]
+        dr = h*r
+        dT = self(r + dr) - self(r - dr)
         
+        return dT/(2*dr)
@@ -14,19 +14,24 @@ SimArray = pynbody.array.SimArray
 
 import isaac
 import ICgen_utils
+import tipsy_io
+import timing
+import gravity as gravity_tree
 
 import os
 import glob
 import gc
 
 def v_xy(f, param, changbin=None, nr=50, min_per_bin=100, changa_preset=None, \
-max_particles=None, est_eps=True):
+max_particles=None, est_eps=True, filename=None, gravity='changa', \
+theta=0.7, field=None, pressure='changa', support=None):
     """
     Attempts to calculate the circular velocities for particles in a thin
     (not flat) keplerian disk.  Also estimates gravitational softening (eps)
     for the gas particles
     
-    Requires ChaNGa
+    Requires ChaNGa, unless gravity is 'tree' or 'grid', pressure is 'grid'
+    and est_eps=False
     
     Note that this will change the velocities IN f
     
@@ -56,10 +61,35 @@ max_particles=None, est_eps=True):
     est_eps : bool
         Estimate eps (gravitational softening length).  Default is True.
         If False, it is assumed eps has already been estimated
+    filename : str (optional)
+        Tipsy file which f was loaded from (and which matches f).  If set,
+        the new velocities and eps are written into it in place, and (if all
+        particles are used) ChaNGa is run on it directly instead of on a
+        copy of f
+    gravity : str
+        How the gravitational accelerations are calculated.  'changa' runs
+        ChaNGa (twice, since eps changes after the first run).  'tree' uses
+        the in-process tree code (see gravity.py).  If est_eps, ChaNGa is
+        still run once to estimate eps.  'grid' uses field (and also runs
+        ChaNGa for eps if est_eps)
+    theta : float
+        Opening angle for gravity='tree'
+    field : potential.disk_field
+        For gravity='grid': the radial gravitational field of the disk and
+        star, calculated from sigma and rho (see potential.py).  The 
+        velocities are interpolated from it, without any fitting
+    pressure : str
+        How the accelerations due to pressure are calculated.  'changa' runs
+        ChaNGa with SPH and uses the binned ratio of the gas to gravitational
+        accelerations.  'grid' uses support
+    support : calc_velocity.pressure_support
+        For pressure='grid': the radial pressure gradient acceleration,
+        calculated from rho and T (see pressure_support)
         
     **RETURNS**
     
-    Nothing.  Velocities are updated within f as is eps
+    Nothing.  Velocities are updated within f as is eps (and within filename,
+    if set)
     """
     # If the snapshot has too many particles, randomly select gas particles
     # To use for calculating velocity and make a view of the snapshot
@@ -99,6 +129,22 @@ max_particles=None, est_eps=True):
     f_name = f_prefix + '.std'
     p_name = f_prefix + '.param'
     
+    # The snapshot is only written once.  Before every ChaNGa run after the
+    # first, only the fields which have changed (eps, vel) are updated
+    run_changa = (gravity == 'changa') or (pressure == 'changa') or est_eps
+    
+    if not run_changa:
+        
+        f_name = None
+        
+    elif subview or (filename is None):
+        
+        f.write(filename=f_name, fmt = pynbody.tipsy.TipsySnap)
+        
+    else:
+        
+        f_name = filename
+    
     # Update parameters
     p_temp = param.copy()
     p_temp['achInFile'] = f_name
@@ -110,42 +156,79 @@ max_particles=None, est_eps=True):
     # --------------------------------------------
     # Estimate velocity from gravity only
     # --------------------------------------------
-    for iGrav in range(2):
-        # Save files
-        f.write(filename=f_name, fmt = pynbody.tipsy.TipsySnap)
-        isaac.configsave(p_temp, p_name, ftype='param')
+    if gravity not in ('changa', 'tree', 'grid'):
+    
+        raise ValueError, 'Unknown gravity method {0}'.format(gravity)
+        
+    if (gravity == 'grid') and (field is None):
+    
+        raise ValueError, 'gravity = grid requires field'
+        
+    if pressure not in ('changa', 'grid'):
+        
+        raise ValueError, 'Unknown pressure method {0}'.format(pressure)
+        
+    if (pressure == 'grid') and (support is None):
+        
+        raise ValueError, 'pressure = grid requires support'
         
-        if iGrav == 0:
-            # Run ChaNGa calculating all forces (for initial run)
+    if gravity in ('tree', 'grid'):
+    
+        if est_eps:
+            # ChaNGa is only run for the smoothing lengths (to estimate eps)
+            isaac.configsave(p_temp, p_name, ftype='param')
             command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '+gas +n 0')
-        else:
-            # Run ChaNGa, only calculating gravity (on second run)
-            command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '-gas +n 0')
+            print command
             
-        print command
-        p = ICgen_utils.changa_run(command)
-        p.wait()
-        
-        if (iGrav == 0) and est_eps:
-            # Estimate the gravitational softening length on the first iteration
+            with timing.stage('changa', command=command):
+                
+                with ICgen_utils.changa_slot():
+                    
+                    p = ICgen_utils.changa_run(command)
+                    p.wait()
+                    
             smoothlength_file = f_prefix + '.000000.smoothlength'
-            eps = ICgen_utils.est_eps(smoothlength_file)
-            f.g['eps'] = eps
-    
-        # Load accelerations
-        acc_name = f_prefix + '.000000.acc2'
+            f.g['eps'] = ICgen_utils.est_eps(smoothlength_file)
+            _clean_up(f_prefix, keep=f_name)
+            
+    if gravity == 'changa':
+        
+        n_grav = 2
+        
+    elif gravity == 'tree':
+        # The gravity doesn't depend on the velocities, so one pass is enough
+        n_grav = 1
+        
+    else:
+        
+        n_grav = 0
+        
+    for iGrav in range(n_grav):
+        
         del a
         gc.collect()
-        a = isaac.load_acc(acc_name, low_mem=True)
-        gc.collect()
         
-        # Clean-up
-        for fname in glob.glob(f_prefix + '*'): os.remove(fname)
+        if gravity == 'tree':
+            
+            with timing.stage('tree_gravity'):
+                
+                a = gravity_tree.snapshot_accelerations(f, 'gas', theta)
+                
+        else:
+            
+            a = _changa_gravity(f, f_name, f_prefix, p_name, p_temp, iGrav, \
+            changa_preset, changbin, est_eps)
+            
+        gc.collect()
         
         # Calculate cos(theta) where theta is angle above x-y plane
         cos = (r/np.sqrt(r**2 + z**2)).in_units('1').astype(np.float32)
         # Calculate radial acceleration times r^2
         ar2 = (a[:,0]*cosine + a[:,1]*sine)*r**2
+        # Keep the unfitted values, to subtract from the total accelerations
+        ar2_grav = ar2
+        del a
+        a = None
         
         # Bin the data
         r_edges = np.linspace(r.min(), (1+np.spacing(2))*r.max(), nr + 1)
@@ -170,55 +253,79 @@ max_particles=None, est_eps=True):
             b[i] = p[1]
             
         # Interpolate the line fits
-        m_spline = isaac.extrap1d(r_bins, m)
-        b_spline = isaac.extrap1d(r_bins, b)
+        ar2_model = _line_fit_model(r_bins, m, b, ar2.units)
         
         # Calculate circular velocity
-        ar2 = SimArray(m_spline(r)*cos + b_spline(r), ar2.units)
-        gc.collect()
-        v_calc = (np.sqrt(abs(ar2)/r)).in_units(vel.units)
+        ar2 = ar2_model(r, z)
         gc.collect()
-        vel[:,0] = -v_calc*sine
-        vel[:,1] = v_calc*cosine
-        del v_calc
+        _set_vel(vel, ar2, r, cosine, sine)
         gc.collect()
         
+    if gravity == 'grid':
+        # The field is smooth, so it doesn't need to be fit
+        def ar2_model(r, z):
+            
+            return field.a_r(z, r) * r**2
+        
+        with timing.stage('grid_gravity'):
+            
+            ar2 = ar2_model(r, z)
+            
+        ar2_grav = ar2
+        _set_vel(vel, ar2, r, cosine, sine)
+        
     # --------------------------------------------
     # Estimate pressure/gas dynamics accelerations
     # --------------------------------------------
     
-    # Save files
-    f.write(filename=f_name, fmt = pynbody.tipsy.TipsySnap)
-    isaac.configsave(p_temp, p_name, ftype='param')
-    
-    # Run ChaNGa, including SPH
-    command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '+gas -n 0')
-    p = ICgen_utils.changa_run(command)
-    p.wait()
+    if pressure == 'changa':
+        
+        # Save files
+        _update_snapshot(f_name, f)
+        isaac.configsave(p_temp, p_name, ftype='param')
+        
+        # Run ChaNGa, including SPH
+        command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '+gas -n 0')
+        
+        with timing.stage('changa', command=command):
+        
+            with ICgen_utils.changa_slot():
+        
+                p = ICgen_utils.changa_run(command)
+                p.wait()
+        
+        # Load accelerations
+        acc_name = f_prefix + '.000000.acc2'
+        
+        with timing.stage('load_acc'):
+        
+            a_total = isaac.load_acc(acc_name, low_mem=True)
+        
+        gc.collect()
+        
+        # Clean-up
+        _clean_up(f_prefix)
+        
+        # Estimate the accelerations due to pressure gradients/gas dynamics
+        ar2_gas = (a_total[:,0]*cosine + a_total[:,1]*sine)*r**2
+        del a_total
+        gc.collect()
+        ar2_gas -= ar2_grav.in_units(ar2_gas.units)
+        del ar2_grav
+        gc.collect()
+        
+        ar2 = ar2.in_units(ar2_gas.units)
+        logr_bins, ratio, err = isaac.binned_mean(np.log(r), ar2_gas/ar2, \
+        nbins=nr, weighted_bins=True)
+        r_bins = np.exp(logr_bins)
+        del ar2_gas
+        gc.collect()
+        ratio_spline = isaac.extrap1d(r_bins, ratio)
+        
+    else:
+        
+        _clean_up(f_prefix)
         
-    # Load accelerations
-    acc_name = f_prefix + '.000000.acc2'
-    a_total = isaac.load_acc(acc_name, low_mem=True)
-    gc.collect()
-    
-    # Clean-up
-    for fname in glob.glob(f_prefix + '*'): os.remove(fname)
-    
-    # Estimate the accelerations due to pressure gradients/gas dynamics
-    a_gas = a_total - a
-    del a_total, a
-    gc.collect()
-    ar2_gas = (a_gas[:,0]*cosine + a_gas[:,1]*sine)*r**2
-    del a_gas
-    gc.collect()
-    
-    logr_bins, ratio, err = isaac.binned_mean(np.log(r), ar2_gas/ar2, nbins=nr,\
-    weighted_bins=True)
-    r_bins = np.exp(logr_bins)
-    del ar2_gas
-    gc.collect()
-    ratio_spline = isaac.extrap1d(r_bins, ratio)
-    
     # If not all the particles were used for calculating velocity,
     # Make sure to use them now
     if subview:
@@ -227,30 +334,174 @@ max_particles=None, est_eps=True):
         f.g['mass'] /= m_scale
         # Scale eps appropriately
         f.g['eps'] /= m_scale**(1.0/3)
-        complete_snapshot.g['eps'] = f.g['eps'][[0]]
         
+        if est_eps:
+            # eps was estimated (a single value) for the subview only
+            complete_snapshot.g['eps'] = f.g['eps'][[0]]
+            
         # Rename complete snapshot
         f = complete_snapshot
         # Calculate stuff for all particles
         r = f.g['rxy']
         z = f.g['z']
-        cos = (r/np.sqrt(r**2 + z**2)).in_units('1').astype(np.float32)
-        ar2 = SimArray(m_spline(r)*cos + b_spline(r), ar2.units)
+        ar2 = ar2_model(r, z)
         cosine = (f.g['x']/r).in_units('1').astype(np.float32)
         sine = (f.g['y']/r).in_units('1').astype(np.float32)
         vel = f.g['vel']
         
     
-    ar2_calc = ar2*(1 + ratio_spline(r))
+    if pressure == 'changa':
+        
+        ar2_calc = ar2*(1 + ratio_spline(r))
+        
+    else:
+        
+        with timing.stage('pressure_support'):
+            
+            ar2_p = support.a_r(z, r) * r**2
+            ar2_calc = ar2 + ar2_p.in_units(ar2.units)
+            del ar2_p
+            
     del ar2
     gc.collect()
     
     # Calculate velocity
-    v = (np.sqrt(abs(ar2_calc)/r)).in_units(f.g['vel'].units)
+    _set_vel(vel, ar2_calc, r, cosine, sine)
     del ar2_calc
     gc.collect()
     
+    if filename is not None:
+        
+        _update_snapshot(filename, f)
+    
+    return
+    
+class pressure_support:
+    """
+    The radial acceleration due to the pressure gradient of the gas, 
+    calculated from rho(z, r) and T(r) of the ICs (ideal gas, P = rho k T/m):
+    
+        a_r = -(1/rho) dP/dr = -(k/m) (dT/dr + T drho/dr / rho)
+        
+    For the isothermal ICs, this is what ChaNGa's SPH forces estimate.
+    
+    USAGE:
+        
+        support = calc_velocity.pressure_support(ICobj)
+        a = support.a_r(z, r)
+    """
+    
+    def __init__(self, ICobj):
+        
+        self.rho = ICobj.rho
+        self.T = ICobj.T
+        self.m = ICobj.settings.physical.m
+        
+    def a_r(self, z, r):
+        """
+        Radial pressure gradient acceleration at (z, r).  Where rho is zero
+        (outside the disk) only the temperature gradient is used
+        """
+        kB = SimArray(1.0, 'k')
+        r = isaac.match_units(r, 'au')[0]
+        z = isaac.match_units(z, 'au')[0]
+        rho = self.rho.rho(z, r)
+        drho_dr = self.rho.drho_dr(z, r).in_units(rho.units/r.units)
+        positive = np.asarray(rho) > 0
+        dlnrho_dr = SimArray(np.zeros(rho.shape), r.units**-1)
+        dlnrho_dr[positive] = np.asarray(drho_dr)[positive] \
+        /np.asarray(rho)[positive]
+        T = self.T(r)
+        a = -(kB/self.m) * (self.T.dT_dr(r) + T*dlnrho_dr)
+        
+        return a.in_units('km s**-2')
+    
+def _line_fit_model(r_bins, m, b, units):
+    """
+    Returns a function ar2(r, z) which interpolates the fits (in radial bins
+    r_bins) of ar2 = m cos + b, where cos = r/sqrt(r^2 + z^2)
+    """
+    m_spline = isaac.extrap1d(r_bins, m)
+    b_spline = isaac.extrap1d(r_bins, b)
+    
+    def ar2_model(r, z):
+        
+        cos = (r/np.sqrt(r**2 + z**2)).in_units('1').astype(np.float32)
+        
+        return SimArray(m_spline(r)*cos + b_spline(r), units)
+        
+    return ar2_model
+    
+def _set_vel(vel, ar2, r, cosine, sine):
+    """
+    Sets the x, y velocities vel to circular velocities for the radial 
+    accelerations ar2/r^2
+    """
+    v = (np.sqrt(abs(ar2)/r)).in_units(vel.units)
     vel[:,0] = -v*sine
     vel[:,1] = v*cosine
     
-    return
+def _changa_gravity(f, f_name, f_prefix, p_name, p_temp, iGrav, \
+changa_preset, changbin, est_eps):
+    """
+    Runs ChaNGa on the snapshot f (saved as f_name) and returns the 
+    accelerations of the gas.  The first run (iGrav = 0) calculates all the
+    forces and (if est_eps) estimates eps, later runs only calculate gravity
+    """
+    # Save files
+    if iGrav > 0:
+        
+        _update_snapshot(f_name, f)
+        
+    isaac.configsave(p_temp, p_name, ftype='param')
+    
+    if iGrav == 0:
+        # Run ChaNGa calculating all forces (for initial run)
+        command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '+gas +n 0')
+    else:
+        # Run ChaNGa, only calculating gravity (on second run)
+        command = ICgen_utils.changa_command(p_name, changa_preset, changbin, '-gas +n 0')
+        
+    print command
+    
+    with timing.stage('changa', command=command):
+        
+        with ICgen_utils.changa_slot():
+            
+            p = ICgen_utils.changa_run(command)
+            p.wait()
+    
+    if (iGrav == 0) and est_eps:
+        # Estimate the gravitational softening length on the first iteration
+        smoothlength_file = f_prefix + '.000000.smoothlength'
+        eps = ICgen_utils.est_eps(smoothlength_file)
+        f.g['eps'] = eps
+
+    # Load accelerations
+    acc_name = f_prefix + '.000000.acc2'
+    
+    with timing.stage('load_acc'):
+        
+        a = isaac.load_acc(acc_name, low_mem=True)
+        
+    # Clean-up (keep the snapshot for the next run)
+    _clean_up(f_prefix, keep=f_name)
+    
+    return a
+    
+def _update_snapshot(filename, f):
+    """
+    Writes the gas velocities and eps of the snapshot f into the tipsy file
+    filename (which otherwise matches f) in place
+    """
+    tipsy_io.patch(filename, 'gas', {'vel': f.g['vel'], 'eps': f.g['eps']})
+    
+def _clean_up(f_prefix, keep=None):
+    """
+    Deletes the files made for/by a ChaNGa run (named f_prefix*), except keep
+    """
+    for fname in glob.glob(f_prefix + '*'):
+        
+        if fname != keep:
+            
+            os.remove(fname)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Writes checkpoints (ie saves of the ICs during IC.generate) in a background
+thread, so that the next step can run while the last one is being saved.
+
+Jobs are run one at a time, in the order they are submitted.  flush() waits
+until all submitted jobs are done and re-raises the first error any of them
+raised.
+
+USAGE:
+    
+    writer = checkpoint.writer()
+    writer.submit(function, arg1, arg2)
+    ...
+    writer.flush()
+"""
+
+# External packages
+import threading
+import Queue
+import sys
+
+class writer:
+    """
+    A background thread which runs (write) jobs one at a time.  See the
+    module doc-string
+    """
+    
+    def __init__(self):
+        
+        self._queue = Queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        # Don't keep python alive for an unfinished checkpoint if the main
+        # thread dies
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def submit(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) in the background, after all the
+        jobs submitted before it
+        """
+        if not self._thread.is_alive():
+            
+            raise RuntimeError, 'Checkpoint writer has been closed'
+        
+        self._queue.put((function, args, kwargs))
+    
+    def flush(self):
+        """
+        Waits for all the submitted jobs to finish.  If any of them raised an
+        error, it is raised here
+        """
+        self._queue.join()
+        error = self._error
+        self._error = None
+        
+        if error is not None:
+            
+            raise error[0], error[1], error[2]
+    
+    def close(self):
+        """
+        Waits for all the submitted jobs to finish (see flush) and stops the
+        thread
+        """
+        try:
+            
+            self.flush()
+        
+        finally:
+            
+            if self._thread.is_alive():
+                
+                self._queue.put(None)
+                self._thread.join()
+    
+    def _run(self):
+        
+        while True:
+            
+            job = self._queue.get()
+            
+            if job is None:
+                
+                self._queue.task_done()
+                break
+            
+            function, args, kwargs = job
+            
+            try:
+                
+                function(*args, **kwargs)
+            
+            except:
+                
+                # Keep the first error (raised by flush)
+                if self._error is None:
+                    
+                    self._error = sys.exc_info()
+            
+            finally:
+                
+                self._queue.task_done()
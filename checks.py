@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Regression checks of the numerical parts of ICgen which don't need ChaNGa.
+Each check compares against an independent reference and has a stated
+tolerance.
+
+The checks are:
+    gravity     gravity.accelerations against direct summation
+                (gravity.direct) for a small disk: theta = 0 must match to
+                round-off, theta = 0.7 must have a median relative error
+                below tolerances['gravity_median']
+    smooth_rho  the smoothing lengths and densities written to a tipsy file
+                by make_snapshot (smooth = 'tree') are read back from the
+                file and compared with smooth.smooth in Msol/au**3
+
+USAGE (command line):
+
+    python checks.py                # runs all the checks
+    python checks.py --only gravity
+
+USAGE (python):
+
+    import checks
+    passed = checks.run()
+"""
+
+# External packages
+import numpy as np
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import pynbody
+SimArray = pynbody.array.SimArray
+
+# ICgen packages
+import gravity
+import smooth
+import tipsy_io
+import make_snapshot
+
+# Tolerances of the checks
+tolerances = {}
+# Maximum relative error of the tree with theta = 0
+tolerances['gravity_exact'] = 1e-10
+# Median relative error of the tree with theta = 0.7
+tolerances['gravity_median'] = 1e-2
+# Relative error of the densities read back from the file (float32)
+tolerances['smooth_rho'] = 1e-5
+
+def run(only=None):
+    """
+    Runs the checks (all of them, or those named in only) and prints the
+    results.  Returns True if they all passed
+    """
+    names = _order if only is None else only
+    passed = True
+
+    for name in names:
+
+        ok, message = _checks[name]()
+        print '{0:<12} {1:<6} {2}'.format(name, 'PASS' if ok else 'FAIL', \
+        message)
+        passed = passed and ok
+
+    return passed
+
+def check_gravity(n=3000, seed=0):
+    """
+    Compares the tree accelerations of a disk of n particles (without a star,
+    so errors aren't hidden by the star's field) to direct summation
+    """
+    pos, mass, eps = _disk(n, seed)
+    a_direct = gravity.direct(pos, mass, eps)
+    norm = np.sqrt((a_direct**2).sum(1))
+    errors = {}
+
+    for theta in (0.0, 0.7):
+
+        a = gravity.accelerations(pos, mass, eps, theta=theta)
+        errors[theta] = np.sqrt(((a - a_direct)**2).sum(1))/norm
+
+    ok = (errors[0.0].max() < tolerances['gravity_exact']) and \
+    (np.median(errors[0.7]) < tolerances['gravity_median'])
+    message = 'theta=0 max error {0:.1e}, theta=0.7 median error {1:.1e} '\
+    '(max {2:.1e})'.format(errors[0.0].max(), np.median(errors[0.7]), \
+    errors[0.7].max())
+
+    return ok, message
+
+def check_smooth_rho(n=2000, n_smooth=32, seed=0):
+    """
+    Writes a tipsy file of a disk of n particles, sets its gas rho and eps as
+    make_snapshot does, and compares the densities read back from the file
+    to smooth.smooth
+    """
+    pos, mass, eps = _disk(n, seed)
+    pos_unit = pynbody.units.au
+    m_unit = pynbody.units.Msol
+    v_unit = pynbody.units.Unit('km s**-1')
+    T_unit = pynbody.units.K
+    work_dir = tempfile.mkdtemp(prefix='ICgen_checks_')
+    filename = os.path.join(work_dir, 'check.std')
+
+    try:
+
+        tipsy_io.write(filename, n_gas=n, n_star=1, gas={'pos': pos, \
+        'mass': mass, 'eps': eps, 'temp': 100.0}, star={'mass': 1.0, \
+        'eps': 0.1}, time=1.0)
+        snapshot = make_snapshot._load_snapshot(filename, pos_unit, v_unit, \
+        m_unit, T_unit)
+        make_snapshot._smooth_snapshot(snapshot, filename, n_smooth, \
+        pos_unit, m_unit)
+        rho_file = tipsy_io.read(filename, 'gas', 'rho')
+        eps_file = tipsy_io.read(filename, 'gas', 'eps')
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    h, rho = smooth.smooth(SimArray(pos, 'au'), SimArray(mass, 'Msol'), \
+    n_smooth)
+    rho = np.asarray(rho.in_units('Msol au**-3'))
+    rho_error = abs(rho_file/rho - 1).max()
+    eps_error = abs(eps_file/(0.5*np.asarray(h.in_units('au'))) - 1).max()
+    ok = (rho_error < tolerances['smooth_rho']) and \
+    (eps_error < tolerances['smooth_rho'])
+    message = 'rho max error {0:.1e}, eps max error {1:.1e}'.format(\
+    rho_error, eps_error)
+
+    return ok, message
+
+def _disk(n, seed):
+    """
+    Positions (au), masses (Msol), and softening lengths (au) of a flared
+    disk of n particles between 0.5 and 10.5 au, with a total mass of 0.1
+    """
+    rs = np.random.RandomState(seed)
+    r = 10*np.sqrt(rs.rand(n)) + 0.5
+    theta = 2*np.pi*rs.rand(n)
+    z = 0.05*r*rs.randn(n)
+    pos = np.column_stack((r*np.cos(theta), r*np.sin(theta), z))
+    mass = 0.1*np.ones(n)/n
+    eps = 0.05*np.ones(n)
+
+    return pos, mass, eps
+
+_checks = {'gravity': check_gravity, 'smooth_rho': check_smooth_rho}
+_order = ['gravity', 'smooth_rho']
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Regression checks of '\
+    'ICgen (see checks.py)')
+    parser.add_argument('--only', nargs='+', choices=_order, default=None, \
+    help='only run these checks')
+    args = parser.parse_args()
+
+    if not run(args.only):
+
+        sys.exit(1)
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process Barnes-Hut tree code for calculating the gravitational
+accelerations of particles (ie for calc_velocity.v_xy), so ChaNGa isn't
+needed for the gravity.
+
+The tree is a balanced binary (kd) tree: every node is split at the median
+along its longest dimension, down to leaves of at most leaf_size particles.
+Nodes store their mass, center of mass, quadrupole moment, and the radius
+around the center of mass containing their particles (bmax).
+
+Accelerations are calculated for a leaf (a group of particles) at a time.  A
+node is used as a whole (monopole + quadrupole) if
+
+    d > bmax/theta  and  d > eps_group + eps_node
+
+where d is the distance from the node's center of mass to the group's
+bounding box, and eps are the largest softening lengths in the group and the
+node.  Otherwise it is opened, and leaves which are opened are summed over
+directly.  Forces between particles are softened with the spline kernel
+(as in ChaNGa/gasoline), using the mean of the two softening lengths: they
+are Newtonian beyond 2 eps.
+
+The walks and the force sums are vectorized over batches of groups, which
+are run on a multiprocessing pool.
+
+USAGE:
+
+    import gravity
+    # Accelerations of all the particles in a snapshot
+    a = gravity.accelerations(f['pos'], f['mass'], f['eps'], theta=0.7)
+    # Or just the gas
+    a = gravity.snapshot_accelerations(f, family='gas')
+"""
+
+# External packages
+import numpy as np
+import pynbody
+SimArray = pynbody.array.SimArray
+from multiprocessing import Pool, cpu_count
+
+# The tree being used by the pool (see accelerations)
+_tree = None
+# Maximum number of interactions (particle-node or particle-particle)
+# evaluated at once
+_max_chunk = int(2**20)
+
+class tree:
+    """
+    A balanced kd tree of particles (see the module doc-string).  Nodes are
+    stored as a heap: the children of node k are 2k+1 and 2k+2, and the
+    leaves are the last n_leaves nodes
+
+    * Arguments *
+
+    pos : array, shape (N, 3)
+    mass : array, shape (N,)
+    eps : array or float
+        Softening lengths
+    leaf_size : int
+        Maximum number of particles in a leaf
+
+    * Attributes *
+
+    order : array
+        Particles in tree order are pos[order]
+    x, m, eps : arrays
+        Positions, masses and softening lengths in tree order
+    bounds : array
+        Particles in leaf i are x[bounds[i]:bounds[i+1]]
+    """
+
+    def __init__(self, pos, mass, eps, leaf_size=16):
+
+        pos = np.asarray(pos, dtype=np.float64)
+        n = len(pos)
+        mass = np.asarray(mass, dtype=np.float64) * np.ones(n)
+        eps = np.asarray(eps, dtype=np.float64) * np.ones(n)
+
+        # Number of levels below the root
+        depth = 0
+
+        while n > leaf_size * 2**depth:
+
+            depth += 1
+
+        self.depth = depth
+        self.n_leaves = 2**depth
+        self.first_leaf = self.n_leaves - 1
+        self.leaf_size = int(np.ceil(n/float(self.n_leaves)))
+
+        # Sort the particles into the leaves, splitting a level at a time
+        order = np.arange(n)
+
+        for level in range(depth):
+
+            bounds = _level_bounds(n, level)
+            node = np.repeat(np.arange(2**level), np.diff(bounds))
+            x = pos[order]
+            lo = np.minimum.reduceat(x, bounds[0:-1], axis=0)
+            hi = np.maximum.reduceat(x, bounds[0:-1], axis=0)
+            axis = np.argmax(hi - lo, axis=1)
+            key = x[np.arange(n), axis[node]]
+            order = order[np.lexsort((key, node))]
+
+        self.order = order
+        self.x = pos[order]
+        self.m = mass[order]
+        self.eps = eps[order]
+        self.bounds = _level_bounds(n, depth)
+        self._moments()
+
+    def _moments(self):
+        """
+        Calculates the node properties, from the leaves up
+        """
+        n_nodes = 2*self.n_leaves - 1
+        self.mass = np.zeros(n_nodes)
+        self.com = np.zeros([n_nodes, 3])
+        # Quadrupoles (xx, yy, zz, xy, xz, yz)
+        self.quad = np.zeros([n_nodes, 6])
+        self.bmax = np.zeros(n_nodes)
+        self.eps_max = np.zeros(n_nodes)
+        self.lo = np.zeros([n_nodes, 3])
+        self.hi = np.zeros([n_nodes, 3])
+
+        # Leaves
+        start = self.bounds[0:-1]
+        leaves = slice(self.first_leaf, n_nodes)
+        x = self.x
+        m = self.m
+        mass = np.add.reduceat(m, start)
+        com = np.add.reduceat(m[:,None] * x, start, axis=0)
+        com /= np.where(mass > 0, mass, 1.0)[:,None]
+        leaf = np.repeat(np.arange(self.n_leaves), np.diff(self.bounds))
+        dx = x - com[leaf]
+        r2 = (dx**2).sum(1)
+        self.mass[leaves] = mass
+        self.com[leaves] = com
+        self.quad[leaves] = np.add.reduceat(m[:,None] * _quad_terms(dx, r2), \
+        start, axis=0)
+        self.bmax[leaves] = np.sqrt(np.maximum.reduceat(r2, start))
+        self.eps_max[leaves] = np.maximum.reduceat(self.eps, start)
+        self.lo[leaves] = np.minimum.reduceat(x, start, axis=0)
+        self.hi[leaves] = np.maximum.reduceat(x, start, axis=0)
+
+        # Parents
+        for level in range(self.depth - 1, -1, -1):
+
+            k = np.arange(2**level - 1, 2**(level + 1) - 1)
+            c1 = 2*k + 1
+            c2 = 2*k + 2
+            m1 = self.mass[c1]
+            m2 = self.mass[c2]
+            mass = m1 + m2
+            com = (m1[:,None]*self.com[c1] + m2[:,None]*self.com[c2])
+            com /= np.where(mass > 0, mass, 1.0)[:,None]
+            quad = np.zeros([len(k), 6])
+            bmax = np.zeros(len(k))
+
+            for c, mc in ((c1, m1), (c2, m2)):
+                # Parallel axis theorem
+                d = self.com[c] - com
+                d2 = (d**2).sum(1)
+                quad += self.quad[c] + mc[:,None] * _quad_terms(d, d2)
+                bmax = np.maximum(bmax, np.sqrt(d2) + self.bmax[c])
+
+            self.mass[k] = mass
+            self.com[k] = com
+            self.quad[k] = quad
+            self.bmax[k] = bmax
+            self.eps_max[k] = np.maximum(self.eps_max[c1], self.eps_max[c2])
+            self.lo[k] = np.minimum(self.lo[c1], self.lo[c2])
+            self.hi[k] = np.maximum(self.hi[c1], self.hi[c2])
+
+    def walk(self, groups, theta):
+        """
+        Finds the nodes interacting with the leaves groups
+
+        Returns (group, node) pairs for the nodes used as a whole (far) and
+        for the leaves summed over directly (near).  group is the leaf
+        number, node is the heap index
+        """
+        group_node = groups + self.first_leaf
+        lo = self.lo[group_node]
+        hi = self.hi[group_node]
+        geps = self.eps_max[group_node]
+        # Pairs to check (index into groups, node)
+        g = np.arange(len(groups))
+        k = np.zeros(len(groups), dtype=int)
+        far = []
+        near = []
+
+        while len(g) > 0:
+
+            com = self.com[k]
+            d = np.maximum(lo[g] - com, 0) + np.maximum(com - hi[g], 0)
+            d = np.sqrt((d**2).sum(1))
+            accept = (d*theta > self.bmax[k]) & (d > geps[g] + self.eps_max[k])
+            far.append((g[accept], k[accept]))
+            is_leaf = (k >= self.first_leaf)
+            opened = ~accept & is_leaf
+            near.append((g[opened], k[opened]))
+            opened = ~accept & ~is_leaf
+            g = np.repeat(g[opened], 2)
+            k = (2*k[opened][:,None] + np.array([1, 2])).ravel()
+
+        far = [groups[np.concatenate([p[0] for p in far])], \
+        np.concatenate([p[1] for p in far])]
+        near = [groups[np.concatenate([p[0] for p in near])], \
+        np.concatenate([p[1] for p in near]) - self.first_leaf]
+
+        return far, near
+
+    def accelerations(self, groups, theta):
+        """
+        Returns the accelerations of the particles in the leaves groups (a
+        contiguous range of leaves), in tree order, with G = 1
+        """
+        far, near = self.walk(groups, theta)
+        g0 = groups[0]
+        size = self.leaf_size
+        acc = np.zeros([len(groups), size, 3])
+
+        # Use the far nodes as a whole
+        for g, k in _chunk_pairs(far, _max_chunk//size):
+
+            x, valid = self._leaf_particles(g)
+            dr = x - self.com[k][:,None,:]
+            r2 = (dr**2).sum(2)
+            r2[~valid] = 1.0
+            inv_r2 = 1.0/r2
+            inv_r = np.sqrt(inv_r2)
+            inv_r3 = inv_r*inv_r2
+            q = self.quad[k]
+            # Q.dr
+            qdr = np.empty(dr.shape)
+            qdr[...,0] = q[:,None,0]*dr[...,0] + q[:,None,3]*dr[...,1] \
+            + q[:,None,4]*dr[...,2]
+            qdr[...,1] = q[:,None,3]*dr[...,0] + q[:,None,1]*dr[...,1] \
+            + q[:,None,5]*dr[...,2]
+            qdr[...,2] = q[:,None,4]*dr[...,0] + q[:,None,5]*dr[...,1] \
+            + q[:,None,2]*dr[...,2]
+            drqdr = (dr*qdr).sum(2)
+            inv_r5 = inv_r3*inv_r2
+            a = -self.mass[k][:,None,None]*inv_r3[...,None]*dr \
+            + inv_r5[...,None]*qdr - 2.5*(drqdr*inv_r5*inv_r2)[...,None]*dr
+            a[~valid] = 0
+            _add_to_groups(acc, g - g0, a)
+
+        # Sum over the near leaves directly
+        for g, leaf in _chunk_pairs(near, _max_chunk//size**2):
+
+            x, valid = self._leaf_particles(g)
+            xs, svalid = self._leaf_particles(leaf)
+            ind = self._leaf_index(g)
+            sind = self._leaf_index(leaf)
+            dr = x[:,:,None,:] - xs[:,None,:,:]
+            r2 = (dr**2).sum(3)
+            h = 0.5*(self.eps[ind][:,:,None] + self.eps[sind][:,None,:])
+            w = self.m[sind][:,None,:] * softened_r3(r2, h)
+            w *= svalid[:,None,:]
+            a = -(w[...,None] * dr).sum(2)
+            a[~valid] = 0
+            _add_to_groups(acc, g - g0, a)
+
+        x, valid = self._leaf_particles(groups)
+
+        return acc[valid]
+
+    def _leaf_index(self, leaves):
+        """
+        Returns the (tree order) indices of the particles in leaves, padded
+        to leaf_size with the last particle
+        """
+        ind = self.bounds[leaves][:,None] + np.arange(self.leaf_size)
+
+        return np.minimum(ind, self.bounds[leaves + 1][:,None] - 1)
+
+    def _leaf_particles(self, leaves):
+        """
+        Returns the positions of the particles in leaves (padded, see
+        _leaf_index) and a mask of which are real
+        """
+        ind = self.bounds[leaves][:,None] + np.arange(self.leaf_size)
+        valid = ind < self.bounds[leaves + 1][:,None]
+
+        return self.x[self._leaf_index(leaves)], valid
+
+def accelerations(pos, mass, eps, theta=0.7, leaf_size=16, processes=None):
+    """
+    Calculates the gravitational accelerations of particles using a tree code
+    (see the module doc-string)
+
+    * Arguments *
+
+    pos : array or SimArray, shape (N, 3)
+    mass : array or SimArray, shape (N,)
+    eps : array, SimArray, or float
+        Gravitational softening lengths (in the units of pos)
+    theta : float
+        Opening angle.  Smaller is more accurate (and slower)
+    leaf_size : int
+        Maximum number of particles in a leaf
+    processes : int
+        Number of processes to use.  Default is the number of CPUs
+
+    * Output *
+
+    a : array or SimArray, shape (N, 3)
+        Accelerations.  If pos and mass are SimArrays, units are
+        G mass.units/pos.units**2, otherwise G = 1
+    """
+    global _tree
+
+    units = None
+
+    if pynbody.units.has_units(pos) and pynbody.units.has_units(mass):
+
+        units = pynbody.units.G * mass.units * pos.units**-2
+
+    if pynbody.units.has_units(eps) and pynbody.units.has_units(pos):
+
+        eps = eps.in_units(pos.units)
+
+    _tree = tree(pos, mass, eps, leaf_size)
+    # Batches of groups (contiguous leaves) handed to the processes
+    n_batch = max(1, _max_chunk//(16*_tree.leaf_size))
+    batches = [np.arange(i, min(i + n_batch, _tree.n_leaves)) \
+    for i in range(0, _tree.n_leaves, n_batch)]
+
+    if processes is None:
+
+        processes = cpu_count()
+
+    processes = min(processes, len(batches))
+    args = [(batch, theta) for batch in batches]
+
+    try:
+
+        if processes > 1:
+
+            pool = Pool(processes)
+            results = pool.map(_batch_accelerations, args)
+            pool.close()
+            pool.join()
+
+        else:
+
+            results = [_batch_accelerations(arg) for arg in args]
+
+        a = np.zeros([len(_tree.x), 3])
+        a[_tree.order] = np.concatenate(results)
+
+    finally:
+
+        _tree = None
+
+    if units is not None:
+
+        a = SimArray(a, units)
+
+    return a
+
+def snapshot_accelerations(f, family='gas', theta=0.7, leaf_size=16, \
+processes=None):
+    """
+    Calculates the gravitational accelerations (from all the particles) of
+    the particles of family in the snapshot f, using a tree code.  See
+    gravity.accelerations
+
+    Returns a SimArray, shape (len(f.family), 3)
+    """
+    a = accelerations(f['pos'], f['mass'], f['eps'], theta, leaf_size, \
+    processes)
+    family = pynbody.family.get_family(family)
+
+    return a[f._get_family_slice(family)]
+
+def direct(pos, mass, eps):
+    """
+    Calculates the accelerations of all the particles by direct summation,
+    with G = 1 (for testing the tree).  Uses O(N^2) memory
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64) * np.ones(len(pos))
+    eps = np.asarray(eps, dtype=np.float64) * np.ones(len(pos))
+    dr = pos[:,None,:] - pos[None,:,:]
+    r2 = (dr**2).sum(2)
+    h = 0.5*(eps[:,None] + eps[None,:])
+    w = mass[None,:] * softened_r3(r2, h)
+
+    return -(w[...,None] * dr).sum(1)
+
+def softened_r3(r2, eps):
+    """
+    The spline softened version of 1/r^3 (ie acceleration = -G m dr
+    softened_r3), Newtonian beyond r = 2 eps.  Is 0 where r = 0
+    """
+    r2 = np.asarray(r2, dtype=np.float64)
+    eps = np.asarray(eps, dtype=np.float64) * np.ones(r2.shape)
+    zero = (r2 <= 0)
+    r2 = np.where(zero, 1.0, r2)
+    r = np.sqrt(r2)
+    out = 1.0/(r*r2)
+    soft = (r < 2*eps)
+    u = r[soft]/eps[soft]
+    inner = (u < 1)
+    f = np.empty(u.shape)
+    ui = u[inner]
+    f[inner] = (4.0/3 - 1.2*ui**2 + 0.5*ui**3)/eps[soft][inner]**3
+    uo = u[~inner]
+    f[~inner] = out[soft][~inner]*(-1.0/15 + 8.0/3*uo**3 - 3*uo**4 \
+    + 1.2*uo**5 - uo**6/6.0)
+    out[soft] = f
+    out[zero] = 0
+
+    return out
+
+def _batch_accelerations(args):
+    # A wrapper for multiprocessing calls to tree.accelerations
+    groups, theta = args
+
+    return _tree.accelerations(groups, theta)
+
+def _level_bounds(n, level):
+    """
+    Particles in node j of level are [bounds[j], bounds[j+1]) (in tree order)
+    """
+    n_nodes = 2**level
+
+    return (np.arange(n_nodes + 1, dtype=np.int64) * n)//n_nodes
+
+def _quad_terms(dx, r2):
+    """
+    Per particle quadrupole terms 3 dx_i dx_j - r^2 delta_ij as (xx, yy, zz,
+    xy, xz, yz)
+    """
+    return np.column_stack((3*dx[:,0]**2 - r2, 3*dx[:,1]**2 - r2, \
+    3*dx[:,2]**2 - r2, 3*dx[:,0]*dx[:,1], 3*dx[:,0]*dx[:,2], \
+    3*dx[:,1]*dx[:,2]))
+
+def _chunk_pairs(pairs, n):
+    """
+    Yields the (group, node) pairs sorted by group, n at a time
+    """
+    g, k = pairs
+    order = np.argsort(g, kind='mergesort')
+    g = g[order]
+    k = k[order]
+    n = max(int(n), 1)
+
+    for i in range(0, len(g), n):
+
+        yield g[i:i+n], k[i:i+n]
+
+def _add_to_groups(acc, g, a):
+    """
+    Adds the accelerations a (one per pair) to acc[g].  g is sorted
+    """
+    start = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    acc[g[start]] += np.add.reduceat(a, start, axis=0)
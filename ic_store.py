@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of the arrays in saved initial conditions (see ICgen.save).
+
+The IC file itself (ie IC.p) is a small pickled dictionary.  The arrays in it
+(sigma, CDF, rho, and the positions) are stored as separate columns in a
+directory next to the IC file (ie IC_data/), one .npy file per array, and are
+replaced in the dictionary by column objects which point to them.
+
+.npy columns are read as (read-only) memory maps, so only the parts of an
+array which are used are read from disk.  Columns can optionally be compressed (.npz), in
+which case they are read fully.  Columns are written in chunks (see
+_write_chunk) so that memory-mapped arrays are never fully loaded, and are
+written to a temporary file first so an interrupted save never leaves a
+partially written column.
+
+Arrays which are already memory-mapped from their column file (ie positions
+generated with pos_gen.chunk_size set, see pos_class) aren't re-written.
+"""
+# ICgen packages
+from ICglobal_settings import global_settings
+
+# External packages
+import pynbody
+SimArray = pynbody.array.SimArray
+import numpy as np
+import os
+import glob
+import tempfile
+
+# Number of elements written to a column at a time
+_write_chunk = int(2**22)
+
+class column:
+    """
+    Points to an array stored as a column of an IC file.  name is the file
+    name of the column (in the IC data directory) and units are the units of
+    the array (None if it isn't a SimArray)
+    """
+    
+    def __init__(self, name, units=None):
+        
+        self.name = name
+        self.units = units
+    
+    def load(self, directory, mmap_mode='r'):
+        """
+        Reads the column from directory.  .npy columns are memory-mapped with
+        mmap_mode (see numpy.load)
+        """
+        filename = os.path.join(directory, self.name)
+        
+        if not os.path.exists(filename):
+            
+            raise IOError, 'Could not find {0}'.format(filename)
+        
+        if filename.endswith('.npz'):
+            
+            npz = np.load(filename)
+            x = npz['data']
+            npz.close()
+        
+        else:
+            
+            x = np.load(filename, mmap_mode=mmap_mode)
+        
+        if self.units is not None:
+            
+            x = simarray_view(x, self.units)
+        
+        return x
+
+def data_dir(IC_file_name):
+    """
+    Returns the directory the arrays of IC_file_name are stored in
+    """
+    return os.path.splitext(IC_file_name)[0] + '_data'
+
+def write(x, directory, name, compress=False):
+    """
+    Replaces all the arrays in x (which can be an array or a dict/list of them)
+    by columns, written to directory and named after name (and their keys in
+    x).  Returns the new x
+    
+    * Arguments *
+    
+    x : array, dict, list, or tuple
+        Arrays to store
+    directory : str
+        Data directory of the IC file (see data_dir)
+    name : str
+        Name of the column (for dicts, '_key' is appended for every entry)
+    compress : bool
+        Save as compressed .npz files
+    
+    * Output *
+    
+    x : the same as x with arrays replaced by column objects
+    """
+    if isinstance(x, np.ndarray) and (x.ndim > 0):
+        
+        return write_column(x, directory, name, compress)
+    
+    elif isinstance(x, dict):
+        
+        return dict([(key, write(val, directory, '{0}_{1}'.format(name, key), \
+        compress)) for key, val in x.iteritems()])
+    
+    elif isinstance(x, (list, tuple)):
+        
+        return type(x)([write(val, directory, '{0}_{1}'.format(name, i), \
+        compress) for i, val in enumerate(x)])
+    
+    return x
+
+def read(x, directory, mmap_mode='r'):
+    """
+    The inverse of write: replaces all the columns in x by the arrays they
+    point to (see column.load)
+    """
+    if isinstance(x, column):
+        
+        return x.load(directory, mmap_mode)
+    
+    elif isinstance(x, dict):
+        
+        return dict([(key, read(val, directory, mmap_mode)) \
+        for key, val in x.iteritems()])
+    
+    elif isinstance(x, (list, tuple)):
+        
+        return type(x)([read(val, directory, mmap_mode) for val in x])
+    
+    return x
+
+def write_column(x, directory, name, compress=False):
+    """
+    Writes the array x to directory as the column name and returns a column
+    object pointing to it
+    """
+    units = getattr(x, 'units', None)
+    
+    if isinstance(units, pynbody.units.NoUnit):
+        
+        units = None
+    
+    ext = '.npz' if compress else '.npy'
+    filename = os.path.join(directory, name + ext)
+    
+    if not os.path.isdir(directory):
+        
+        os.makedirs(directory)
+    
+    if (not compress) and _is_mapped_from(x, filename):
+        
+        # Already stored
+        _flush(x)
+        
+        return column(name + ext, units)
+    
+    fd, tmpname = tempfile.mkstemp(suffix=ext, dir=directory)
+    os.close(fd)
+    
+    try:
+        
+        if compress:
+            
+            f = open(tmpname, 'wb')
+            np.savez_compressed(f, data=np.asarray(x))
+            f.close()
+        
+        else:
+            
+            out = np.lib.format.open_memmap(tmpname, mode='w+', \
+            dtype=x.dtype, shape=x.shape)
+            out_flat = out.reshape(-1)
+            x_flat = np.asarray(x).reshape(-1)
+            
+            for i in range(0, x.size, _write_chunk):
+                
+                out_flat[i:i+_write_chunk] = x_flat[i:i+_write_chunk]
+            
+            out.flush()
+            del out, out_flat
+        
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, filename)
+    
+    except:
+        
+        if os.path.exists(tmpname):
+            
+            os.remove(tmpname)
+        
+        raise
+    
+    return column(name + ext, units)
+
+def load_column(IC_file_name, name, mmap_mode='r'):
+    """
+    Reads the single column name (ie 'pos_xyz') of a saved IC without loading
+    anything else.  By default it is memory-mapped read-only, so slices of it
+    can be read without reading the whole array
+    """
+    directory = data_dir(IC_file_name)
+    
+    for ext in ('.npy', '.npz'):
+        
+        if os.path.exists(os.path.join(directory, name + ext)):
+            
+            return column(name + ext).load(directory, mmap_mode)
+    
+    raise IOError, 'Could not find column {0} in {1}'.format(name, directory)
+
+def clean(directory, x):
+    """
+    Deletes the column files in directory which aren't used by x (columns
+    from previous saves)
+    """
+    used = set([col.name for col in _columns(x)])
+    
+    for filename in glob.glob(os.path.join(directory, '*.np[yz]')):
+        
+        if os.path.basename(filename) not in used:
+            
+            os.remove(filename)
+
+def simarray_view(x, units):
+    """
+    Returns a SimArray view of x with units (without copying x, unlike
+    isaac.set_units)
+    """
+    x = x.view(SimArray)
+    x.units = units
+    
+    return x
+
+def compress_default():
+    """
+    Whether ICs are saved with compressed columns by default
+    """
+    return global_settings['ic_store']['compress']
+
+def _columns(x):
+    """
+    Returns a list of all the columns in x
+    """
+    if isinstance(x, column):
+        
+        return [x]
+    
+    elif isinstance(x, dict):
+        
+        x = x.values()
+    
+    elif not isinstance(x, (list, tuple)):
+        
+        return []
+    
+    return sum([_columns(val) for val in x], [])
+
+def _memmap_base(x):
+    """
+    Returns the np.memmap x is a view of (or None)
+    """
+    while x is not None:
+        
+        if isinstance(x, np.memmap):
+            
+            return x
+        
+        x = getattr(x, 'base', None)
+    
+    return None
+
+def _is_mapped_from(x, filename):
+    """
+    Checks whether the array x is all of the memory-mapped file filename
+    """
+    base = _memmap_base(x)
+    
+    if (base is None) or (getattr(base, 'filename', None) is None) \
+    or (not os.path.exists(filename)) or (base.mode == 'c'):
+        
+        return False
+    
+    try:
+        
+        same = os.path.samefile(base.filename, filename)
+    
+    except OSError:
+        
+        return False
+    
+    return same and (base.size == x.size) and (base.shape == x.shape)
+
+def _flush(x):
+    
+    _memmap_base(x).flush()
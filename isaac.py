@@ -20,6 +20,8 @@ import fnmatch
 import logging
 
 self_dir = os.path.dirname(os.path.realpath(__file__))
+# Size (bytes) of the blocks ChaNGa acceleration files are read in
+_acc_chunk_size = int(2**24)
 print os.path.realpath(__file__)
 
 def snapshot_defaults(snapshot):
@@ -223,7 +225,7 @@ def walltime(filename):
     return wall_per_step
     
 
-def load_acc(filename, param_name = None, low_mem = True):
+def load_acc(filename, param_name = None, low_mem = True, chunk_size = None):
     """
     Loads accelerations from a ChaNGa acceleration file (.acc2), ignoring the
     star particle.
@@ -235,8 +237,14 @@ def load_acc(filename, param_name = None, low_mem = True):
         length unit: AU
         mass unit  : Msol
         
-    Setting low_mem=True decreases memory usage by about 2x but also increases
-    readtime by about 2x
+    ASCII files are read in blocks of chunk_size bytes (default 
+    isaac._acc_chunk_size), which are parsed directly into one float32 array.
+    Memory use is therefore the array plus one block.  Setting low_mem=False
+    reads the file as a single block instead (slightly faster, but the whole
+    file is held in memory)
+    
+    Binary (XDR) acceleration files, as written by ChaNGa with binary output
+    enabled, are detected automatically and read directly
     """
     
     if param_name is None:
@@ -279,30 +287,138 @@ def load_acc(filename, param_name = None, low_mem = True):
     t_unit = ((l_unit**3) * G**-1 * m_unit**-1)**(1,2)
     a_unit = l_unit * t_unit**-2
     
-    if low_mem:
+    if chunk_size is None:
+        
+        chunk_size = _acc_chunk_size
+        
+    if not low_mem:
+        
+        chunk_size = None
+        
+    acc_file = open(filename, 'rb')
     
-        acc_file = open(filename, 'r')
-        n_particles = int(acc_file.readline().strip())
-        acc = SimArray(np.zeros(3*n_particles, dtype=np.float32), a_unit)
+    try:
         
-        for i, line in enumerate(acc_file):
+        if _acc_is_binary(acc_file):
             
-            acc[i] = np.float32(line.strip())
+            acc = _read_acc_binary(acc_file)
             
-        acc_file.close()
+        else:
             
-        return acc.reshape([n_particles, 3], order='F')[0:-1]
+            acc = _read_acc_ascii(acc_file, chunk_size)
+            
+    finally:
+        
+        acc_file.close()
+        
+    n_particles = len(acc)/3
+    acc = SimArray(acc, a_unit)
+    
+    return acc.reshape([n_particles, 3], order='F')[0:-1]
+    
+def _acc_is_binary(acc_file):
+    """
+    Checks whether an open acceleration file is binary.  ASCII files start 
+    with the number of particles on its own line.  The file position is left
+    at the start
+    """
+    header = acc_file.read(64)
+    acc_file.seek(0)
+    line = header.split('\n')[0].strip()
+    
+    return not ((len(line) > 0) and line.isdigit())
+    
+def _read_acc_binary(acc_file):
+    """
+    Reads a binary acceleration file: a big-endian int (the number of 
+    particles) followed by 3 big-endian floats or doubles per particle (all the
+    x, then y, then z components).  Returns a flat float32 array
+    """
+    n_particles = int(np.fromfile(acc_file, dtype='>i4', count=1)[0])
+    start = acc_file.tell()
+    acc_file.seek(0, os.SEEK_END)
+    n_bytes = acc_file.tell() - start
+    acc_file.seek(start)
+    n_values = 3*n_particles
+    
+    if n_bytes == 4*n_values:
+        
+        dtype = '>f4'
+        
+    elif n_bytes == 8*n_values:
+        
+        dtype = '>f8'
         
     else:
         
-        # Load acceleration file as numpy array
-        acc = np.genfromtxt(filename, skip_header=1, dtype=np.float32)
-        n_particles = len(acc)/3
+        raise IOError, 'Binary acceleration file has {0} bytes of data, '\
+        'which does not match {1} particles'.format(n_bytes, n_particles)
+        
+    acc = np.fromfile(acc_file, dtype=dtype, count=n_values)
+    
+    return acc.astype(np.float32)
+    
+def _read_acc_ascii(acc_file, chunk_size=None):
+    """
+    Reads an ASCII acceleration file (the number of particles, then one value
+    per line) into a flat float32 array.  The file is read in blocks of 
+    chunk_size bytes (all at once if None), each of which is split at its
+    last newline and parsed in one vectorized call
+    """
+    n_particles = int(acc_file.readline().strip())
+    n_values = 3*n_particles
+    acc = np.zeros(n_values, dtype=np.float32)
+    i = 0
+    leftover = ''
+    
+    while True:
+        
+        if chunk_size is None:
+            
+            block = acc_file.read()
+            
+        else:
+            
+            block = acc_file.read(chunk_size)
+            
+        if len(block) == 0:
+            
+            text = leftover
+            leftover = ''
+            
+        else:
+            
+            # Only parse complete lines
+            end = block.rfind('\n') + 1
+            
+            if end == 0:
+                
+                leftover += block
+                continue
+            
+            text = leftover + block[0:end]
+            leftover = block[end:]
+            
+        values = np.fromstring(text, dtype=np.float32, sep=' ')
+        
+        if i + len(values) > n_values:
+            
+            raise IOError, 'Acceleration file has more than {0} values'\
+            .format(n_values)
+            
+        acc[i:i + len(values)] = values
+        i += len(values)
+        
+        if len(block) == 0:
+            
+            break
+            
+    if i != n_values:
         
-        # Reshape and make it a SimArray with proper units
-        acc = SimArray(acc.reshape([n_particles, 3], order='F'), a_unit)
+        raise IOError, 'Acceleration file has {0} values, expected {1}'\
+        .format(i, n_values)
         
-        return acc
+    return acc
     
 def height(snapshot, bins=100, center_on_star=True):
     """
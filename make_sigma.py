@@ -9,6 +9,7 @@ Created on Mon Jan 27 13:00:52 2014
 """
 # ICgen packages
 import isaac
+import timing
 
 # External packages
 import pynbody
@@ -16,7 +17,7 @@ SimArray = pynbody.array.SimArray
 
 import numpy as np
 from scipy.interpolate import interp1d
-from scipy.integrate import quad
+from scipy.interpolate import make_interp_spline
 from scipy.integrate import simps
 import copy as copier
 
@@ -48,9 +49,19 @@ class sigma_gen:
     def __init__(self, r_bins, sigmaBinned, CDF=None):
         
         self.input_dict = {'r': r_bins, 'sigma': sigmaBinned}
-        self._make_sigma(r_bins, sigmaBinned)
-        self._make_pdf()
-        self._make_cdf_inv(CDF)
+        
+        with timing.stage('spline'):
+            
+            self._make_sigma(r_bins, sigmaBinned)
+            
+        with timing.stage('pdf'):
+            
+            self._make_pdf()
+            
+        with timing.stage('cdf_inv'):
+            
+            self._make_cdf_inv(CDF)
+            
         self._disk_mass()
         
     def __call__(self, r):
@@ -157,7 +168,9 @@ class sigma_gen:
         callable method and saves to self.cdf_inv
         
         The CDF_inv is made by cumulatively integrating the PDF over the radial
-        bins defined in self.r_bins
+        bins defined in self.r_bins.  The PDF is a cubic spline, so this is
+        done exactly (in one pass) by evaluating the antiderivative of the
+        spline at the bins.
         
         The optional argument, f, is the CDF binned over the radial bins
             
@@ -165,17 +178,14 @@ class sigma_gen:
         print 'calculating CDF'
         # Calculate the CDF from prob
         r = self.r_bins
+        # The pdf spline starts at the first bin (it is 0 below that)
+        r0 = float(r[0])
         r[0] = 0.0
         nr = len(r)
         
         if f is None:
             
-            f = np.zeros(nr)
-            
-            for n in range(nr):
-                
-                f[n] = quad(self.pdf,r[[0]],r[[n]])[0]
-                
+            f = self._integrate_pdf(r, r0)
             f /= f.max()
         
         self._CDF = f.copy()
@@ -188,9 +198,7 @@ class sigma_gen:
         r = r[ind]
         # Drop values where CDF is constant (ie, prob = 0)
         mask = np.ones(nr,dtype='bool')
-        for n in range(1,nr):
-            if f[n] == f[n-1]:
-                mask[n] = False
+        mask[1:] = (f[1:] != f[0:-1])
         f = f[mask]
         r = r[mask]
         finv = interp1d(f,r,kind='linear')
@@ -215,6 +223,25 @@ class sigma_gen:
             return r_out
         
         self.cdf_inv = finv_fcn
+        
+    def _integrate_pdf(self, r, r0):
+        """
+        Integrates the PDF from 0 to every r.  The PDF is zero outside of the
+        bins (r0 to max(r_bins)), where it is the cubic spline made by
+        _make_pdf.  The same spline (not-a-knot, as used by interp1d) is
+        rebuilt from the PDF at the bins and its antiderivative evaluated at r
+        """
+        r = np.asarray(r, dtype=float)
+        r_bins = r.copy()
+        r_bins[0] = r0
+        pdf_bins = np.asarray(self.pdf(r_bins))
+        
+        pdf_spline = make_interp_spline(r_bins, pdf_bins, k=3)
+        cdf_spline = pdf_spline.antiderivative()
+        
+        r_clip = np.clip(r, r_bins[0], r_bins[-1])
+        
+        return cdf_spline(r_clip) - cdf_spline(r_bins[0])
             
     def _disk_mass(self):
         """
@@ -13,9 +13,14 @@ SimArray = pynbody.array.SimArray
 import numpy as np
 import gc
 import os
+import tempfile
 
 import isaac
 import calc_velocity
+import potential
+import smooth
+import tipsy_io
+import timing
 import ICgen_utils
 import ICglobal_settings
 global_settings = ICglobal_settings.global_settings
@@ -28,6 +33,10 @@ def snapshot_gen(ICobj):
     
         snapshot: tipsy snapshot
         param: dictionary containing info for a .param file
+        
+    The snapshot is written once, to settings.filenames.snapshotName, and is
+    loaded from there.  Later changes (velocities, eps, tform) are written to
+    the file in place, so it is up to date when snapshot_gen returns
     """
     
     print 'Generating snapshot...'
@@ -68,8 +77,8 @@ def snapshot_gen(ICobj):
     pos_unit = r.units
     
     if xyz.units != r.units:
-        
-        xyz.convert_units(pos_unit)
+        # A copy (the positions may be memory-mapped read-only)
+        xyz = xyz.in_units(pos_unit)
         
     # time units are sqrt(L^3/GM)
     t_unit = np.sqrt((pos_unit**3)*np.power((G*m_unit), -1)).units
@@ -85,24 +94,25 @@ def snapshot_gen(ICobj):
     # -------------------------------------------------
     # Initialize snapshot
     # -------------------------------------------------
-    # Note that empty pos, vel, and mass arrays are created in the snapshot
-    snapshot = pynbody.new(star=1,gas=nParticles)
-    snapshot['vel'].units = v_unit
-    snapshot['eps'] = 0.01*SimArray(np.ones(nParticles+1, dtype=np.float32), pos_unit)
-    snapshot['metals'] = SimArray(np.zeros(nParticles+1, dtype=np.float32))
-    snapshot['rho'] = SimArray(np.zeros(nParticles+1, dtype=np.float32))
-    
-    snapshot.gas['pos'] = xyz
-    snapshot.gas['temp'] = ICobj.T(r)
-    snapshot.gas['mass'] = m_particles
-    snapshot.gas['metals'] = metals
-    
-    snapshot.star['pos'] = SimArray([[ 0.,  0.,  0.]],pos_unit)
-    snapshot.star['vel'] = SimArray([[ 0.,  0.,  0.]], v_unit)
-    snapshot.star['mass'] = m_star
-    snapshot.star['metals'] = SimArray(star_metals)
+    # Write the tipsy file straight from the particle positions (in chunks,
+    # see tipsy_io) then load it.  Velocities are zero until calc_velocity
+    T_unit = ICobj.T(r[[0]]).units
+    gas = {'pos': xyz, \
+    'mass': float(m_particles.in_units(m_unit)), \
+    'temp': lambda i0, i1: ICobj.T(r[i0:i1]), \
+    'eps': 0.01, \
+    'metals': metals}
     # Estimate the star's softening length as the closest particle distance
-    snapshot.star['eps'] = r.min()
+    star = {'mass': float(m_star), \
+    'metals': star_metals, \
+    'eps': float(r.min())}
+    # (time=1 is the expansion factor pynbody writes for new snapshots)
+    with timing.stage('tipsy_write', filename=snapshotName):
+        
+        tipsy_io.write(snapshotName, n_gas=nParticles, n_star=1, gas=gas, \
+        star=star, time=1.0)
+        
+    snapshot = _load_snapshot(snapshotName, pos_unit, v_unit, m_unit, T_unit)
     
     # Make param file
     param = isaac.make_param(snapshot, snapshotName)
@@ -120,24 +130,62 @@ def snapshot_gen(ICobj):
     
     # -------------------------------------------------
     # CALCULATE VELOCITY USING calc_velocity.py.  This also estimates the 
-    # gravitational softening length eps
+    # gravitational softening length eps (unless it is estimated here, see
+    # smooth.py)
     # -------------------------------------------------
     print 'Calculating circular velocity'
     preset = settings.changa_run.preset
     max_particles = global_settings['misc']['max_particles']
-    calc_velocity.v_xy(snapshot, param, changa_preset=preset, max_particles=max_particles)
+    est_eps = True
+    
+    if settings.snapshot.smooth not in ('changa', 'tree'):
+        
+        raise ValueError, 'Unknown smooth method {0}'\
+        .format(settings.snapshot.smooth)
+    
+    if settings.snapshot.smooth == 'tree':
+        # Per-particle eps from smoothing lengths found in-process (instead 
+        # of by ChaNGa in calc_velocity), which also gives the SPH density
+        with timing.stage('smooth'):
+            
+            _smooth_snapshot(snapshot, snapshotName, param.get('nSmooth', 32), \
+            pos_unit, m_unit)
+            
+        est_eps = False
+        
+    field = None
+    
+    if settings.snapshot.gravity == 'grid':
+        # Gravitational field of the disk and star from sigma and rho
+        with timing.stage('disk_field'):
+            
+            field = potential.disk_field(ICobj)
+            
+    support = None
+    
+    if settings.snapshot.pressure == 'grid':
+        
+        support = calc_velocity.pressure_support(ICobj)
+            
+    with timing.stage('v_xy'):
+        
+        calc_velocity.v_xy(snapshot, param, changa_preset=preset, \
+        max_particles=max_particles, est_eps=est_eps, filename=snapshotName, \
+        gravity=settings.snapshot.gravity, theta=settings.snapshot.theta, \
+        field=field, pressure=settings.snapshot.pressure, support=support)
     
     gc.collect()
     
     # -------------------------------------------------
     # Estimate time step for changa to use
     # -------------------------------------------------
-    # Save param file
+    # Save param file (the snapshot file is already up to date)
     isaac.configsave(param, paramName, 'param')
-    # Save snapshot
-    snapshot.write(filename=snapshotName, fmt=pynbody.tipsy.TipsySnap)
     # est dDelta
-    dDelta = ICgen_utils.est_time_step(paramName, preset)
+    with timing.stage('est_time_step'):
+        
+        dDelta = ICgen_utils.est_time_step(paramName, preset)
+        
     param['dDelta'] = dDelta
     
     # -------------------------------------------------
@@ -161,6 +209,7 @@ def snapshot_gen(ICobj):
     # Now set the star particle's tform to a negative number.  This allows
     # UW ChaNGa treat it as a sink particle.
     snapshot.star['tform'] = -1.0
+    tipsy_io.patch(snapshotName, 'star', {'tform': -1.0})
     
     # Update params
     r_sink = isaac.strip_units(r.min())
@@ -170,3 +219,50 @@ def snapshot_gen(ICobj):
     param['bDoSinks'] = 1
     
     return snapshot, param, director
+
+def _smooth_snapshot(snapshot, filename, n_smooth, pos_unit, m_unit):
+    """
+    Sets the gas eps (half the smoothing length) and rho of snapshot using
+    smooth.py, and writes them (in code units: pos_unit, m_unit) to the tipsy
+    file filename, which is checked by reading rho back
+    """
+    smooth.snapshot_smooth(snapshot, 'gas', n_smooth)
+    snapshot.g['eps'] = snapshot.g['smooth']/2
+    rho = snapshot.g['rho'].in_units(m_unit*pos_unit**-3)
+    tipsy_io.patch(filename, 'gas', {'rho': rho, \
+    'eps': snapshot.g['eps'].in_units(pos_unit)})
+    
+    if not np.allclose(tipsy_io.read(filename, 'gas', 'rho'), rho, \
+    rtol=1e-5):
+        
+        raise RuntimeError, 'Gas densities in {0} do not match the '\
+        'calculated densities'.format(filename)
+    
+def _load_snapshot(filename, pos_unit, v_unit, m_unit, T_unit):
+    """
+    Loads a tipsy snapshot written by tipsy_io and sets the units of its
+    arrays.  A minimal .param file is passed to pynbody so that it doesn't
+    use (possibly stale) .param files it finds in the directory
+    """
+    fd, paramfile = tempfile.mkstemp(suffix='.param')
+    f = os.fdopen(fd, 'w')
+    f.write('dKpcUnit = 1\ndMsolUnit = 1\n')
+    f.close()
+    
+    try:
+        
+        snapshot = pynbody.load(filename, paramfile=paramfile)
+        
+    finally:
+        
+        os.remove(paramfile)
+        
+    for key, units in (('pos', pos_unit), ('vel', v_unit), ('mass', m_unit), \
+    ('eps', pos_unit)):
+        
+        snapshot[key].units = units
+        
+    snapshot.gas['temp'].units = T_unit
+    snapshot.gas['rho'].units = m_unit*pos_unit**-3
+    
+    return snapshot
@@ -18,10 +18,16 @@ __iversion__ = int(filter(str.isdigit,__version__))
 import pynbody
 SimArray = pynbody.array.SimArray
 import numpy as np
+import os
 
 # ICgen packages
 import isaac
 import ICgen_utils
+import ic_store
+
+# Number of spiral grid steps summed directly (with np.cumsum) in
+# _spiral_theta before being added onto the compensated running sum
+_theta_block = 1024
 
 class pos:
     """
@@ -33,6 +39,10 @@ class pos:
     
     ICobj should be an initial conditions object (ICgen.IC) with rho already
     calculated.
+    
+    If ICobj.settings.pos_gen.chunk_size is set, positions are generated
+    chunk_size particles at a time and r, xyz are stored in memory-mapped
+    .npy files (see _npy_filename) rather than in memory.
 
     """
     
@@ -67,15 +77,7 @@ class pos:
         self.nParticles, self.method)
         
         # Generate positions
-        self._generate_r()
-        self.xyz = SimArray(np.zeros([self.nParticles, 3], dtype=np.float32), self.r.units)
-        self._generate_z()
-        self._generate_theta()
-        self._cartesian_pos()
-        
-        # To save on memory, delete theta.  It can be re-calculated later
-        # if absolutely needed
-        del self.theta
+        self._generate(ICobj.settings.pos_gen.chunk_size)
         
     def __getstate__(self):
         """
@@ -86,11 +88,17 @@ class pos:
         # Ignore self.parent
         state = self.__dict__.copy()
         state.pop('_parent', None)
+        memmap_files = state.get('_memmap_files', {})
         
         # Now handle the possibly large arrays (too large to pickle)
         for key,val in state.iteritems():
             
-            if isinstance(val, np.ndarray):
+            if key in memmap_files:
+                
+                # Memory-mapped arrays are already on disk
+                state[key] = _npy_file(memmap_files[key], val.units)
+                
+            elif isinstance(val, np.ndarray):
                 
                 state[key] = ICgen_utils.listify(val, 1001)
                 
@@ -106,89 +114,270 @@ class pos:
                 
                 d[key] = val.delistify()
                 
+            elif isinstance(val, _npy_file):
+                
+                d[key] = val.load()
+                
         self.__dict__ = d
         
+    def _generate(self, chunk_size=None):
+        """
+        Generates r and xyz, chunk_size particles at a time.  If chunk_size is
+        None, everything is done in one chunk and stored in memory.  Otherwise
+        r and xyz are memory-mapped .npy files, so that memory use is set by
+        chunk_size rather than nParticles
+        """
+        
+        nParticles = self.nParticles
+        units = self._parent.sigma.r_bins.units
+        
+        if chunk_size is None:
+            
+            chunk_size = nParticles
+            self.r = SimArray(np.zeros(nParticles, dtype=np.float32), units)
+            self.xyz = SimArray(np.zeros([nParticles, 3], dtype=np.float32), units)
+            self._memmap_files = {}
+            memmaps = []
+            
+        else:
+            
+            chunk_size = int(chunk_size)
+            self._memmap_files = {'r': self._npy_filename('r'), \
+            'xyz': self._npy_filename('xyz')}
+            print 'Storing positions in {0} and {1}'.format(\
+            self._memmap_files['r'], self._memmap_files['xyz'])
+            
+            for filename in self._memmap_files.values():
+                # Unlink old files (rather than overwriting them) in case
+                # they are still memory-mapped
+                if os.path.exists(filename):
+                    
+                    os.remove(filename)
+                    
+            memmaps = [np.lib.format.open_memmap(self._memmap_files['r'], \
+            mode='w+', dtype=np.float32, shape=(nParticles,)), \
+            np.lib.format.open_memmap(self._memmap_files['xyz'], mode='w+', \
+            dtype=np.float32, shape=(nParticles, 3))]
+            self.r, self.xyz = [ic_store.simarray_view(x, units) \
+            for x in memmaps]
+            
+        streams = self._random_streams(chunk_size)
+        # Last r and theta (see _spiral_theta) of the previous chunk, needed
+        # for the spiral grid
+        r_prev = None
+        theta_carry = (0.0, 0.0)
+        
+        for i0 in range(0, nParticles, chunk_size):
+            
+            i1 = min(i0 + chunk_size, nParticles)
+            
+            if i1 - i0 < nParticles:
+                
+                print 'Generating particles {0} to {1}'.format(i0, i1)
+            
+            r = self._generate_r(i0, i1, streams)
+            self.r[i0:i1] = r
+            self.xyz[i0:i1,2] = self._generate_z(r, streams)
+            theta, theta_carry = self._generate_theta(r, streams, r_prev, \
+            theta_carry)
+            self._cartesian_pos(r, theta, i0, i1)
+            
+            r_prev = r[-1]
+            
+        for x in memmaps:
+            
+            x.flush()
+            
+    def _npy_filename(self, key):
+        """
+        Filename of the memory-mapped .npy file for array self.key.  This is
+        its column in the data directory of the IC file (see ic_store.py), so
+        it doesn't need to be copied when the ICs are saved
+        """
+        
+        IC_file_name = self._parent.settings.filenames.IC_file_name
+        directory = ic_store.data_dir(IC_file_name)
+        
+        if not os.path.isdir(directory):
+            
+            os.makedirs(directory)
+        
+        return os.path.join(directory, 'pos_{0}.npy'.format(key))
+        
+    def _random_streams(self, chunk_size):
+        """
+        Makes the random number generators used for r, z, the sign of z, and
+        theta.  For a given seed these give the same numbers that seeding
+        np.random before generating all of r, z, and theta at once does.
+        """
+        
+        seed = self._seed
+        streams = {}
+        
+        for key in ('r', 'z', 'sign', 'theta'):
+            
+            streams[key] = np.random.RandomState(seed)
+            
+        if seed is not None:
+            
+            # The z signs were drawn after the nParticles z random numbers
+            for i in range(0, self.nParticles, chunk_size):
+                
+                streams['sign'].rand(min(chunk_size, self.nParticles - i))
+                
+        return streams
     
-    def _generate_r(self):
+    def _generate_r(self, i0, i1, streams):
         """
-        Generate radial positions
+        Generate radial positions of particles i0 to i1
         """
         
-        print 'Generating r positions'
         cdf_inv_r = self._parent.sigma.cdf_inv
         
         if self.method == 'grid':
             
             # Generate linearly increasing values of m, using 2 more than
             # necessary to avoid boundary issues
-            m = np.linspace(0,1,self.nParticles + 2)
-            # Calculate r from inverse CDF
-            r = cdf_inv_r(m[1:-1]).astype(np.float32)
-            # Assign output
-            self.r = r
+            m = np.arange(i0 + 1, i1 + 1) * (1.0/(self.nParticles + 1))
             
         if self.method == 'random':
             
-            np.random.seed(self._seed)
-            m = np.random.rand(self.nParticles)
-            r = cdf_inv_r(m).astype(np.float32)
-            self.r = r
+            m = streams['r'].rand(i1 - i0)
+            
+        # Calculate r from inverse CDF
+        r = cdf_inv_r(m).astype(np.float32)
+        
+        return r
             
-    def _generate_z(self):
+    def _generate_z(self, r, streams):
         """
-        Generate z positions
+        Generate z positions at radii r
         """
         
-        print 'Generating z positions'
         # The inverse CDF over z as a function of r
         cdf_inv_z = self._parent.rho.cdf_inv
         # Random numbers between 0 and 1
-        np.random.seed(self._seed)
-        m = np.random.rand(self.nParticles)
+        m = streams['z'].rand(len(r))
         # Calculate z
-        z = cdf_inv_z(m, self.r)
+        z = cdf_inv_z(m, r)
         # Randomly select sign of z
-        z = z * np.random.choice(np.array([-1,1]), self.nParticles)
-        # Assign output
-        self.xyz[:,2] = z
+        z = z * streams['sign'].choice(np.array([-1,1]), len(r))
         
-    def _generate_theta(self):
-        """
-        Generate angular positions
+        return z
+        
+    def _generate_theta(self, r, streams, r_prev=None, carry=(0.0, 0.0)):
         """
+        Generate angular positions at radii r.  For the spiral grid, r_prev is
+        the radius of the particle before r[0] (if there is one) and carry is
+        its theta (see _spiral_theta).
         
-        nParticles = self.nParticles
+        Returns theta and the carry for the next chunk
+        """
         
         if self.method == 'grid':
             
-            r = self.r
+            if r_prev is not None:
+                
+                r = np.concatenate(([r_prev], r))
             
             dtheta = np.sqrt(2*np.pi*(1 - r[0:-1]/r[1:]))
             dtheta = isaac.strip_units(dtheta)
-            theta = np.zeros(nParticles)
+            # NOTE: it's import to subtract (not add) dtheta.  The particles
+            # will be moving counter-clockwise.  To prevent the particle
+            # spirals from kinking, the particle spirals must go out
+            # clockwise
+            theta, theta_carry = _spiral_theta(dtheta, carry)
             
-            for n in range(nParticles - 1):
-                
-                # NOTE: it's import to subtract (not add) dtheta.  The particles
-                # will be moving counter-clockwise.  To prevent the particle
-                # spirals from kinking, the particle spirals must go out
-                # clockwise
-                theta[n+1] = theta[n] - dtheta[n]
+            if r_prev is None:
                 
-            self.theta = theta
+                theta = np.concatenate(([carry[0]], theta))
             
         if self.method == 'random':
             
-            np.random.seed(self._seed)
-            theta = 2*np.pi*np.random.rand(nParticles)
-            self.theta = theta
+            theta = 2*np.pi*streams['theta'].rand(len(r))
+            theta_carry = carry
+            
+        return theta, theta_carry
             
-    def _cartesian_pos(self):
+    def _cartesian_pos(self, r, theta, i0, i1):
         """
-        Generate x,y
+        Generate x,y of particles i0 to i1
         """
         
-        r = self.r
-        theta = self.theta
-        self.xyz[:,0] = r*np.cos(theta)
-        self.xyz[:,1] = r*np.sin(theta)
+        self.xyz[i0:i1,0] = r*np.cos(theta)
+        self.xyz[i0:i1,1] = r*np.sin(theta)
+        
+def _spiral_theta(dtheta, carry=(0.0, 0.0)):
+    """
+    Calculates theta[n] = theta0 - (dtheta[0] + ... + dtheta[n]) for the
+    spiral grid.
+    
+    The steps are summed in blocks of _theta_block with np.cumsum and the block
+    totals are added onto a compensated (Kahan) running sum, which is kept
+    between 0 and -2 pi.  This keeps the rounding error from growing with the
+    number of particles.
+    
+    * Arguments *
+    
+    dtheta : array
+        Angular steps
+    carry : tuple
+        (theta0, compensation) of the running sum, as returned by a previous
+        call (for the particle before dtheta[0])
+    
+    * Output *
+    
+    theta : array
+        theta after every step (modulo 2 pi)
+    carry : tuple
+        Running sum after the last step, to pass on to the next call
+    """
+    
+    dtheta = np.asarray(dtheta, dtype=np.float64)
+    n = len(dtheta)
+    nblocks = -(-n // _theta_block)
+    block_sums = np.zeros(nblocks * _theta_block)
+    block_sums[0:n] = dtheta
+    block_sums = block_sums.reshape([nblocks, _theta_block]).cumsum(1)
+    
+    # Compensated running sum of theta at the start of each block
+    theta_sum, c = carry
+    offsets = np.zeros(nblocks)
+    
+    for i in range(nblocks):
+        
+        offsets[i] = theta_sum
+        y = -block_sums[i,-1] - c
+        t = theta_sum + y
+        c = (t - theta_sum) - y
+        # np.fmod is exact, so the compensation remains valid
+        theta_sum = np.fmod(t, 2*np.pi)
+        
+    theta = (offsets[:,None] - block_sums).ravel()[0:n]
+    
+    return theta, (theta_sum, c)
+        
+class _npy_file:
+    """
+    Points to an array stored in a .npy file (used to pickle memory-mapped
+    arrays without loading them)
+    """
+    
+    def __init__(self, filename, units=None):
+        
+        self.filename = filename
+        self.units = units
+        
+    def load(self):
+        """
+        Memory-maps the file (read-only, so the saved IC can't be changed by
+        accident) and returns it as a SimArray.  Copy it to change it
+        """
+        
+        if not os.path.exists(self.filename):
+            
+            raise IOError, 'Could not find {0}'.format(self.filename)
+            
+        x = np.load(self.filename, mmap_mode='r')
+        
+        return ic_store.simarray_view(x, self.units)
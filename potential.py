@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Calculates the gravitational field of an axisymmetric disk (plus the star)
+directly from its surface density (sigma) and vertical density profile
+(rho), without any particles.  Used by calc_velocity.v_xy (gravity='grid')
+to get circular velocities which are free of N-body noise.
+
+The disk is split into rings on a (z, r) grid.  Every radius r_j has a grid
+of heights from 0 to zmax(r_j) (the top of the rho grid, mirrored below the
+midplane), so the grid follows the flaring of the disk.  A column of rings
+has the mass of the annulus at r_j (from sigma, scaled to the total disk
+mass used for the particles) spread over z as rho(z, r_j).
+
+The radial acceleration due to a ring of mass m, radius a, and height z' at
+(r, z) is
+
+    a_r = (2 G m/pi) d/dr [K(k^2)/sqrt(D)]
+
+with D = (r + a)^2 + (z - z')^2 + s^2, k^2 = 4 a r/D and K the complete
+elliptic integral of the first kind.  The softening s (half the size of the
+ring's grid cell) stands in for the ring's cross section, which keeps the
+field finite at the rings themselves.  Summing over all the rings gives a_r
+on the same (z, r) grid, which is then interpolated in (|z|/zmax(r), r).  The
+star's field is steep near the axis, so it isn't put on the grid: it is
+added analytically when the field is evaluated.
+
+USAGE:
+
+    import potential
+    field = potential.disk_field(ICobj, nr=150, nz=40)
+    a_r = field.a_r(z, r)   # Radial acceleration (SimArray)
+    v = field.v_circ(z, r)  # Circular velocity
+"""
+
+# External packages
+import numpy as np
+import pynbody
+SimArray = pynbody.array.SimArray
+import scipy.special as special
+import scipy.interpolate as interp
+
+# ICgen packages
+import isaac
+
+# Maximum number of ring-point interactions evaluated at once
+_max_chunk = int(2**22)
+
+class disk_field:
+    """
+    The radial gravitational acceleration of a disk + star.  The disk's field
+    is calculated on a (z, r) grid (a_r_grid) and interpolated, the star's is
+    added analytically.  See the module doc-string
+
+    * Arguments *
+
+    ICobj : IC object
+        With sigma and rho generated
+    nr : int
+        Number of radii in the grid (spanning ICobj.rho.r_bins)
+    nz : int
+        Number of heights (from the midplane to zmax) at every radius
+    m_scale : float
+        Factor the disk mass is scaled by.  Default is
+        ICobj.settings.snapshot.mScale (as for the particle masses)
+    """
+
+    def __init__(self, ICobj, nr=150, nz=40, m_scale=None):
+
+        settings = ICobj.settings
+
+        if m_scale is None:
+
+            m_scale = settings.snapshot.mScale
+
+        rho = ICobj.rho
+        r_bins = isaac.match_units(rho.r_bins, 'au')[0]
+        r = SimArray(np.linspace(r_bins.min(), r_bins.max(), nr), 'au')
+        zmax = SimArray(_zmax(rho, r), rho.z_bins.units)
+        zmax.convert_units('au')
+        zeta = np.linspace(0, 1, nz)
+
+        m_disk = isaac.match_units(ICobj.sigma.m_disk, 'Msol')[0]
+        M_star = isaac.match_units(settings.physical.M, 'Msol')[0]
+        sigma = np.asarray(ICobj.sigma(r).in_units('Msol au**-2'))
+        z = zeta[:,None] * np.asarray(zmax)[None,:]
+        rho_grid = np.asarray(rho(SimArray(z, 'au'), r[None,:]))
+
+        a_r = radial_field(np.asarray(r), zeta, np.asarray(zmax), sigma, \
+        rho_grid, float(m_disk)*m_scale, 0.0)
+
+        if not np.isfinite(a_r).all():
+
+            raise ValueError, 'Disk field has {0} non-finite values'\
+            .format((~np.isfinite(a_r)).sum())
+
+        self.r = r
+        self.zeta = zeta
+        self.zmax = zmax
+        self.M_star = M_star
+        self.a_r_grid = SimArray(a_r, 'G Msol au**-2')
+        self._spline = interp.RectBivariateSpline(zeta, np.asarray(r), a_r)
+
+    def a_r(self, z, r):
+        """
+        Radial acceleration at (z, r).  The disk's part is interpolated from
+        the grid: points above zmax(r) are given the value at zmax(r), and
+        points outside of the r range the value at the edge.  The star's part
+        is exact
+        """
+        z = np.asarray(isaac.match_units(z, 'au')[0], dtype=float)
+        r = np.asarray(isaac.match_units(r, 'au')[0], dtype=float)
+        z, r = np.broadcast_arrays(z, r)
+        r_grid = np.asarray(self.r)
+        r_clip = np.clip(r, r_grid[0], r_grid[-1])
+        zeta = abs(z)/np.interp(r_clip, r_grid, np.asarray(self.zmax))
+        zeta = np.clip(zeta, 0, 1)
+        a = self._spline.ev(zeta.ravel(), r_clip.ravel()).reshape(r.shape)
+        a += star_a_r(r, z, float(self.M_star))
+
+        return SimArray(a, self.a_r_grid.units)
+
+    def v_circ(self, z, r):
+        """
+        Circular velocity sqrt(r |a_r|) at (z, r) in km/s
+        """
+        r = isaac.match_units(r, 'au')[0]
+        v = np.sqrt(abs(self.a_r(z, r)) * r)
+
+        return v.in_units('km s**-1')
+
+def radial_field(r, zeta, zmax, sigma, rho, m_disk, M_star):
+    """
+    Calculates the radial acceleration of a disk + star (G = 1) on a grid.
+    The grid points are also the positions of the rings (see the module
+    doc-string)
+
+    * Arguments *
+
+    r : array, shape (nr,)
+        Radii (uniformly spaced)
+    zeta : array, shape (nz,)
+        Heights as a fraction of zmax, from 0 to 1
+    zmax : array, shape (nr,)
+        Maximum height at every radius
+    sigma : array, shape (nr,)
+        Surface density at r
+    rho : array, shape (nz, nr)
+        Density at z = zeta*zmax, r (only its shape in z is used)
+    m_disk : float
+        Total mass of the disk
+    M_star : float
+        Mass of the star (at the origin)
+
+    * Output *
+
+    a_r : array, shape (nz, nr)
+        Radial acceleration at (zeta*zmax, r)
+    """
+    nz = len(zeta)
+    nr = len(r)
+    z = zeta[:,None] * zmax[None,:]
+
+    # Mirror the column below the midplane
+    z_full = np.concatenate([-z[:0:-1], z])
+    rho_full = np.concatenate([rho[:0:-1], rho])
+    # Mass of the rings: annulus masses (from sigma), distributed over z as
+    # rho (trapezoid weights)
+    w_r = _trapezoid_weights(r)
+    m_annulus = 2*np.pi*r*sigma*w_r
+    m_annulus *= m_disk/m_annulus.sum()
+    w_z = _trapezoid_weights(np.linspace(-1, 1, 2*nz - 1))
+    column = np.maximum(rho_full, 0) * w_z[:,None]
+    norm = column.sum(0)
+    column /= np.where(norm > 0, norm, 1.0)
+    m_ring = column * m_annulus
+    # Softening: half the size of the ring's cell
+    dr = r[1] - r[0] if nr > 1 else r[0]
+    dz = zmax * (zeta[1] - zeta[0]) if nz > 1 else zmax
+    soft2 = 0.25*(dr**2 + dz**2) * np.ones(z_full.shape)
+
+    # Source rings (only those with mass)
+    mask = m_ring > 0
+    a_src = (r * np.ones(z_full.shape))[mask]
+    z_src = z_full[mask]
+    m_src = m_ring[mask]
+    s2_src = soft2[mask]
+
+    # Targets
+    r_tgt = (r * np.ones(z.shape)).ravel()
+    z_tgt = z.ravel()
+    a_r = np.zeros(r_tgt.shape)
+    n_chunk = max(1, _max_chunk//max(len(m_src), 1))
+
+    for i in range(0, len(r_tgt), n_chunk):
+
+        sl = slice(i, i + n_chunk)
+        a_r[sl] = (m_src * ring_a_r(r_tgt[sl,None], z_tgt[sl,None], \
+        a_src, z_src, s2_src)).sum(1)
+
+    # The star
+    a_r += star_a_r(r_tgt, z_tgt, M_star)
+
+    return a_r.reshape(z.shape)
+
+def star_a_r(r, z, M_star):
+    """
+    Radial acceleration at (r, z) due to a point mass M_star at the origin
+    (with G = 1).  The radial field is 0 on the axis
+    """
+    r = np.asarray(r, dtype=float)
+    z = np.asarray(z, dtype=float)
+    a = np.zeros(np.broadcast(r, z).shape)
+    r, z = np.broadcast_arrays(r, z)
+    off_axis = r > 0
+    d2 = r[off_axis]**2 + z[off_axis]**2
+    a[off_axis] = -M_star * r[off_axis]/d2**1.5
+
+    return a
+
+def ring_a_r(r, z, a, z_ring, soft2=0.0):
+    """
+    Radial acceleration at (r, z) due to a ring of unit mass, radius a, at
+    height z_ring (with G = 1), softened by soft2 = s^2.  Arguments are
+    broadcast against each other
+    """
+    dz2 = (z - z_ring)**2 + soft2
+    D = (r + a)**2 + dz2
+    m = 4*a*r/D
+    K = special.ellipk(m)
+    E = special.ellipe(m)
+    # dK/dm, with its m -> 0 limit
+    small = m < 1e-6
+    m_safe = np.where(small, 0.5, m)
+    dK = np.where(small, np.pi/8, (E - (1 - m_safe)*K)/(2*m_safe*(1 - m_safe)))
+    # dm/dr
+    dm = 4*a*(a**2 - r**2 + dz2)/D**2
+
+    return (2/np.pi) * (dK*dm/np.sqrt(D) - K*(r + a)/D**1.5)
+
+def _zmax(rho, r):
+    """
+    Top of the rho grid at r (in the units of rho.z_bins)
+    """
+    r = np.asarray(isaac.match_units(r, rho.r_bins.units)[0])
+
+    if getattr(rho, '_zmax', None) is not None:
+
+        return np.interp(r, np.asarray(rho.r_bins), np.asarray(rho._zmax))
+
+    return float(np.asarray(rho.z_bins).max()) * np.ones(len(r))
+
+def _trapezoid_weights(x):
+    """
+    Weights w for which (w*f).sum() is the trapezoid rule integral of f(x)
+    """
+    w = np.zeros(len(x))
+
+    if len(x) < 2:
+
+        w[:] = 1.0
+        return w
+
+    dx = np.diff(x)
+    w[0:-1] += 0.5*dx
+    w[1:] += 0.5*dx
+
+    return w
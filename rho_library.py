@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+A library of precomputed, dimensionless solutions for rho(z) (see
+calc_rho.rho_z), cached on disk.
+
+In units of the scale height h = sqrt(2 r^3/a), the differential equation
+for rho(z) (see calc_rho.rho_z) only depends on two dimensionless numbers:
+
+    eps = h/r           (thickness of the disc)
+    gamma = 2 b rho_int h   (self gravity, ie 2h/z0 for the sech^2 scale
+                            height z0 = 2/(b sigma))
+
+The solution, normalized to rho_int/h_eff, is tabulated as a function of
+xi = z/h_eff, where h_eff = h/(1 + gamma/2) is the scale height including
+self gravity.  The table is over (eps, u) where u = gamma/(1 + gamma).
+
+rho(z,r) is then found for a new disc by interpolating in the table.  Radii
+which fall outside of the table, where the estimated interpolation error is
+above settings.rho_calc.library_tol, or where the profile isn't captured by
+the z grid are solved for exactly (with calc_rho).
+
+The table is built the first time it is needed and saved to the directory
+global_settings['rho_library']['directory'].  Table files are versioned and
+the cache is kept below global_settings['rho_library']['max_size'] (MB) by
+deleting the least recently used tables.
+"""
+# ICgen packages
+import calc_rho
+import isaac
+from ICglobal_settings import global_settings
+
+# External packages
+import numpy as np
+import os
+import glob
+import hashlib
+import scipy.integrate as nInt
+import tempfile
+
+# Version of the table format/solution.  Bump this to invalidate old tables
+_version = 1
+# Default table grid
+_eps_grid = (0.0, 0.3, 31)
+_u_grid = (0.0, 0.96, 49)
+_xi_grid = (0.0, 10.0, 501)
+# Relative tolerance used for the rescaling when building the table (see
+# calc_rho.rho_z, rho_tol)
+_build_tol = 1e-5
+# Tables already loaded
+_tables = {}
+
+def rho_z_library(sigma, T, r, settings):
+    """
+    rho,z = rho_z_library(...)
+    
+    Calculates rho(z) at all the radii r by interpolating in the dimensionless
+    solution table (see the module doc-string).  Radii where the table can't
+    be used are solved for with calc_rho, warm starting from the table where
+    possible.
+    
+    Arguments and outputs are the same as for calc_rho.rho_z_batch
+    """
+    rho_tol = settings.rho_calc.rho_tol
+    tol = settings.rho_calc.library_tol
+    nz = settings.rho_calc.nz
+    nr = len(r)
+    
+    rho_int, a, b, z0guess, r, z, dz, use, units = \
+    calc_rho._column_params(sigma, T, r, settings)
+    mass_unit, length_unit = units
+    rho0 = np.zeros([nr, nz])
+    
+    table = load_table()
+    # Only the radii which are solved for (see calc_rho.rho_z)
+    ind = np.where(use)[0]
+    rho_int, a, b, z0guess, r = [x[ind] for x in (rho_int, a, b, z0guess, r)]
+    z_bins, dz_bins = z, dz
+    z, dz = [calc_rho._take_columns(x, ind) for x in (z, dz)]
+    
+    # Dimensionless parameters
+    h = z0guess
+    eps = h/r
+    gamma = 2*b*rho_int*h
+    u = gamma/(1 + gamma)
+    h_eff = h/(1 + gamma/2)
+    
+    # Interpolate
+    rho_interp, err, inside = table.interp(eps[:,0], u[:,0], z/h_eff)
+    rho_interp *= rho_int/h_eff
+    # Check how well the profile is captured by the z grid (ie if z is too
+    # coarse, or if zmax is too small)
+    norm = nInt.trapz(rho_interp, z, axis=-1)
+    good = (norm > 0) & (abs(1 - norm/rho_int[:,0]) < tol)
+    rho_interp[good] *= (rho_int[good]/norm[good,None])
+    
+    use_table = inside & good & (err < tol)
+    rho0[ind[use_table]] = rho_interp[use_table]
+    print 'Interpolated rho(z) from the library at {0} of {1} radii'\
+    .format(use_table.sum(), nr)
+    
+    # Solve the rest, warm starting from the table where it is usable
+    warm = ~use_table & inside & good
+    cold = ~use_table & ~warm
+    
+    for mask, guess in ((warm, rho_interp), (cold, None)):
+        
+        if not np.any(mask):
+            
+            continue
+        
+        i = np.where(mask)[0]
+        
+        if guess is not None:
+            
+            guess = guess[i]
+            
+        rho0[ind[i]], n_iter, unconverged = calc_rho._solve_columns(\
+        rho_int[i], a[i], b[i], r[i], z0guess[i], \
+        calc_rho._take_columns(z, i), calc_rho._take_columns(dz, i), \
+        rho_tol, guess=guess)[0:3]
+        
+        if np.any(unconverged):
+            
+            print 'Warning: solution to rho did not converge for r = {0}'\
+            .format(r[i][unconverged, 0])
+            
+    print 'Solved for rho(z) at {0} radii'.format(warm.sum() + cold.sum())
+    
+    # Re-introduce units
+    rho0 = isaac.set_units(rho0.T, mass_unit/length_unit**3)
+    z = isaac.set_units(z_bins.T, length_unit)
+    
+    return rho0, z
+    
+class rho_table:
+    """
+    Table of dimensionless solutions for rho(z).  See the module doc-string
+    
+    table = rho_table(eps, u, xi)   solves for the table (can be slow)
+    table = rho_table.load(filename)
+    
+    table.interp(eps, u, xi) interpolates in the table
+    table.save(filename)
+    """
+    
+    def __init__(self, eps=None, u=None, xi=None, build=True):
+        
+        self.eps = np.linspace(*_eps_grid) if eps is None else np.asarray(eps)
+        self.u = np.linspace(*_u_grid) if u is None else np.asarray(u)
+        self.xi = np.linspace(*_xi_grid) if xi is None else np.asarray(xi)
+        self.version = _version
+        
+        if build:
+            
+            self._build()
+        
+    def _build(self):
+        """
+        Solves for rho(xi) at every point in the table.  Also estimates the
+        interpolation error in every cell (see interp)
+        """
+        eps, u = np.meshgrid(self.eps, self.u, indexing='ij')
+        eps = eps.reshape([-1, 1])
+        u = u.reshape([-1, 1])
+        print 'Building rho(z) library ({0} profiles)'.format(len(eps))
+        
+        # Parameters in units of h_eff, with rho_int = 1
+        gamma = u/(1 - u)
+        h = 1 + gamma/2
+        r = h/np.maximum(eps, 1e-6)
+        a = 2*r**3/h**2
+        b = gamma/(2*h)
+        rho_int = np.ones(eps.shape)
+        dxi = self.xi[1] - self.xi[0]
+        
+        rho = calc_rho._solve_columns(rho_int, a, b, r, h, self.xi, dxi, \
+        1 + _build_tol)[0]
+        self.rho = rho.reshape([len(self.eps), len(self.u), len(self.xi)])
+        self.err = _interp_error(self.rho)
+        
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a table saved by rho_table.save
+        """
+        data = np.load(filename)
+        table = cls(data['eps'], data['u'], data['xi'], build=False)
+        table.version = int(data['version'])
+        table.rho = data['rho']
+        table.err = data['err']
+        
+        return table
+        
+    def save(self, filename):
+        """
+        Saves the table to filename.  The file is written to a temporary file
+        first, so a partially written table is never left at filename
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        
+        with os.fdopen(fd, 'wb') as f:
+            
+            np.savez(f, version=self.version, eps=self.eps, u=self.u, \
+            xi=self.xi, rho=self.rho, err=self.err)
+            
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
+        
+    def interp(self, eps, u, xi):
+        """
+        Bilinear interpolation in (eps, u) and linear interpolation in xi.
+        eps and u are 1D arrays (one per column) and xi has shape
+        (ncol, nxi).  rho = 0 is returned for xi beyond the table.
+        
+        Returns rho (shape (ncol, nxi)), the estimated relative error for
+        every column (from the second differences of the table, see
+        _interp_error) and a boolean array which is False for columns outside
+        of the table.  Those are clipped to the edge of the table
+        """
+        xi = np.asarray(xi)
+        ncol = len(eps)
+        inside = (eps >= self.eps[0]) & (eps <= self.eps[-1]) \
+        & (u >= self.u[0]) & (u <= self.u[-1])
+        
+        # Cell indices and weights
+        i, wi = _grid_index(self.eps, eps)
+        j, wj = _grid_index(self.u, u)
+        k, wk = _grid_index(self.xi, xi)
+        out = xi > self.xi[-1]
+        
+        rho = np.zeros(xi.shape)
+        
+        for di, w1 in ((0, 1 - wi), (1, wi)):
+            
+            for dj, w2 in ((0, 1 - wj), (1, wj)):
+                
+                w = (w1*w2)[:,None]
+                profile = self.rho[i+di, j+dj]
+                rows = np.arange(ncol)[:,None]
+                rho += w*((1 - wk)*profile[rows, k] + wk*profile[rows, k+1])
+                
+        rho[out] = 0
+        err = np.max([self.err[i+di, j+dj] for di in (0, 1) for dj in (0, 1)],\
+        axis=0)
+        
+        return rho, err, inside
+    
+def load_table():
+    """
+    Returns the rho(z) table, loading it from the cache or building (and
+    caching) it if needed
+    """
+    filename = _table_filename()
+    
+    if filename in _tables:
+        
+        return _tables[filename]
+    
+    table = None
+    
+    if os.path.isfile(filename):
+        
+        try:
+            
+            table = rho_table.load(filename)
+            
+            if table.version != _version:
+                
+                table = None
+                
+            else:
+                # Mark as recently used
+                os.utime(filename, None)
+            
+        except (IOError, KeyError, ValueError):
+            
+            print 'Could not read rho(z) library file {0}'.format(filename)
+            table = None
+            
+    if table is None:
+        
+        table = rho_table()
+        _save_table(table, filename)
+        
+    _tables[filename] = table
+    
+    return table
+    
+def clear_cache():
+    """
+    Deletes all the cached rho(z) tables
+    """
+    _tables.clear()
+    
+    for filename in glob.glob(os.path.join(_cache_dir(), 'rho_table_*.npz')):
+        
+        os.remove(filename)
+    
+def _cache_dir():
+    
+    return global_settings['rho_library']['directory']
+    
+def _table_filename():
+    """
+    File name for the default table.  Tables are labelled by the version and
+    a hash of the grid parameters
+    """
+    key = repr((_version, _eps_grid, _u_grid, _xi_grid, _build_tol))
+    label = hashlib.md5(key).hexdigest()[0:12]
+    
+    return os.path.join(_cache_dir(), 'rho_table_v{0}_{1}.npz'.format(_version, \
+    label))
+    
+def _save_table(table, filename):
+    """
+    Saves table to the cache, if there is room for it, then deletes the least
+    recently used tables until the cache is below its maximum size
+    """
+    max_size = global_settings['rho_library']['max_size'] * 1024.0**2
+    size = table.rho.nbytes + table.err.nbytes
+    
+    if size > max_size:
+        
+        print 'rho(z) library table is larger than the maximum cache size.  '\
+        'Not saving it'
+        return
+    
+    directory = os.path.dirname(filename)
+    
+    try:
+        
+        if not os.path.isdir(directory):
+            
+            os.makedirs(directory)
+            
+        table.save(filename)
+        
+    except (IOError, OSError):
+        
+        print 'Could not save rho(z) library to {0}'.format(filename)
+        return
+    
+    # Enforce the size limit (least recently used first)
+    files = glob.glob(os.path.join(directory, 'rho_table_*.npz'))
+    files.sort(key=os.path.getmtime)
+    total = sum([os.path.getsize(f) for f in files])
+    
+    for f in files:
+        
+        if total <= max_size:
+            
+            break
+        
+        if f != filename:
+            
+            total -= os.path.getsize(f)
+            os.remove(f)
+    
+def _grid_index(grid, x):
+    """
+    For a uniform grid, returns the index of the cell containing x and the
+    fractional position of x in that cell.  x is clipped to the grid
+    """
+    dx = grid[1] - grid[0]
+    t = np.clip((x - grid[0])/dx, 0, len(grid) - 1)
+    i = np.minimum(t.astype(int), len(grid) - 2)
+    
+    return i, t - i
+    
+def _interp_error(rho):
+    """
+    Estimates the error of bilinear interpolation in (eps, u) for every cell
+    of the table rho (shape (neps, nu, nxi)), relative to max(rho).  The
+    error is estimated from the second differences along eps and u
+    (error ~ |d2|/8), taken at the nodes and using the nearest interior node
+    for the edges.  The error of the linear interpolation in xi is included
+    the same way.
+    """
+    scale = rho.max(-1)
+    d2_xi = abs(rho[...,2:] - 2*rho[...,1:-1] + rho[...,0:-2]).max(-1)
+    d2_eps = np.zeros(rho.shape[0:2])
+    d2_u = np.zeros(rho.shape[0:2])
+    d2_eps[1:-1] = abs(rho[2:] - 2*rho[1:-1] + rho[0:-2]).max(-1)
+    d2_u[:,1:-1] = abs(rho[:,2:] - 2*rho[:,1:-1] + rho[:,0:-2]).max(-1)
+    d2_eps[0] = d2_eps[1]
+    d2_eps[-1] = d2_eps[-2]
+    d2_u[:,0] = d2_u[:,1]
+    d2_u[:,-1] = d2_u[:,-2]
+    
+    return (d2_eps + d2_u + d2_xi)/(8*scale)
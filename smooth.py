@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+In-process SPH smoothing lengths and densities of particles, found with a kd
+tree nearest neighbor search (scipy.spatial.cKDTree), so ChaNGa isn't needed
+to estimate the gravitational softening (see ICgen_utils.est_eps).
+
+As in ChaNGa/gasoline, the smoothing length h of a particle is half the
+distance to its n_smooth-th nearest neighbor (counting itself), and the
+density is the SPH sum over those neighbors
+
+    rho_i = sum_j m_j W(r_ij, h_i)
+
+with the M4 cubic spline kernel W, which is zero beyond 2h.  The neighbor
+searches are split into chunks of particles, which are run on a
+multiprocessing pool.
+
+USAGE:
+
+    import smooth
+    h, rho = smooth.smooth(f.g['pos'], f.g['mass'], n_smooth=32)
+    # Or set f.g['smooth'] and f.g['rho'] of a snapshot
+    smooth.snapshot_smooth(f)
+"""
+
+# External packages
+import numpy as np
+import pynbody
+SimArray = pynbody.array.SimArray
+from scipy.spatial import cKDTree
+from multiprocessing import Pool, cpu_count
+
+# The kd tree and particle masses being used by the pool (see smooth)
+_kdtree = None
+_mass = None
+# Maximum number of neighbor distances calculated at once
+_max_chunk = int(2**22)
+
+def smooth(pos, mass, n_smooth=32, processes=None):
+    """
+    Calculates the SPH smoothing lengths and densities of particles (see the
+    module doc-string)
+
+    * Arguments *
+
+    pos : array or SimArray, shape (N, 3)
+    mass : array, SimArray, or float
+    n_smooth : int
+        Number of neighbors (including the particle itself)
+    processes : int
+        Number of processes to use.  Default is the number of CPUs
+
+    * Output *
+
+    h : array or SimArray, shape (N,)
+        Smoothing lengths (in the units of pos)
+    rho : array or SimArray, shape (N,)
+        Densities.  If pos and mass are SimArrays, units are
+        mass.units/pos.units**3
+    """
+    global _kdtree, _mass
+
+    pos_units = None
+    rho_units = None
+
+    if pynbody.units.has_units(pos):
+
+        pos_units = pos.units
+
+        if pynbody.units.has_units(mass):
+
+            rho_units = mass.units * pos.units**-3
+
+    x = np.asarray(pos, dtype=np.float64)
+    n = len(x)
+    n_smooth = int(min(n_smooth, n))
+
+    if n_smooth < 2:
+
+        raise ValueError, 'Need at least 2 particles to calculate smoothing '\
+        'lengths'
+
+    _kdtree = cKDTree(x)
+    _mass = np.asarray(mass, dtype=np.float64) * np.ones(n)
+    # Chunks of particles handed to the processes
+    n_chunk = max(1, _max_chunk//n_smooth)
+    chunks = [(i, min(i + n_chunk, n), n_smooth) for i in range(0, n, n_chunk)]
+
+    if processes is None:
+
+        processes = cpu_count()
+
+    processes = min(processes, len(chunks))
+
+    try:
+
+        if processes > 1:
+
+            pool = Pool(processes)
+            results = pool.map(_chunk_smooth, chunks)
+            pool.close()
+            pool.join()
+
+        else:
+
+            results = [_chunk_smooth(chunk) for chunk in chunks]
+
+    finally:
+
+        _kdtree = None
+        _mass = None
+
+    h = np.concatenate([result[0] for result in results])
+    rho = np.concatenate([result[1] for result in results])
+
+    if pos_units is not None:
+
+        h = SimArray(h, pos_units)
+
+    if rho_units is not None:
+
+        rho = SimArray(rho, rho_units)
+
+    return h, rho
+
+def snapshot_smooth(f, family='gas', n_smooth=32, processes=None):
+    """
+    Calculates the smoothing lengths and densities of the particles of family
+    in the snapshot f (using only those particles as neighbors) and saves
+    them to f[family]['smooth'] and f[family]['rho'].  See smooth.smooth
+    """
+    sub = f[pynbody.family.get_family(family)]
+    h, rho = smooth(sub['pos'], sub['mass'], n_smooth, processes)
+    sub['smooth'] = h.astype(np.float32)
+    sub['rho'] = rho.astype(np.float32)
+
+def kernel(r, h):
+    """
+    The M4 cubic spline SPH kernel W(r, h), normalized in 3D and zero beyond
+    r = 2h
+    """
+    q = np.asarray(r, dtype=np.float64)/h
+    w = np.where(q < 1, 1 - 1.5*q**2 + 0.75*q**3, 0.25*(2 - q)**3)
+    w[q >= 2] = 0
+
+    return w/(np.pi*np.asarray(h, dtype=np.float64)**3)
+
+def _chunk_smooth(args):
+    """
+    Smoothing lengths and densities of particles i0 to i1 (for the pool)
+    """
+    i0, i1, n_smooth = args
+    x = _kdtree.data[i0:i1]
+    r, j = _kdtree.query(x, n_smooth)
+    h = 0.5*r[:,-1]
+    rho = (_mass[j] * kernel(r, h[:,None])).sum(1)
+
+    return h, rho
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+An on-disk cache of the outputs of the IC generation stages (sigma, rho, and
+pos), used by ICgen.maker.
+
+Every stage output is stored under a key: an md5 hash of exactly the settings
+the stage reads (see _stage_settings) and of the upstream outputs it is made
+from (rho is made from sigma, pos from sigma and rho).  Upstream outputs are
+labelled by a hash of their contents (see hash_value), so rho made from a
+sigma which was loaded from disk has the same key as one made from a newly
+generated sigma.  When a stage is run, the cache is checked for its key first
+and the output is only calculated if it isn't found.  A new IC with the same
+settings therefore reuses any sigma, rho, or position set which has already
+been made.
+
+The cache is stored in global_settings['stage_cache']['directory'] and is kept
+below global_settings['stage_cache']['max_size'] (MB) by deleting the least
+recently used entries.  Caching is off by default, and can be turned on with
+global_settings['stage_cache']['enabled'] = True
+"""
+# ICgen packages
+from ICglobal_settings import global_settings
+import timing
+
+# External packages
+import pynbody
+import numpy as np
+import cPickle as pickle
+import os
+import glob
+import hashlib
+import tempfile
+import types
+
+# Version of the stage outputs.  Bump this to invalidate old cache entries
+_version = 1
+# The settings each stage reads, as (settings group, attributes).  If
+# attributes is None, the whole group is used
+_stage_settings = {\
+'sigma': [('sigma', None), \
+('physical', ('kind', 'T0', 'r0', 'Tpower', 'Tmin', 'Tmax', 'M', 'm'))], \
+'rho': [('rho_calc', None), ('physical', None)], \
+'pos': [('pos_gen', ('nParticles', 'method', 'seed'))], \
+'snapshot': [('snapshot', None), ('changa_run', None)]}
+
+def stage_key(ICobj, stage, upstream=None):
+    """
+    Returns the key (a hex string) for the output of stage, made using the
+    current settings of ICobj
+    
+    * Arguments *
+    
+    ICobj : IC object
+    stage : str
+        'sigma', 'rho', 'pos', or 'snapshot'
+    upstream : str or tuple of str
+        Labels of the stage outputs this stage is made from (if any)
+    
+    * Output *
+    
+    key : str
+        None if any of the upstream outputs are unlabelled
+    """
+    if not isinstance(upstream, tuple):
+        
+        upstream = (upstream,)
+        
+    if (stage != 'sigma') and (None in upstream):
+        
+        return None
+    
+    settings = ICobj.settings
+    values = []
+    
+    for group, attrs in _stage_settings[stage]:
+        
+        group_dict = getattr(settings, group).__dict__
+        
+        if attrs is not None:
+            
+            group_dict = dict([(attr, group_dict.get(attr)) for attr in attrs])
+        
+        values.append((group, group_dict))
+    
+    return hash_value((_version, stage, upstream, values))
+
+def hash_value(x):
+    """
+    Returns an md5 hash (hex string) of x.  x can be made up of arrays,
+    SimArrays, units, numbers, strings, lists, tuples, dicts, and objects
+    (which are hashed by their class name and __dict__)
+    """
+    m = hashlib.md5()
+    _update_hash(m, x)
+    
+    return m.hexdigest()
+
+def load(stage, key):
+    """
+    Returns the output of stage with key stored in the cache, or None if it
+    isn't there (or caching is turned off)
+    """
+    if (key is None) or (not _enabled()):
+        
+        return None
+    
+    filename = _filename(stage, key)
+    
+    if not os.path.isfile(filename):
+        
+        return None
+    
+    try:
+        
+        with timing.stage('cache_load'):
+            
+            f = open(filename, 'rb')
+            output = pickle.load(f)
+            f.close()
+    
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError, \
+    ImportError, ValueError):
+        
+        print 'Could not read stage cache file {0}'.format(filename)
+        return None
+    
+    # Mark as recently used
+    os.utime(filename, None)
+    print 'Loaded {0} from the stage cache'.format(stage)
+    
+    return output
+
+def save(stage, key, output):
+    """
+    Saves the output of stage under key, then deletes the least recently used
+    entries until the cache is below its maximum size
+    """
+    if (key is None) or (not _enabled()):
+        
+        return
+    
+    filename = _filename(stage, key)
+    directory = os.path.dirname(filename)
+    max_size = global_settings['stage_cache']['max_size'] * 1024.0**2
+    
+    try:
+        
+        if not os.path.isdir(directory):
+            
+            os.makedirs(directory)
+        
+        # Write to a temporary file first so a partially written entry is
+        # never read
+        with timing.stage('cache_save'):
+            
+            fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            f = os.fdopen(fd, 'wb')
+            pickle.dump(output, f, protocol=2)
+            f.close()
+            os.chmod(tmpname, 0644)
+        
+        if os.path.getsize(tmpname) > max_size:
+            
+            print '{0} is larger than the maximum stage cache size.  Not '\
+            'caching it'.format(stage)
+            os.remove(tmpname)
+            return
+        
+        os.rename(tmpname, filename)
+    
+    except (IOError, OSError, pickle.PicklingError):
+        
+        print 'Could not save {0} to the stage cache'.format(stage)
+        return
+    
+    # Enforce the size limit (least recently used first)
+    files = glob.glob(os.path.join(directory, 'stage_*.p'))
+    files.sort(key=os.path.getmtime)
+    total = sum([os.path.getsize(f) for f in files])
+    
+    for f in files:
+        
+        if total <= max_size:
+            
+            break
+        
+        if f != filename:
+            
+            total -= os.path.getsize(f)
+            os.remove(f)
+
+def clear_cache():
+    """
+    Deletes all the cached stage outputs
+    """
+    for filename in glob.glob(os.path.join(_cache_dir(), 'stage_*.p')):
+        
+        os.remove(filename)
+
+def _enabled():
+    
+    return global_settings['stage_cache']['enabled']
+
+def _cache_dir():
+    
+    return global_settings['stage_cache']['directory']
+
+def _filename(stage, key):
+    
+    return os.path.join(_cache_dir(), 'stage_{0}_{1}.p'.format(stage, key))
+
+def _update_hash(m, x):
+    """
+    Recursively adds x to the md5 hash m
+    """
+    if isinstance(x, np.ndarray):
+        
+        units = getattr(x, 'units', None)
+        x = np.ascontiguousarray(x)
+        m.update('array{0}{1}{2}'.format(x.dtype.str, x.shape, units))
+        m.update(x.tostring())
+    
+    elif isinstance(x, pynbody.units.UnitBase):
+        
+        m.update('units{0}'.format(x))
+    
+    elif isinstance(x, np.generic):
+        
+        _update_hash(m, x.item())
+    
+    elif isinstance(x, (bool, int, long, float, complex, str, unicode)) \
+    or (x is None):
+        
+        m.update('{0}{1!r}'.format(type(x).__name__, x))
+    
+    elif isinstance(x, dict):
+        
+        m.update('dict{0}'.format(len(x)))
+        
+        for key in sorted(x.keys()):
+            
+            _update_hash(m, key)
+            _update_hash(m, x[key])
+    
+    elif isinstance(x, (list, tuple)):
+        
+        m.update('{0}{1}'.format(type(x).__name__, len(x)))
+        
+        for val in x:
+            
+            _update_hash(m, val)
+    
+    elif hasattr(x, '__dict__') and not isinstance(x, (types.FunctionType, \
+    types.MethodType, types.ClassType, type)):
+        
+        m.update('object{0}'.format(x.__class__.__name__))
+        _update_hash(m, x.__dict__)
+    
+    else:
+        # Functions, etc (repr might contain a memory address)
+        m.update('other{0}'.format(getattr(x, '__name__', type(x).__name__)))
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Generates a batch of initial conditions which differ by a few settings (a
+parameter sweep), ie a set of disks with different Qmin, power, mScale, or
+binary orbits.
+
+The ICs are made from a base settings object and a parameter grid.  Each IC
+is generated (see IC.generate) in its own directory, by a pool of processes.
+Stages which are shared by more than one IC (ie sigma and rho, when only
+mScale changes) are made once, before the ICs which use them, and are read
+from the stage cache (see stage_cache.py) by those ICs.  The stage cache is
+turned on for the sweep (unless cache=False).  Positions are only shared if they can be cached
+(pos_gen.seed is set and pos_gen.chunk_size is None), otherwise every IC
+gets its own random realization.
+
+The number of ChaNGa runs at once (over all the processes) can be limited
+with max_changa (see ICgen_utils.changa_slot).
+
+USAGE:
+
+    import ICgen_settings
+    import sweep
+
+    base = ICgen_settings.settings(kind='powerlaw')
+    base.pos_gen.nParticles = 100000
+
+    # Every combination of the values (4 ICs)
+    grid = {'sigma.Qmin': [1.0, 1.5], 'snapshot.mScale': [0.5, 1.0]}
+    results = sweep.run(base, grid, 'sweep_dir', processes=4, max_changa=1)
+
+    # Or a list of the settings of every IC
+    grid = [{'sigma.Qmin': 1.0}, {'sigma.Qmin': 1.5, 'sigma.power': -1.5}]
+    results = sweep.run(base, grid, 'sweep_dir')
+
+    # Load one of the ICs
+    IC = sweep.load('sweep_dir', 0)
+
+The ICs are put in sweep_dir/IC_000, sweep_dir/IC_001, ...  The parameters
+of every IC (and whether generating it failed) are saved to
+sweep_dir/sweep.p (see sweep.read)
+"""
+
+# External packages
+import os
+import copy
+import itertools
+import traceback
+import multiprocessing
+import Queue
+import cPickle as pickle
+
+# ICgen packages
+import ICgen
+import ICgen_utils
+import stage_cache
+from ICglobal_settings import global_settings
+
+# Filename (in the sweep directory) of the list of the ICs
+_index_name = 'sweep.p'
+# Name of the directory of IC number i
+_dir_format = 'IC_{0:03d}'
+# The stages which can be shared between ICs, in the order they are made
+_shared_stages = ('sigma', 'rho', 'pos')
+
+def run(base, grid, directory='.', processes=None, max_changa=1, cache=True):
+    """
+    Generates a set of ICs, one for every point in a parameter grid.  See the
+    module doc-string
+
+    * Arguments *
+
+    base : ICgen_settings.settings
+        Settings the ICs are made from (not changed)
+    grid : dict or list of dicts
+        If a dict, maps settings (as 'group.attribute', ie 'sigma.Qmin') to
+        lists of values.  An IC is made for every combination of the values.
+        If a list of dicts, each dict maps settings to the value for one IC
+    directory : str
+        Directory to put the ICs in
+    processes : int
+        Number of ICs (or shared stages) generated at once.  Default is the
+        number of CPUs
+    max_changa : int or None
+        Maximum number of ChaNGa runs at once.  If None, unlimited
+    cache : bool
+        Turn the stage cache on during the sweep, so shared stages are only
+        made once (see stage_cache.py).  Its previous setting is restored
+        afterwards
+
+    * Output *
+
+    results : list of dicts
+        One for every IC, with keys 'directory', 'params', and 'error' (None,
+        or the traceback if generating the IC failed)
+    """
+    points = grid_points(grid)
+
+    if processes is None:
+
+        processes = multiprocessing.cpu_count()
+
+    if not os.path.isdir(directory):
+
+        os.makedirs(directory)
+
+    # Settings of every IC
+    all_settings = []
+    results = []
+
+    for i, params in enumerate(points):
+
+        settings = make_settings(base, params)
+        IC_dir = os.path.join(directory, _dir_format.format(i))
+        # Every IC writes its files in its own directory
+        filenames = settings.filenames.__dict__
+
+        for key, val in filenames.items():
+
+            if isinstance(val, str):
+
+                filenames[key] = os.path.basename(val)
+
+        settings.filenames.IC_file_name = 'IC.p'
+        all_settings.append(settings)
+        results.append({'directory': IC_dir, 'params': params, \
+        'error': None})
+
+    old_limit = ICgen_utils._changa_limit
+    cache_enabled = global_settings['stage_cache']['enabled']
+
+    try:
+
+        if max_changa is not None:
+
+            ICgen_utils.set_changa_limit(ICgen_utils.changa_limit(max_changa))
+
+        if cache:
+
+            global_settings['stage_cache']['enabled'] = True
+
+        _run_all(all_settings, results, processes)
+
+    finally:
+        # Don't leave the global settings changed (ie after an error)
+        ICgen_utils.set_changa_limit(old_limit)
+        global_settings['stage_cache']['enabled'] = cache_enabled
+
+    # Save the list of ICs
+    f = open(os.path.join(directory, _index_name), 'wb')
+    pickle.dump(results, f, protocol=2)
+    f.close()
+
+    n_failed = sum([result['error'] is not None for result in results])
+    print 'Sweep done: {0} ICs generated, {1} failed'.format(\
+    len(results) - n_failed, n_failed)
+
+    return results
+
+def grid_points(grid):
+    """
+    Returns a list of dicts of the settings of every IC in grid (see run)
+    """
+    if isinstance(grid, dict):
+
+        keys = sorted(grid.keys())
+        values = [grid[key] for key in keys]
+        points = []
+
+        for combination in itertools.product(*values):
+
+            points.append(dict(zip(keys, combination)))
+
+        return points
+
+    return [dict(point) for point in grid]
+
+def make_settings(base, params):
+    """
+    Returns a copy of the settings base, with the settings in params (a dict
+    mapping 'group.attribute' to values) changed.  kind is set before the
+    other settings, since it resets the defaults of sigma (see
+    ICgen_settings.sigma)
+    """
+    settings = copy.deepcopy(base)
+    # Don't let the copies save over the base settings file
+    settings.__dict__.pop('settings_filename', None)
+    keys = sorted(params.keys(), key=lambda key: not key.endswith('.kind'))
+
+    for key in keys:
+
+        group, attr = _split_key(key)
+        setattr(getattr(settings, group), attr, params[key])
+
+    return settings
+
+def shared(all_settings, stage):
+    """
+    Returns the settings of one IC for every output of stage which is used by
+    more than one of the ICs with all_settings.  ICs share the output if the
+    settings of the stage and of the stages before it are the same (see
+    stage_cache.stage_key)
+    """
+    if stage == 'pos':
+        # Unseeded and memory-mapped positions aren't cached
+        all_settings = [settings for settings in all_settings \
+        if (settings.pos_gen.chunk_size is None) and \
+        (settings.pos_gen.seed is not None)]
+
+    groups = {}
+
+    for settings in all_settings:
+
+        key = _group_key(settings, stage)
+        groups.setdefault(key, []).append(settings)
+
+    return [members[0] for key, members in sorted(groups.items()) \
+    if len(members) > 1]
+
+def read(directory):
+    """
+    Returns the list of ICs of the sweep in directory (see run)
+    """
+    f = open(os.path.join(directory, _index_name), 'rb')
+    results = pickle.load(f)
+    f.close()
+
+    return results
+
+def load(directory, i):
+    """
+    Loads IC number i of the sweep in directory
+    """
+    IC_dir = os.path.join(directory, _dir_format.format(i))
+    cwd = os.getcwd()
+    # The IC refers to its files relative to its directory
+    os.chdir(IC_dir)
+
+    try:
+
+        ICobj = ICgen.load('IC.p')
+
+    finally:
+
+        os.chdir(cwd)
+
+    return ICobj
+
+class _settings_holder:
+    """
+    Something with settings, for calculating stage keys without an IC object
+    """
+    def __init__(self, settings):
+
+        self.settings = settings
+
+def _group_key(settings, stage):
+    """
+    Returns a key for the output of stage made with settings.  Upstream
+    outputs are labelled by their own group keys (their contents aren't
+    known yet)
+    """
+    holder = _settings_holder(settings)
+    key = stage_cache.stage_key(holder, 'sigma')
+
+    if stage in ('rho', 'pos'):
+
+        sigma_key = key
+        key = stage_cache.stage_key(holder, 'rho', sigma_key)
+
+    if stage == 'pos':
+
+        key = stage_cache.stage_key(holder, 'pos', (sigma_key, key))
+
+    return key
+
+def _split_key(key):
+
+    parts = key.split('.')
+
+    if len(parts) != 2:
+
+        raise ValueError, 'Settings should be given as group.attribute, '\
+        'not {0}'.format(key)
+
+    return parts
+
+def _make_stage(settings, stage):
+    """
+    Makes the output of stage (and the stages before it), which are saved to
+    the stage cache
+    """
+    # Initializing an IC with a kind of sigma makes sigma
+    ICobj = ICgen.IC(settings=settings)
+
+    if stage in ('rho', 'pos'):
+
+        ICobj.maker.rho_gen()
+
+    if stage == 'pos':
+
+        ICobj.maker.pos_gen()
+
+def _generate(settings, directory):
+    """
+    Generates an IC with settings in directory
+    """
+    if not os.path.isdir(directory):
+
+        os.makedirs(directory)
+
+    # Output files (and ChaNGa's temporary files) are put in directory
+    os.chdir(directory)
+    ICobj = ICgen.IC(settings=settings)
+    ICobj.generate()
+
+def _run_all(all_settings, results, processes):
+    """
+    Makes the shared stages, then generates every IC (see run).  The errors
+    of the ICs are stored in results
+    """
+    # Make the shared stages
+    if stage_cache._enabled():
+
+        for stage in _shared_stages:
+
+            jobs = []
+
+            for settings in shared(all_settings, stage):
+
+                jobs.append((_make_stage, (settings, stage)))
+
+            if len(jobs) > 0:
+
+                print 'Making {0} shared {1} stage(s)'.format(len(jobs), stage)
+
+            for index, error in _run_jobs(jobs, processes):
+
+                if error is not None:
+                    # The ICs which use it will make it again (and fail)
+                    print 'Making a shared {0} stage failed:'.format(stage)
+                    print error
+
+    else:
+
+        print 'The stage cache is disabled, so stages shared between ICs '\
+        'will be made once per IC'
+
+    # Generate the ICs
+    jobs = []
+
+    for settings, result in zip(all_settings, results):
+
+        jobs.append((_generate, (settings, result['directory'])))
+
+    for index, error in _run_jobs(jobs, processes):
+
+        results[index]['error'] = error
+
+        if error is None:
+
+            print 'Generated {0}'.format(results[index]['directory'])
+
+        else:
+
+            print 'Generating {0} failed:'.format(results[index]['directory'])
+            print error
+
+def _run_job(queue, index, function, args, limit):
+    """
+    Runs function(*args) (in a child process) and puts index and the error
+    (None if there wasn't one) in queue
+    """
+    ICgen_utils.set_changa_limit(limit)
+
+    try:
+
+        function(*args)
+        error = None
+
+    except:
+
+        error = traceback.format_exc()
+
+    queue.put((index, error))
+
+def _run_jobs(jobs, processes):
+    """
+    Runs jobs (a list of (function, args)), processes at a time, each in its
+    own process.  Yields (index, error) for every job as it finishes (see
+    _run_job)
+
+    Plain processes are used instead of a multiprocessing.Pool, since pool
+    processes can't start their own pools (ie for calc_rho_zr.rho_zr)
+    """
+    queue = multiprocessing.Queue()
+    limit = ICgen_utils._changa_limit
+    running = {}
+    n_done = 0
+    next_job = 0
+
+    while n_done < len(jobs):
+
+        while (next_job < len(jobs)) and (len(running) < processes):
+
+            function, args = jobs[next_job]
+            p = multiprocessing.Process(target=_run_job, \
+            args=(queue, next_job, function, args, limit))
+            p.start()
+            running[next_job] = p
+            next_job += 1
+
+        try:
+
+            index, error = queue.get(timeout=1.0)
+
+        except Queue.Empty:
+
+            # Check for processes which died without reporting
+            for index, p in running.items():
+
+                if not p.is_alive() and (p.exitcode != 0):
+
+                    p.join()
+                    del running[index]
+                    n_done += 1
+                    yield index, 'Process exited with code {0}'.format(\
+                    p.exitcode)
+
+            continue
+
+        running.pop(index).join()
+        n_done += 1
+        yield index, error
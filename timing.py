@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation of IC generation.
+
+Parts of the code are timed by wrapping them in stage(name).  Stages can be
+nested.  Every stage records its wall time, CPU time (of this process and of
+finished subprocesses, ie ChaNGa and pool workers), resident memory, and
+optionally the sizes of the arrays it made (see add_arrays).  The peak
+resident memory of a stage (peak_rss_mb) is the largest value seen by a
+thread which samples it every _sample_interval seconds while stages run.
+process_peak_rss_mb is the peak of the whole process so far.  Stages are only recorded while a
+report is running (in the same thread), otherwise stage() does nothing, so
+the instrumented functions can be used as usual.
+
+IC.generate runs a report and stores it as IC.timing, and saves it next to
+the IC file (ie IC_timing.json).
+
+USAGE:
+    
+    import timing
+    
+    with timing.report('my_report') as rep:
+        
+        with timing.stage('rho'):
+            
+            rho = ...
+            timing.add_arrays(rho=rho)
+    
+    rep.summary()
+    rep.save('timing.json')
+
+Reports can be nested: a report started while another is running is also
+added to it as a stage.
+"""
+
+# External packages
+import numpy as np
+import os
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    
+    import resource
+
+except ImportError:
+    
+    # Not available on windows.  Peak memory is not recorded
+    resource = None
+
+# Stack of the running stages (per thread)
+_local = threading.local()
+# Time (s) between samples of the resident memory
+_sample_interval = 0.02
+
+class report:
+    """
+    A tree of timed stages (see the module doc-string).  Use as a context
+    manager: the report runs for the duration of the with block
+    
+    * Attributes *
+    
+    name : str
+        Name of the report
+    record : dict
+        The top level stage.  Its sub-stages are in record['stages']
+    """
+    
+    def __init__(self, name='report'):
+        
+        self.name = name
+        self.record = None
+        self._stage = None
+    
+    def __enter__(self):
+        
+        self._stage = _timed(self.name, {}, top=True)
+        self.record = self._stage.__enter__()
+        
+        return self
+    
+    def __exit__(self, *exc_info):
+        
+        return self._stage.__exit__(*exc_info)
+    
+    def to_dict(self):
+        """
+        Returns the report as a dictionary (which can be converted to JSON)
+        """
+        return self.record
+    
+    def to_json(self, indent=2):
+        """
+        Returns the report as a JSON string
+        """
+        return json.dumps(self.record, indent=indent)
+    
+    def save(self, filename):
+        """
+        Saves the report as JSON to filename
+        """
+        f = open(filename, 'w')
+        f.write(self.to_json())
+        f.close()
+        print 'Timing report saved to {0}'.format(filename)
+    
+    def summary(self):
+        """
+        Prints the wall time, CPU time (this process + subprocesses), and peak
+        memory of every stage
+        """
+        print '{0:<40} {1:>10} {2:>10} {3:>10} {4:>12}'.format('stage', \
+        'wall (s)', 'cpu (s)', 'sub (s)', 'peak (MB)')
+        _print_record(self.record, 0)
+
+def stage(name, **info):
+    """
+    Context manager which times the code it wraps as the stage name (see the
+    module doc-string).  Any keyword arguments are stored with the stage (ie
+    the ChaNGa command).  Returns the record of the stage (or None if no
+    report is running)
+    """
+    return _timed(name, info)
+
+@contextmanager
+def _timed(name, info, top=False):
+    """
+    Times a stage.  If top=True it is recorded even if no report is running
+    (it is the top level stage of a report)
+    """
+    stack = _stack()
+    
+    if (len(stack) == 0) and not top:
+        
+        yield None
+        return
+    
+    record = _new_record(name, info)
+    
+    if len(stack) > 0:
+        
+        stack[-1]['stages'].append(record)
+    
+    stack.append(record)
+    record['start'] = time.time()
+    t0 = os.times()
+    record['rss_start_mb'] = _rss_mb()
+    record['peak_rss_mb'] = record['rss_start_mb']
+    _sampler.add(record)
+    
+    try:
+        
+        yield record
+    
+    finally:
+        
+        t1 = os.times()
+        record['wall'] = time.time() - record['start']
+        record['cpu'] = (t1[0] - t0[0]) + (t1[1] - t0[1])
+        record['cpu_children'] = (t1[2] - t0[2]) + (t1[3] - t0[3])
+        _sampler.remove(record)
+        record['rss_end_mb'] = _rss_mb()
+        record['peak_rss_mb'] = _max(record['peak_rss_mb'], \
+        record['rss_end_mb'])
+        record['process_peak_rss_mb'] = _peak_rss_mb()
+        stack.pop()
+
+def add_arrays(**arrays):
+    """
+    Records the shape, dtype, and size of arrays (given as name=array) in the
+    current stage
+    """
+    stack = _stack()
+    
+    if len(stack) == 0:
+        
+        return
+    
+    for name, x in arrays.iteritems():
+        
+        if x is None:
+            
+            continue
+        
+        x = np.asanyarray(x)
+        stack[-1]['arrays'][name] = {'shape': list(x.shape), \
+        'dtype': x.dtype.str, 'nbytes': int(x.nbytes)}
+
+class _rss_sampler:
+    """
+    Samples the resident memory of the process in a background thread while
+    any stage is running, and keeps the peak_rss_mb of every running stage
+    up to date
+    """
+    def __init__(self):
+        
+        self._records = []
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def add(self, record):
+        
+        with self._lock:
+            
+            self._records.append(record)
+            
+            if (self._thread is None) or not self._thread.is_alive():
+                
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+    
+    def remove(self, record):
+        
+        with self._lock:
+            
+            self._records = [x for x in self._records if x is not record]
+    
+    def _run(self):
+        
+        while True:
+            
+            rss = _rss_mb()
+            
+            with self._lock:
+                
+                if len(self._records) == 0:
+                    # Stops when no stages are running (restarted by add)
+                    self._thread = None
+                    return
+                
+                for record in self._records:
+                    
+                    record['peak_rss_mb'] = _max(record['peak_rss_mb'], rss)
+            
+            time.sleep(_sample_interval)
+
+_sampler = _rss_sampler()
+
+def _max(x, y):
+    """
+    Maximum of x and y, either of which can be None
+    """
+    if x is None:
+        
+        return y
+    
+    if y is None:
+        
+        return x
+    
+    return max(x, y)
+
+def _stack():
+    
+    if not hasattr(_local, 'stack'):
+        
+        _local.stack = []
+    
+    return _local.stack
+
+def _new_record(name, info):
+    
+    return {'name': name, 'info': info, 'arrays': {}, 'stages': []}
+
+def _rss_mb():
+    """
+    Current resident memory of this process (MB), or None if it can't be read
+    """
+    try:
+        
+        f = open('/proc/self/statm', 'r')
+        pages = int(f.read().split()[1])
+        f.close()
+    
+    except (IOError, IndexError, ValueError):
+        
+        return None
+    
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+
+def _peak_rss_mb():
+    """
+    Peak resident memory of this process so far (MB), or None
+    """
+    if resource is None:
+        
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    if sys.platform == 'darwin':
+        # bytes on OS X, kB on linux
+        return peak / 1024.0**2
+    
+    return peak / 1024.0
+
+def _print_record(record, depth):
+    
+    def fmt(x, f='{0:.2f}'):
+        
+        return '-' if x is None else f.format(x)
+    
+    print '{0:<40} {1:>10} {2:>10} {3:>10} {4:>12}'.format(\
+    '  '*depth + record['name'], fmt(record.get('wall')), \
+    fmt(record.get('cpu')), fmt(record.get('cpu_children')), \
+    fmt(record.get('peak_rss_mb'), '{0:.0f}'))
+    
+    for sub in record['stages']:
+        
+        _print_record(sub, depth + 1)
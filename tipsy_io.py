@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Writes tipsy (standard) snapshots directly from numpy arrays, without making
+a pynbody snapshot first.
+
+The file is memory-mapped and the gas, dark, and star particle records are
+filled in chunks using numpy structured dtypes, so memory use is set by the
+chunk size and the file is written at (close to) disk bandwidth.  The
+format is the same as written by pynbody (big-endian, with a padded header).
+
+USAGE:
+    
+    import tipsy_io
+    tipsy_io.write('snapshot.std', n_gas=len(xyz), n_star=1, \\
+    gas={'pos': xyz, 'mass': m, 'temp': T, 'eps': 0.01}, \\
+    star={'mass': 1.0, 'eps': 0.01})
+
+Values can be arrays (one row per particle), scalars (used for every
+particle), or functions f(i0, i1) returning the values for particles i0 to
+i1 (so that they don't need to be calculated for all particles at once).
+Fields which aren't given are set to 0.  Numbers are written as-is, so all
+values should be in the same units (ie the units of the .param file)
+
+Fields of a tipsy file can also be updated in place with patch (ie new
+velocities), without re-writing the rest of the file:
+    
+    tipsy_io.patch('snapshot.std', 'gas', {'vel': vel, 'eps': eps})
+
+and single fields read back with read:
+    
+    rho = tipsy_io.read('snapshot.std', 'gas', 'rho')
+"""
+
+# External packages
+import numpy as np
+import os
+
+# Number of particles written at a time
+_chunk_size = int(2**16)
+# Fields of the particle records of each family
+_fields = {\
+'gas': ('mass', 'pos', 'vel', 'rho', 'temp', 'eps', 'metals', 'phi'), \
+'dark': ('mass', 'pos', 'vel', 'eps', 'phi'), \
+'star': ('mass', 'pos', 'vel', 'metals', 'tform', 'eps', 'phi')}
+# The order the families are stored in
+_families = ('gas', 'dark', 'star')
+
+def header_dtype(byteorder='>'):
+    """
+    dtype of the tipsy header (including the padding)
+    """
+    i4 = byteorder + 'i4'
+    
+    return np.dtype([('time', byteorder + 'f8'), ('nbodies', i4), \
+    ('ndim', i4), ('nsph', i4), ('ndark', i4), ('nstar', i4), ('pad', i4)])
+
+def particle_dtype(family, byteorder='>', double_pos=False, double_vel=False):
+    """
+    dtype of the particle records of family ('gas', 'dark', or 'star').  pos
+    and vel are (3,) sub-arrays, double precision if double_pos/double_vel
+    """
+    f4 = byteorder + 'f4'
+    f8 = byteorder + 'f8'
+    dtype = []
+    
+    for name in _fields[family]:
+        
+        if name == 'pos':
+            
+            dtype.append((name, f8 if double_pos else f4, (3,)))
+        
+        elif name == 'vel':
+            
+            dtype.append((name, f8 if double_vel else f4, (3,)))
+        
+        else:
+            
+            dtype.append((name, f4))
+    
+    return np.dtype(dtype)
+
+def write(filename, n_gas=0, n_dark=0, n_star=0, gas=None, dark=None, \
+star=None, time=0.0, chunk_size=None, byteorder='>', double_pos=False, \
+double_vel=False):
+    """
+    Writes a tipsy snapshot to filename.  See the module doc-string
+    
+    * Arguments *
+    
+    filename : str
+        File to write to
+    n_gas, n_dark, n_star : int
+        Number of particles of each family
+    gas, dark, star : dict
+        Particle data for each family, as {field: value}.  See _fields for
+        the available fields
+    time : float
+        Simulation time (header)
+    chunk_size : int
+        Number of particles written at a time (default _chunk_size)
+    byteorder : str
+        '>' (big-endian, default) or '<'
+    double_pos, double_vel : bool
+        Write positions/velocities in double precision (see bDoublePos and
+        bDoubleVel in the .param file)
+    """
+    if chunk_size is None:
+        
+        chunk_size = _chunk_size
+    
+    counts = {'gas': int(n_gas), 'dark': int(n_dark), 'star': int(n_star)}
+    data = {'gas': gas, 'dark': dark, 'star': star}
+    h_dtype = header_dtype(byteorder)
+    dtypes = dict([(family, particle_dtype(family, byteorder, double_pos, \
+    double_vel)) for family in _families])
+    
+    for family in _families:
+        
+        data[family] = {} if data[family] is None else data[family]
+        
+        for key in data[family]:
+            
+            if key not in _fields[family]:
+                
+                raise ValueError, 'Unknown {0} field: {1}'.format(family, key)
+    
+    offsets = _offsets(h_dtype, counts, dtypes)
+    f = np.memmap(filename, dtype=np.uint8, mode='w+', \
+    shape=(offsets['end'],))
+    
+    # Header
+    header = f[0:h_dtype.itemsize].view(h_dtype)
+    header['time'] = time
+    header['nbodies'] = sum(counts.values())
+    header['ndim'] = 3
+    header['nsph'] = counts['gas']
+    header['ndark'] = counts['dark']
+    header['nstar'] = counts['star']
+    header['pad'] = 0
+    
+    # Particles
+    for family in _families:
+        
+        n = counts[family]
+        dtype = dtypes[family]
+        records = _records(f, offsets[family], n, dtype)
+        # Records are made in a buffer then copied to the file.  Fields which
+        # are the same for every particle only need to be set once
+        buf = np.zeros(min(chunk_size, n), dtype)
+        fields = data[family]
+        vary = [name for name in fields \
+        if _per_particle(fields[name], n, name in ('pos', 'vel'))]
+        
+        for name in fields:
+            
+            if name not in vary:
+                
+                buf[name] = np.asarray(fields[name])
+        
+        for i0 in range(0, n, chunk_size):
+            
+            i1 = min(i0 + chunk_size, n)
+            block = buf[0:i1 - i0]
+            
+            for name in vary:
+                
+                x = fields[name]
+                x = x(i0, i1) if callable(x) else x[i0:i1]
+                block[name] = np.asarray(x)
+            
+            records[i0:i1] = block
+    
+    f.flush()
+    del f
+
+def read_header(filename):
+    """
+    Reads the header of a tipsy file.  Returns the header (a numpy record,
+    see header_dtype) and the byteorder of the file ('>' or '<')
+    """
+    raw = np.fromfile(filename, dtype=np.uint8, count=header_dtype().itemsize)
+    
+    for byteorder in ('>', '<'):
+        
+        header = raw.view(header_dtype(byteorder))[0]
+        
+        if header['ndim'] == 3:
+            
+            return header, byteorder
+    
+    raise IOError, 'Could not read tipsy header of {0}'.format(filename)
+
+def patch(filename, family, fields, chunk_size=None):
+    """
+    Overwrites fields of all the particles of one family in an existing
+    tipsy file, in place.  The rest of the file is left as it is.  Byte order
+    and double precision pos/vel are detected from the file
+    
+    * Arguments *
+    
+    filename : str
+        Tipsy file to update
+    family : str
+        'gas', 'dark', or 'star'
+    fields : dict
+        The new values, as {field: value}.  Values can be arrays, scalars,
+        or functions f(i0, i1) (see write)
+    chunk_size : int
+        Number of particles written at a time (default _chunk_size)
+    """
+    if chunk_size is None:
+        
+        chunk_size = _chunk_size
+    
+    for key in fields:
+        
+        if key not in _fields[family]:
+            
+            raise ValueError, 'Unknown {0} field: {1}'.format(family, key)
+    
+    byteorder, counts, dtypes, offsets = _layout(filename)
+    n = counts[family]
+    f = np.memmap(filename, dtype=np.uint8, mode='r+', shape=(offsets['end'],))
+    records = _records(f, offsets[family], n, dtypes[family])
+    
+    for i0 in range(0, n, chunk_size):
+        
+        i1 = min(i0 + chunk_size, n)
+        block = records[i0:i1]
+        
+        for name, x in fields.iteritems():
+            
+            if _per_particle(x, n, name in ('pos', 'vel')):
+                
+                x = x(i0, i1) if callable(x) else x[i0:i1]
+            
+            block[name] = np.asarray(x)
+    
+    f.flush()
+    del f
+
+def read(filename, family, field):
+    """
+    Reads one field of all the particles of one family from a tipsy file (as
+    stored, ie in code units).  Returns a copy
+    """
+    if field not in _fields[family]:
+        
+        raise ValueError, 'Unknown {0} field: {1}'.format(family, field)
+    
+    byteorder, counts, dtypes, offsets = _layout(filename)
+    f = np.memmap(filename, dtype=np.uint8, mode='r', shape=(offsets['end'],))
+    x = np.array(_records(f, offsets[family], counts[family], \
+    dtypes[family])[field])
+    del f
+    
+    return x
+
+def _layout(filename):
+    """
+    Returns the byteorder, particle counts, particle dtypes, and offsets (see
+    _offsets) of a tipsy file.  Whether pos/vel are double precision is
+    worked out from the file size
+    """
+    header, byteorder = read_header(filename)
+    h_dtype = header_dtype(byteorder)
+    counts = {'gas': int(header['nsph']), 'dark': int(header['ndark']), \
+    'star': int(header['nstar'])}
+    size = os.path.getsize(filename)
+    
+    for double_pos, double_vel in ((False, False), (True, False), \
+    (False, True), (True, True)):
+        
+        dtypes = dict([(family, particle_dtype(family, byteorder, double_pos, \
+        double_vel)) for family in _families])
+        offsets = _offsets(h_dtype, counts, dtypes)
+        
+        if offsets['end'] == size:
+            
+            return byteorder, counts, dtypes, offsets
+    
+    raise IOError, 'Size of {0} does not match its header'.format(filename)
+
+def _offsets(h_dtype, counts, dtypes):
+    """
+    Returns the byte offsets of the particle records of each family, and of
+    the end of the file ('end')
+    """
+    offsets = {}
+    offset = h_dtype.itemsize
+    
+    for family in _families:
+        
+        offsets[family] = offset
+        offset += counts[family] * dtypes[family].itemsize
+    
+    offsets['end'] = offset
+    
+    return offsets
+
+def _records(f, offset, n, dtype):
+    """
+    Returns the n particle records (dtype) starting at offset in the
+    memory-mapped (uint8) file f
+    """
+    return f[offset:offset + n*dtype.itemsize].view(dtype)
+
+def _per_particle(x, n, vector=False):
+    """
+    Checks whether x (see write) has different values for each of the n
+    particles (ie it's a function or an array of length n).  For vector fields
+    (pos, vel) only 2D arrays are per-particle
+    """
+    if callable(x):
+        
+        return True
+    
+    return (np.ndim(x) > (1 if vector else 0)) and (len(x) == n)